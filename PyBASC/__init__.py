@@ -1,12 +1,36 @@
 from PyBASC.utils import (
     timeseries_bootstrap,
+    timeseries_bootstrap_indices,
+    timeseries_bootstrap_generator,
     standard_bootstrap,
+    standard_bootstrap_counts,
+    pack_stability_matrix,
+    unpack_stability_matrix,
+    save_stability_matrix,
+    load_stability_matrix,
+    sum_stability_matrices,
+    PackedStabilityMatrix,
+    correlation_similarity,
+    knn_correlation_similarity,
+    similarity_matrix,
+    SimilarityWorkspace,
+    WarmStart,
+    spatial_connectivity,
     cluster_timeseries,
+    cluster_similarity,
+    similarity_embedding,
+    WardTree,
     cross_cluster_timeseries,
     adjacency_matrix,
+    CoassignmentAccumulator,
+    stability_matrix_from_labels,
+    cluster_one_hot,
     cluster_matrix_average,
+    WithinClusterMask,
     individual_stability_matrix,
+    parallel_individual_stability_matrix,
     expand_ism,
+    expand_ism_blocks,
     compare_stability_matrices,
     data_compression,
 )
@@ -14,9 +38,21 @@ from PyBASC.utils import (
 from PyBASC.basc import (
     nifti_individual_stability,
     map_group_stability,
+    map_group_stability_bootstraps,
+    group_stability_means,
+    cluster_group_stability,
+    select_individual_stability,
     join_group_stability,
+    load_roi_mask,
+    load_header,
+    load_subject_rois,
+    create_cohort_store,
+    is_cohort_entry,
+    load_cohort_rois,
     ndarray_to_vol,
+    ndarray_to_vols,
     individual_group_clustered_maps,
+    batch_individual_group_clustered_maps,
     post_analysis,
     save_igcm_nifti,
     create_group_cluster_maps,
@@ -22,6 +22,12 @@ def main_args():
     parser.add_argument('--parallelized', action='store_true')
     parser.add_argument('--cache_method', type=str)
     parser.add_argument('--seed', type=int)
+    parser.add_argument('--cohort_store', type=str,
+                        help='Directory where the masked subject time series '
+                             'are stored and reused between runs')
+    parser.add_argument('--cache_dir', type=str,
+                        help='Directory where the masked subject time series '
+                             'are cached by the workflow nodes')
     args = parser.parse_args()
 
     config = yaml.load(args.config)
@@ -30,10 +36,13 @@ def main_args():
     main(config,
          parallelized=args.parallelized,
          random_seed=args.seed,
-         cache_method=args.cache_method)
+         cache_method=args.cache_method,
+         cohort_store=args.cohort_store,
+         cache_dir=args.cache_dir)
 
 
-def main(config, parallelized=False, random_seed=None, cache_method='timestamp'):
+def main(config, parallelized=False, random_seed=None, cache_method='timestamp',
+         cohort_store=None, cache_dir=None):
 
     if type(config) is not dict:
         raise ValueError("Expecting dictionary of configuration")
@@ -75,6 +84,18 @@ def main(config, parallelized=False, random_seed=None, cache_method='timestamp')
         cross_cluster_mask_file = \
             os.path.abspath(cross_cluster_mask_file.replace('$PYBASC', path))
 
+    cohort_store = config.get('cohort_store', cohort_store)
+    if cohort_store:
+        subject_file_list = PyBASC.create_cohort_store(
+            subject_file_list, roi_mask_file,
+            os.path.abspath(cohort_store.replace('$PYBASC', path)),
+            cxc_roi_mask_file=cross_cluster_mask_file if cross_cluster else None
+        )
+
+    cache_dir = config.get('cache_dir', cache_dir)
+    if cache_dir:
+        cache_dir = os.path.abspath(cache_dir.replace('$PYBASC', path))
+
     if parallelized:
 
         run_basc_workflow_parallelized(
@@ -94,7 +115,8 @@ def main(config, parallelized=False, random_seed=None, cache_method='timestamp')
             out_dir=home + '/PyBASC_Outputs', proc_mem=proc_mem,
             analysis_id=analysis_id,
             random_seed=random_seed,
-            cache_method=cache_method
+            cache_method=cache_method,
+            cache_dir=cache_dir
         )
 
     else:
@@ -118,7 +140,8 @@ def main(config, parallelized=False, random_seed=None, cache_method='timestamp')
             reruns=reruns,
             group_dim_reduce=group_dim_reduce,
             analysis_ID=analysis_id,
-            random_seed=random_seed
+            random_seed=random_seed,
+            cache_dir=cache_dir
         )
 
 
@@ -128,7 +151,7 @@ def run_PyBASC(
     dataset_bootstrap_list, timeseries_bootstrap_list, similarity_metric_list, cluster_methods,
     blocklength_list, n_clusters_list, output_sizes, subject_file_list, roi_mask_file, proc_mem,
     cross_cluster, cross_cluster_mask_file, affinity_threshold_list, run, home, reruns,
-    group_dim_reduce, analysis_ID, random_seed=None
+    group_dim_reduce, analysis_ID, random_seed=None, cache_dir=None
 ):
 
     ism_gsm_stability = []
@@ -207,7 +230,8 @@ def run_PyBASC(
                                         affinity_threshold=affinity_threshold_per_subject,
                                         cluster_method=cluster_method,
                                         out_dir=experiment_dir,
-                                        run=run
+                                        run=run,
+                                        cache_dir=cache_dir
                                     )
 
                                     ism_gsm_stability.append(
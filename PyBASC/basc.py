@@ -1,3 +1,4 @@
+import functools
 import os
 import sys
 
@@ -10,7 +11,7 @@ import numpy as np
 def group_dim_reduce(
     subjects_files,
     roi_mask_file, compression_dim, group_dim_reduce=False,
-    cross_cluster=False, cxc_roi_mask_file=None
+    cross_cluster=False, cxc_roi_mask_file=None, cache_dir=None
 ):
     """
     Perform group dimensionality reduction, if group_dim is enabled and
@@ -19,7 +20,7 @@ def group_dim_reduce(
     Parameters
     ----------
     subjects_files : string
-        Nifti files of all subjects
+        Nifti files of all subjects, or their entries in a cohort store
     roi_mask_file : string
         Region of interest. This method is too computationally intensive to
         perform on a whole-brain volume.
@@ -35,7 +36,10 @@ def group_dim_reduce(
     cxc_roi_mask_file : string
         The primary region will be clustered based on similarity of voxel-wise
         connectivity to this region.
-    
+    cache_dir : string, optional
+        Directory of the masked subject time series cache, see
+        `load_subject_rois`, and of the ward connectivity graphs, see
+        `utils.spatial_connectivity`
 
     Returns
     -------
@@ -78,6 +82,7 @@ def group_dim_reduce(
         from sklearn.preprocessing import normalize
 
         import PyBASC.utils as utils
+        import PyBASC.basc as basc
 
         print("Compressing %d subjects with dimension "
               "%d" % (len(subjects_files), compression_dim))
@@ -90,18 +95,27 @@ def group_dim_reduce(
             cxc_roi_mask_img = nb.load(cxc_roi_mask_file)
             cxc_roi_mask_data = cxc_roi_mask_img.get_data().astype('bool')
 
+        roi_mask_files = []
+        if compress:
+            roi_mask_files.append(roi_mask_file)
+        if cross_cluster and cxc_compress:
+            roi_mask_files.append(cxc_roi_mask_file)
+
         group_data = []
         cxc_group_data = []
         for subject_i, subject_file in enumerate(subjects_files):
-            subject_data = nb.load(subject_file) \
-                            .get_data() \
-                            .astype('float16')
+            subject_rois = basc.load_subject_rois(
+                subject_file, roi_mask_files, cache_dir=cache_dir
+            )
+            subject_rois = [
+                subject_roi.astype('float16') for subject_roi in subject_rois
+            ]
 
             if compress:
-                group_data.append(subject_data[roi_mask_data])
+                group_data.append(subject_rois[0])
 
             if cross_cluster and cxc_compress:
-                cxc_group_data.append(subject_data[cxc_roi_mask_data])
+                cxc_group_data.append(subject_rois[-1])
 
             print(
                 "Subject %d of %d loaded" % (
@@ -114,7 +128,8 @@ def group_dim_reduce(
             group_data = normalize(group_data, norm='l2')
 
             compression = utils.data_compression(group_data.T, roi_mask_img,
-                                                 roi_mask_data, compression_dim)
+                                                 roi_mask_data, compression_dim,
+                                                 cache_dir=cache_dir)
 
             compression_labels = compression['labels'][:, np.newaxis]
 
@@ -139,7 +154,8 @@ def group_dim_reduce(
                 cxc_group_data.T,
                 cxc_roi_mask_img,
                 cxc_roi_mask_data,
-                cxc_compression_dim
+                cxc_compression_dim,
+                cache_dir=cache_dir
             )
 
             cxc_compressor = cxc_compression['compressor']
@@ -157,7 +173,10 @@ def nifti_individual_stability(
     n_bootstraps, n_clusters, compression_dim, similarity_metric,
     blocklength=1, cbb_block_size=None, affinity_threshold=0.0, cluster_method='ward',
     compressor=None, cross_cluster=False, cxc_compressor=None,
-    cxc_roi_mask_file=None, random_state_tuple=None
+    cxc_roi_mask_file=None, random_state_tuple=None, n_jobs=1,
+    stability_format='npz', cache_dir=None, warm_start=False,
+    embedding=None, n_components=50, eigen_solver='arpack', n_neighbors=10,
+    deferred=False, save_labels=False
 ):
     # TODO @AKI update docs
     """
@@ -167,7 +186,7 @@ def nifti_individual_stability(
     Parameters
     ----------
     subject_file : string
-        Nifti file of a subject
+        Nifti file of a subject, or its entry in a cohort store
         
     roi_mask_file : string
         Region of interest that is being parcellated. Large volumes should use
@@ -176,8 +195,10 @@ def nifti_individual_stability(
     n_bootstraps : integer
         Number of bootstraps
         
-    n_clusters : integer
-        Number of clusters
+    n_clusters : integer or list of integers
+        Number of clusters. With a list, the bootstraps are resampled and
+        their similarity computed once for all numbers of clusters, and one
+        stability matrix is written per number of clusters.
                 
     compression_dim : 
         The number of supervoxels to be created after the compression.
@@ -213,16 +234,60 @@ def nifti_individual_stability(
     
     random_state_tuple : 
 
+    n_jobs : integer, optional
+        Number of processes the bootstraps of the subject are spread over.
+        The bootstraps are seeded differently with one job than with
+        several, see `individual_stability_matrix`
+
+    stability_format : {'npz', 'npy'}, optional
+        File format of the saved stability matrix: a sparse `.npz`, or the
+        packed upper triangle as a memory-mappable `.npy`
+
+    cache_dir : string, optional
+        Directory of the masked subject time series cache, see
+        `load_subject_rois`, and of the ward connectivity graphs, see
+        `utils.spatial_connectivity`
+
+    warm_start : boolean, optional
+        For the k-means methods, start each bootstrap from the centroids of
+        the previous one, see `individual_stability_matrix`
+
+    embedding : {None, 'svd', 'spectral'}, optional
+        Cluster each bootstrap on a low-rank embedding of its similarity
+        matrix, see `utils.cluster_similarity`
+
+    n_components : integer, optional
+        Number of dimensions of the embedding
+
+    eigen_solver : {'arpack', 'lobpcg', 'amg'}, optional
+        Eigensolver of spectral clustering and embedding, 'amg' needs pyamg
+
+    n_neighbors : integer, optional
+        Number of neighbours of each voxel with the 'k_neighbors' metric
+
+    deferred : boolean, optional
+        Count the co-assignments once all bootstraps are clustered, see
+        `individual_stability_matrix`
+
+    save_labels : boolean, optional
+        Also write the cluster labels of every bootstrap to
+        `bootstrap_labels.npy`, so the stability can be recomputed later
+        with `utils.stability_matrix_from_labels` without clustering again
+
     Returns
     -------
-    ism : array_like
-        Individual stability matrix of shape (`V`, `V`), `V` voxels
+    ism_file : string or list of strings
+        Individual stability matrix file, or one file per number of clusters
+        when `n_clusters` is a list
+    compression_labels_file : string
+        Labels of the individual compression, None if not compressed
     """
     
     import os
     import numpy as np
     import nibabel as nb
     import PyBASC.utils as utils
+    import PyBASC.basc as basc
     from sklearn.preprocessing import normalize
     import scipy.sparse
 
@@ -237,11 +302,18 @@ def nifti_individual_stability(
     else:
         cxc_compression_dim = compression_dim
 
-    subject_data = nb.load(subject_file).get_data().astype('float32')
+    roi_mask_files = [roi_mask_file]
+    if cross_cluster:
+        roi_mask_files.append(cxc_roi_mask_file)
+
+    subject_rois = basc.load_subject_rois(
+        subject_file, roi_mask_files, cache_dir=cache_dir
+    )
+    subject_rois, subject_cxc_rois = subject_rois[0], subject_rois[-1]
+
     roi_mask_image = nb.load(roi_mask_file)
     roi_mask_data = roi_mask_image.get_data().astype('bool')
 
-    subject_rois = subject_data[roi_mask_data]
     subject_rois = normalize(subject_rois, norm='l2')
 
     if compression_dim == 0:
@@ -259,7 +331,8 @@ def nifti_individual_stability(
                 subject_rois.T,
                 roi_mask_image,
                 roi_mask_data,
-                compression_dim
+                compression_dim,
+                cache_dir=cache_dir
             )
 
             compression_labels = compression['labels'][:, np.newaxis]
@@ -282,7 +355,6 @@ def nifti_individual_stability(
         cxc_roi_mask_img = nb.load(cxc_roi_mask_file)
         cxc_roi_mask_data = cxc_roi_mask_img.get_data().astype('bool')
 
-        subject_cxc_rois = subject_data[cxc_roi_mask_data]
         subject_cxc_rois = normalize(subject_cxc_rois, norm='l2')
 
         if cxc_compression_dim == 0:
@@ -299,7 +371,8 @@ def nifti_individual_stability(
                     subject_cxc_rois.T,
                     cxc_roi_mask_img,
                     cxc_roi_mask_data,
-                    cxc_compression_dim
+                    cxc_compression_dim,
+                    cache_dir=cache_dir
                 )
 
                 cxc_compressed = cxc_compression['compressed']
@@ -335,28 +408,73 @@ def nifti_individual_stability(
         blocklength=blocklength,
         affinity_threshold=affinity_threshold,
         cluster_method=cluster_method,
-        random_state=random_state
+        random_state=random_state,
+        deferred=deferred,
+        return_labels=save_labels,
+        n_jobs=n_jobs,
+        warm_start=warm_start,
+        embedding=embedding,
+        n_components=n_components,
+        eigen_solver=eigen_solver,
+        n_neighbors=n_neighbors
     )
 
-    ism = scipy.sparse.csr_matrix(ism, dtype=np.int8)
-    ism_file = os.path.join(os.getcwd(), 'individual_stability_matrix.npz')
-
-    # get back to original dimensionality based on individual or group-based
-    # dimensionality reductionn
-    if not compressor:
-        voxel_ism = utils.expand_ism(ism, compression_labels)
-        voxel_ism = voxel_ism.astype("uint8")
-        scipy.sparse.save_npz(ism_file, voxel_ism)
+    if save_labels:
+        ism, bootstrap_labels = ism
+        np.save(os.path.join(os.getcwd(), 'bootstrap_labels.npy'),
+                bootstrap_labels)
+
+    multiple_k = isinstance(n_clusters, (list, tuple, np.ndarray))
+    if multiple_k:
+        isms = ism
+        ism_files = [
+            os.path.join(
+                os.getcwd(),
+                'individual_stability_matrix_k%d.%s' % (k, stability_format)
+            )
+            for k in n_clusters
+        ]
     else:
-        scipy.sparse.save_npz(ism_file, ism)
+        isms = [ism]
+        ism_files = [os.path.join(
+            os.getcwd(), 'individual_stability_matrix.%s' % stability_format
+        )]
+
+    for ism, ism_file in zip(isms, ism_files):
+        ism = utils.PackedStabilityMatrix.from_dense(ism)
+
+        # get back to original dimensionality based on individual or
+        # group-based dimensionality reductionn
+        if not compressor and compression_labels_file:
+            ism = ism.expand(compression_labels)
+
+        ism.save(ism_file)
+
+    if multiple_k:
+        return ism_files, compression_labels_file
+
+    return ism_files[0], compression_labels_file
+
 
-    return ism_file, compression_labels_file
+def _check_n_clusters(n_clusters):
+    """
+    Check that a single number of clusters is given to a group-level stage.
+    Only the individual stability matrices can be computed for several
+    numbers of clusters at once.
+    """
+    import numpy as np
+
+    if np.ndim(n_clusters) > 0:
+        raise ValueError(
+            'The group stages take a single number of clusters, got %s. '
+            'Run them once for each number of clusters.' % (n_clusters,)
+        )
 
 
 def map_group_stability_random_bootstrap(
     subject_stability_list, n_clusters, is_bootstrapping,
     roi_mask_file, group_dim_reduce, cluster_method='ward',
-    random_state_tuple=None
+    random_state_tuple=None, stability_format='npz'
 ):
     """
 
@@ -367,8 +485,8 @@ def map_group_stability_random_bootstrap(
         A length `N` list of file paths to numpy matrices of shape (`V`, `V`),
         `N` subjects, `V` voxels
         
-    n_clusters : array_like
-        number of clusters extracted from adjacency matrx  
+    n_clusters : integer
+        number of clusters extracted from adjacency matrix, a single one
         
      is_bootstrapping : int or bool
         indicates if it is to perform bootstrapping. If it is an integer, it will
@@ -385,7 +503,10 @@ def map_group_stability_random_bootstrap(
         
     cluster_method : string, optional
         What type of clustering will be applied.    
-        
+
+    stability_format : {'npz', 'npy'}, optional
+        File format of the saved stability matrix: a sparse `.npz`, or the
+        packed upper triangle as a memory-mappable `.npy`
    
     """
 
@@ -403,14 +524,15 @@ def map_group_stability_random_bootstrap(
     return map_group_stability(
         subject_stability_list, n_clusters, is_bootstrapping,
         roi_mask_file, group_dim_reduce, cluster_method,
-        random_state_tuple=random_state.get_state()
+        random_state_tuple=random_state.get_state(),
+        stability_format=stability_format
     )
 
 
 def map_group_stability(
     subject_stability_list, n_clusters, is_bootstrapping,
     roi_mask_file, group_dim_reduce, cluster_method='ward',
-    random_state_tuple=None
+    random_state_tuple=None, stability_format='npz'
 ):
     # TODO @AKI review doc
     """
@@ -421,8 +543,8 @@ def map_group_stability(
     subject_stability_list : list of strings
         A length `N` list of file paths to numpy matrices of shape (`V`, `V`),
         `N` subjects, `V` voxels
-    n_clusters : array_like
-        number of clusters extracted from adjacency matrix
+    n_clusters : integer
+        number of clusters extracted from adjacency matrix, a single one
         
     is_bootstrapping : int or bool
         indicates if it is to perform bootstrapping. If it is an integer, it will
@@ -440,6 +562,10 @@ def map_group_stability(
     cluster_method : string, optional
         What type of clustering will be applied.    
 
+    stability_format : {'npz', 'npy'}, optional
+        File format of the saved stability matrix: a sparse `.npz`, or the
+        packed upper triangle as a memory-mappable `.npy`
+
     Returns
     -------
     G_file : numpy array
@@ -451,8 +577,11 @@ def map_group_stability(
     import numpy as np
     import nibabel as nb
     import PyBASC.utils as utils
+    import PyBASC.basc as basc
     import scipy.sparse
 
+    basc._check_n_clusters(n_clusters)
+
     print(
         'Calculating group stability matrix for %d subjects' %
         len(subject_stability_list)
@@ -460,20 +589,20 @@ def map_group_stability(
 
     random_state = utils.get_random_state(random_state_tuple)
 
-    indiv_stability_set = np.asarray([
-        scipy.sparse.load_npz(ism_file).toarray()
-        for ism_file in subject_stability_list
-    ])
-
+    # The subject matrices are summed one at a time, weighted by the number
+    # of times the bootstrap drew them, instead of stacking the resample
+    n_subjects = len(subject_stability_list)
     if is_bootstrapping:
-        J = utils.standard_bootstrap(
-            indiv_stability_set,
-            random_state=random_state
-        ).mean(axis=0)
+        weights = utils.standard_bootstrap_counts(
+            n_subjects, random_state=random_state
+        )
     else:
-        J = indiv_stability_set.mean(axis=0)
+        weights = None
 
-    J = J.astype("uint8")
+    J = utils.sum_stability_matrices(
+        subject_stability_list, weights, packed=True
+    )
+    J = J.scaled(1, n_subjects).toarray()
 
     if group_dim_reduce:
         roi_mask_img = None
@@ -482,30 +611,355 @@ def map_group_stability(
     
 
     
-    G = utils.adjacency_matrix(
+    G = utils.PackedStabilityMatrix.from_labels(
         utils.cluster_timeseries(J, roi_mask_img, n_clusters,
                                  similarity_metric='correlation',
                                  affinity_threshold=0.0,
                                  cluster_method=cluster_method,
-                                 random_state=random_state)[:, np.newaxis]
+                                 random_state=random_state)
     )
-    
 
-    
-    G = scipy.sparse.csr_matrix(G, dtype=np.int8)
-    
+    G_file = os.path.join(
+        os.getcwd(), 'individual_stability_matrix.%s' % stability_format
+    )
+    G.save(G_file)
+
+    return G_file
+
+
+def group_stability_means(
+    subject_stability_list, bootstrap_list, random_state_tuple=None
+):
+    """
+    Calculate the average individual stability matrix of every group-level
+    bootstrap, reading each individual stability matrix a single time.
+
+    The multiplicity of each subject in each bootstrap is drawn up front and
+    the averages of all bootstraps are computed together as a product of the
+    (`B`, `N`) multiplicities with the (`N`, `V` * (`V` + 1) / 2) packed
+    matrices, one block of columns at a time. Packed `.npy` matrices are
+    memory-mapped in place, the other formats are decoded once into a
+    memory-mapped stack.
+
+    Parameters
+    ----------
+    subject_stability_list : list of strings
+        A length `N` list of file paths to numpy matrices of shape (`V`, `V`),
+        `N` subjects, `V` voxels
+
+    bootstrap_list : list
+        The `is_bootstrapping` value of each group bootstrap, see
+        `map_group_stability_random_bootstrap`
+
+    Returns
+    -------
+    group_mean_files : list of strings
+        The packed `.npy` average matrix of each bootstrap
+
+    random_state_tuples : list of tuples
+        The state each bootstrap leaves its random state in, to cluster its
+        average matrix with
+
+    """
+
+    import os
+    import numpy as np
+    import PyBASC.utils as utils
+
+    n_subjects = len(subject_stability_list)
+    n_bootstraps = len(bootstrap_list)
+
+    print(
+        'Calculating %d group stability matrices for %d subjects' %
+        (n_bootstraps, n_subjects)
+    )
+
+    # draw the subject multiplicities of every bootstrap, leaving each random
+    # state where map_group_stability would leave it before clustering
+    random_state_tuples = []
+    weights = np.ones((n_bootstraps, n_subjects))
+    for i, is_bootstrapping in enumerate(bootstrap_list):
+        random_state = utils.generate_random_state(
+            utils.get_random_state(random_state_tuple), is_bootstrapping
+        )
+        if type(is_bootstrapping) == int:
+            weights[i] = utils.standard_bootstrap_counts(
+                n_subjects, random_state=random_state
+            )
+        random_state_tuples.append(random_state.get_state())
+
+    # the matrices are symmetric, only their packed upper triangles are
+    # averaged
+    stack_file = os.path.join(os.getcwd(), 'subject_stability_stack.npy')
+    n_staged = sum(
+        not ism_file.endswith('.npy') for ism_file in subject_stability_list
+    )
+
+    isms = []
+    stack = None
+    staged = 0
+    for ism_file in subject_stability_list:
+        ism = utils.load_stability_matrix(ism_file, packed=True)
+        if not ism_file.endswith('.npy'):
+            if stack is None:
+                stack = np.lib.format.open_memmap(
+                    stack_file, mode='w+', dtype='uint8',
+                    shape=(n_staged, len(ism))
+                )
+            stack[staged] = ism
+            ism = stack[staged]
+            staged += 1
+        isms.append(ism)
+    n_packed = len(isms[0])
+
+    group_mean_files = [
+        os.path.join(os.getcwd(), 'group_stability_mean_%d.npy' % i)
+        for i in range(n_bootstraps)
+    ]
+    means = [
+        np.lib.format.open_memmap(
+            group_mean_file, mode='w+', dtype='uint8', shape=(n_packed,)
+        )
+        for group_mean_file in group_mean_files
+    ]
+
+    # both the staged block and its (B x block) product fit in 64MB of
+    # float64, the sums are integers well below 2 ** 53 so the product is
+    # exact
+    block_size = max(1, (1 << 23) // max(n_bootstraps, n_subjects))
+    for start in range(0, n_packed, block_size):
+        stop = min(start + block_size, n_packed)
+        block = np.empty((n_subjects, stop - start))
+        for i, ism in enumerate(isms):
+            block[i] = ism[start:stop]
+
+        J = np.dot(weights, block)
+        J //= n_subjects
+        for mean, J_mean in zip(means, J):
+            mean[start:stop] = J_mean
+
+    for mean in means:
+        mean.flush()
+    del isms, stack, means
+    if n_staged:
+        os.remove(stack_file)
+
+    return group_mean_files, random_state_tuples
+
+
+def cluster_group_stability(
+    group_mean_file, n_clusters, roi_mask_file, group_dim_reduce,
+    cluster_method='ward', random_state_tuple=None, stability_format='npz',
+    G_file=None
+):
+    """
+    Cluster the average individual stability matrix of a group-level
+    bootstrap into its group stability matrix.
+
+    Parameters
+    ----------
+    group_mean_file : string
+        The packed `.npy` average matrix of the bootstrap, see
+        `group_stability_means`
+
+    n_clusters : integer
+        number of clusters extracted from adjacency matrix, a single one
+
+    roi_mask_file : string
+        Region of interest that is being parcellated.
+
+    group_dim_reduce : boolean
+        Whether or not dimension reduction will be performed at the group
+        level.
+
+    cluster_method : string, optional
+        What type of clustering will be applied.
+
+    random_state_tuple : tuple, optional
+        State of the random state of the bootstrap
+
+    stability_format : {'npz', 'npy'}, optional
+        File format of the saved stability matrix: a sparse `.npz`, or the
+        packed upper triangle as a memory-mappable `.npy`
+
+    G_file : string, optional
+        Path of the saved group stability matrix, in the working directory by
+        default
+
+    Returns
+    -------
+    G_file : string
+        The group stability matrix of the bootstrap
+
+    """
+
+    import os
+    import nibabel as nb
+    import PyBASC.utils as utils
+    import PyBASC.basc as basc
+
+    basc._check_n_clusters(n_clusters)
+
+    random_state = utils.get_random_state(random_state_tuple)
+
+    J = utils.PackedStabilityMatrix.load(group_mean_file).toarray()
+
+    if group_dim_reduce:
+        roi_mask_img = None
+    else:
+        roi_mask_img = nb.load(roi_mask_file).get_data().astype('bool')
 
+    G = utils.PackedStabilityMatrix.from_labels(
+        utils.cluster_timeseries(J, roi_mask_img, n_clusters,
+                                 similarity_metric='correlation',
+                                 affinity_threshold=0.0,
+                                 cluster_method=cluster_method,
+                                 random_state=random_state)
+    )
 
-    G_file = os.path.join(os.getcwd(), 'individual_stability_matrix.npz')
-    scipy.sparse.save_npz(G_file, G)
+    if G_file is None:
+        G_file = os.path.join(
+            os.getcwd(), 'group_stability_matrix.%s' % stability_format
+        )
+    G.save(G_file)
 
     return G_file
 
 
+def map_group_stability_bootstraps(
+    subject_stability_list, n_clusters, bootstrap_list,
+    roi_mask_file, group_dim_reduce, cluster_method='ward',
+    random_state_tuple=None, stability_format='npz', n_jobs=1
+):
+    """
+    Calculate the group stability maps of all group-level bootstraps at once,
+    reading each individual stability matrix a single time.
+
+    It produces the same matrices as calling
+    `map_group_stability_random_bootstrap` for every item of
+    `bootstrap_list`. The average matrices of all bootstraps are computed in
+    one pass by `group_stability_means`, then each of them is clustered by
+    `cluster_group_stability`, in parallel over `n_jobs` processes.
+
+    Parameters
+    ----------
+    subject_stability_list : list of strings
+        A length `N` list of file paths to numpy matrices of shape (`V`, `V`),
+        `N` subjects, `V` voxels
+
+    n_clusters : integer
+        number of clusters extracted from adjacency matrix, a single one
+
+    bootstrap_list : list
+        The `is_bootstrapping` value of each group bootstrap, see
+        `map_group_stability_random_bootstrap`
+
+    roi_mask_file : string
+        Region of interest that is being parcellated.
+
+    group_dim_reduce : boolean
+        Whether or not dimension reduction will be performed at the group
+        level.
+
+    cluster_method : string, optional
+        What type of clustering will be applied.
+
+    stability_format : {'npz', 'npy'}, optional
+        File format of the saved stability matrix: a sparse `.npz`, or the
+        packed upper triangle as a memory-mappable `.npy`
+
+    n_jobs : integer, optional
+        Number of processes clustering the bootstraps
+
+    Returns
+    -------
+    G_file : list of strings
+        The group stability matrix file of each bootstrap
+
+    """
+
+    import os
+    from joblib import Parallel, delayed
+    from PyBASC.basc import (
+        _check_n_clusters,
+        cluster_group_stability,
+        group_stability_means,
+    )
+
+    _check_n_clusters(n_clusters)
+
+    group_mean_files, random_state_tuples = group_stability_means(
+        subject_stability_list, bootstrap_list,
+        random_state_tuple=random_state_tuple
+    )
+
+    G_files = [
+        os.path.join(
+            os.getcwd(),
+            'group_bootstrap_stability_matrix_%d.%s' % (i, stability_format)
+        )
+        for i in range(len(bootstrap_list))
+    ]
+
+    Parallel(n_jobs=n_jobs)(
+        delayed(cluster_group_stability)(
+            group_mean_file, n_clusters, roi_mask_file, group_dim_reduce,
+            cluster_method=cluster_method,
+            random_state_tuple=bootstrap_state,
+            stability_format=stability_format,
+            G_file=G_file
+        )
+        for group_mean_file, bootstrap_state, G_file in zip(
+            group_mean_files, random_state_tuples, G_files
+        )
+    )
+
+    for group_mean_file in group_mean_files:
+        os.remove(group_mean_file)
+
+    return G_files
+
+
+def select_individual_stability(
+    subject_stability_list, n_clusters_list, n_clusters
+):
+    """
+    Select the individual stability matrices of one number of clusters, out
+    of the ones `nifti_individual_stability` computes in a single pass for a
+    list of numbers of clusters.
+
+    Parameters
+    ----------
+    subject_stability_list : list
+        A length `N` list of the stability matrix files of each subject, one
+        per number of clusters of `n_clusters_list`
+
+    n_clusters_list : list of integers
+        The numbers of clusters the stability matrices were computed for
+
+    n_clusters : integer
+        The number of clusters to select
+
+    Returns
+    -------
+    subject_stability_list : list of strings
+        A length `N` list of the stability matrix file of each subject for
+        `n_clusters`
+
+    """
+
+    k = list(n_clusters_list).index(n_clusters)
+
+    return [
+        ism_files[k] if isinstance(ism_files, list) else ism_files
+        for ism_files in subject_stability_list
+    ]
+
+
 def join_group_stability(
     subject_stability_list, group_stability_list, n_bootstraps, n_clusters,
     roi_mask_file, group_dim_reduce, compression_labels_list,
-    cluster_method='ward', random_state_tuple=None
+    cluster_method='ward', random_state_tuple=None, stability_format='npz'
 ):
     """
     Merges the group stability maps for all and compares to all individual
@@ -524,8 +978,8 @@ def join_group_stability(
     n_bootstraps : array_like
         Number of bootstraps to join and average.
         
-    n_clusters : array_like
-        number of clusters extrated from adjacency matrx
+    n_clusters : integer
+        number of clusters extracted from adjacency matrix, a single one
         
     roi_mask_file : string
         Region of interest that is being parcellated. Large volumes should use
@@ -542,6 +996,10 @@ def join_group_stability(
     cluster_method : string, optional
         What type of clustering will be applied. 
 
+    stability_format : {'npz', 'npy'}, optional
+        File format of the saved stability matrix: a sparse `.npz`, or the
+        packed upper triangle as a memory-mappable `.npy`
+
     Returns
     -------
     G_file : numpy array
@@ -553,32 +1011,28 @@ def join_group_stability(
     import numpy as np
     import nibabel as nb
     import PyBASC.utils as utils
+    import PyBASC.basc as basc
     import scipy.sparse
 
-    random_state = utils.get_random_state(random_state_tuple)
+    basc._check_n_clusters(n_clusters)
 
-    group_stability_set = np.asarray([
-        scipy.sparse.load_npz(G_file).toarray()
-        for G_file in group_stability_list
-    ])
+    random_state = utils.get_random_state(random_state_tuple)
 
-    
-    G = group_stability_set.sum(axis=0)
-    G *= 100
-    G //= n_bootstraps
-    G = G.astype("uint8")
+    G = utils.sum_stability_matrices(group_stability_list, packed=True)
+    G = G.scaled(100, n_bootstraps)
 
     if group_dim_reduce:
-        compression_labels = np.asarray([np.load(compression_labels_list[0])])
-        G = scipy.sparse.csr_matrix(G, dtype=np.int8)
-        G = utils.expand_ism(G, compression_labels.T)
-        G = G.toarray()
+        # keep the supervoxel matrix, subjects are compared to it directly
+        group_labels = np.load(compression_labels_list[0]).ravel()
+        supervox_G = G.toarray()
+        G = G.expand(group_labels)
     
     
     roi_mask_data = nb.load(roi_mask_file).get_data().astype('bool')
 
+    G_dense = G.toarray()
     clusters_G = utils.cluster_timeseries(
-        G, roi_mask_data, n_clusters,
+        G_dense, roi_mask_data, n_clusters,
         similarity_metric='correlation', affinity_threshold=0.0,
         cluster_method=cluster_method, random_state=random_state
     )
@@ -592,16 +1046,12 @@ def join_group_stability(
     # so start from 1 to provide contrast when viewing between 0 voxels
     clusters_G += 1
 
-    indiv_stability_set = [
-        scipy.sparse.load_npz(ism_file) for ism_file in subject_stability_list
-    ]
-
     if compression_labels_list[0] == None:
         ism_gsm_corr = np.zeros(len(subject_stability_list))
 
         for i in range(len(subject_stability_list)):
-            ism = indiv_stability_set[i].toarray()
-            ism_gsm_corr[i] = utils.compare_stability_matrices(ism, G)
+            ism = utils.PackedStabilityMatrix.load(subject_stability_list[i])
+            ism_gsm_corr[i] = ism.compare(G_dense)
 
     else:
 
@@ -613,16 +1063,29 @@ def join_group_stability(
         ism_gsm_corr = np.zeros(len(subject_stability_list))
 
         for i in range(len(subject_stability_list)):
-            compression_labels = compression_labels_set[i]
-            ism = utils.expand_ism(
-                indiv_stability_set[i], compression_labels
-            ).toarray()
-            ism_gsm_corr[i] = utils.compare_stability_matrices(ism, G)
-
-    gsm_file = os.path.join(os.getcwd(), 'group_stability_matrix.npz')
-    G = scipy.sparse.csr_matrix(G, dtype=np.int8)
+            compression_labels = compression_labels_set[i].ravel()
+            ism = utils.PackedStabilityMatrix.load(subject_stability_list[i])
+
+            if ism.n_features == len(compression_labels):
+                # individually compressed ISMs are saved at voxel level
+                ism_gsm_corr[i] = ism.compare(G_dense)
+            elif group_dim_reduce and \
+                    np.array_equal(compression_labels, group_labels):
+                # both matrices expand with the same labels, compare them
+                # in supervoxel space
+                ism_gsm_corr[i] = ism.compare(
+                    supervox_G, labels=compression_labels
+                )
+            else:
+                ism_gsm_corr[i] = ism.expand(compression_labels).compare(
+                    G_dense
+                )
 
-    scipy.sparse.save_npz(gsm_file, G)
+    gsm_file = os.path.join(
+        os.getcwd(), 'group_stability_matrix.%s' % stability_format
+    )
+    G.save(gsm_file)
+    G = scipy.sparse.csr_matrix(G_dense, dtype=np.int8)
 
     clusters_G_file = os.path.join(os.getcwd(), 'clusters_G.npy')
     np.save(clusters_G_file, clusters_G)
@@ -640,69 +1103,439 @@ def join_group_stability(
     )
 
 
-def ndarray_to_vol(data_array, roi_mask_file, sample_file, filename):
+def _file_key(path):
     """
-    Converts a numpy array to a nifti file given an roi mask
+    Cache key of a file: its absolute path, modification time and size, so
+    that a rewritten file is read again.
+    """
+    import os
+
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    return path, stat.st_mtime_ns, stat.st_size
+
+
+@functools.lru_cache(maxsize=8)
+def _cached_roi_mask(file_key):
+    mask = nb.load(file_key[0]).get_data().astype('bool')
+    mask.flags.writeable = False
+    return mask
+
+
+@functools.lru_cache(maxsize=8)
+def _cached_header(file_key):
+    nii = nb.load(file_key[0])
+    affine = nii.get_affine()
+    affine.flags.writeable = False
+    return nii.get_header(), affine
+
+
+def load_roi_mask(roi_mask_file):
+    """
+    Loads a ROI mask as a read-only boolean array. The decoded masks of the
+    last few files are kept in memory.
 
     Parameters
     ----------
-    data_array : array_like
-        A data array with the same column length and index alignment as the
-        given roi_mask_file.  If data_array is two dimensional, first dimension
-        is considered temporal dimension
     roi_mask_file : string
-        Region of interest that is being parcellated. Large volumes should use
-        compression_dim to reduce computational load.
-    sample_file : string or list of strings
-        Path of sample nifti file(s) to use for header of the output.
-        If list, the first file is chosen.
-    filename : string
-        Name of output file
-
+        Path of the nifti mask
 
     Returns
     -------
-    img_file : string
-        Path of the nifti file output
+    roi_mask : array_like
+        Read-only boolean mask
 
     """
+    import PyBASC.basc as basc
 
-    import os
-    import numpy as np
-    import nibabel as nb
+    return basc._cached_roi_mask(basc._file_key(roi_mask_file))
 
-    roi_mask_file = nb.load(roi_mask_file).get_data().astype('bool')
 
-    if data_array.ndim == 1:
-        out_vol = np.zeros_like(roi_mask_file, dtype=data_array.dtype)
-        out_vol[roi_mask_file] = data_array
+def load_header(sample_file):
+    """
+    Loads the header and affine of a nifti file. The pairs of the last few
+    files are kept in memory.
 
-    elif data_array.ndim == 2:
-        list_roi_shape = list(roi_mask_file.shape[0:3])
+    Parameters
+    ----------
+    sample_file : string or list of strings
+        Path of sample nifti file(s). If list, the first file is chosen.
+        The header of a cohort store entry is the one of its original
+        subject file.
 
-        out_vol = np.zeros(
-            list_roi_shape + [data_array.shape[1]],
-            dtype=data_array.dtype
-        )
-        out_vol[roi_mask_file] = data_array
+    Returns
+    -------
+    header : Nifti1Header
+        The header of the file, to be copied before any change
+    affine : array_like
+        Read-only affine of the file
 
-    else:
-        raise ValueError(
-            'data_array is %i dimensional, '
+    """
+    import os
+    import json
+    import PyBASC.basc as basc
+
+    if type(sample_file) is list:
+        sample_file = sample_file[0]
+
+    if basc.is_cohort_entry(sample_file):
+        with open(os.path.join(os.path.dirname(sample_file),
+                               'cohort.json')) as f:
+            index = json.load(f)
+        sample_file = \
+            index['subjects'][os.path.basename(sample_file)]['file']
+
+    return basc._cached_header(basc._file_key(sample_file))
+
+
+def _file_hash(path, chunk_size=1 << 20):
+    """
+    SHA-1 of the content of a file, read in chunks.
+    """
+    import hashlib
+
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def load_subject_rois(subject_file, roi_mask_files, cache_dir=None,
+                      chunk_size=None):
+    """
+    Loads the time series of a subject within one or more ROI masks,
+    decompressing the subject file once for all of them.
+
+    The image is streamed through its data proxy a few volumes at a time,
+    and only the bounding box of the masks is kept from each read, so the
+    memory used is proportional to the ROIs and not to the full 4D image.
+
+    Parameters
+    ----------
+    subject_file : string
+        4D nifti file of a subject, or an entry of a cohort store made by
+        `create_cohort_store`
+    roi_mask_files : list of strings
+        Nifti masks of the regions to extract
+    cache_dir : string, optional
+        Directory where the masked time series are kept as `.npy` files,
+        keyed by the content hashes of the subject and mask files. When all
+        the masks of a subject are cached, the subject file is not decoded.
+    chunk_size : integer, optional
+        Number of volumes read at a time, by default as many as fit in about
+        64MB of the masks' bounding box
+
+    Returns
+    -------
+    subject_rois : list of array_like
+        For each mask, the float32 time series of shape (`V`, `T`) of its
+        `V` voxels
+
+    """
+    import os
+    import numpy as np
+    import nibabel as nb
+    import PyBASC.basc as basc
+    import PyBASC.utils as utils
+
+    if basc.is_cohort_entry(subject_file):
+        return basc.load_cohort_rois(subject_file, roi_mask_files)
+
+    cache_files = [None] * len(roi_mask_files)
+    if cache_dir:
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            if not os.path.isdir(cache_dir):
+                raise
+        subject_hash = basc._file_hash(subject_file)
+        cache_files = [
+            os.path.join(
+                cache_dir,
+                '%s_%s.npy' % (subject_hash, basc._file_hash(roi_mask_file))
+            )
+            for roi_mask_file in roi_mask_files
+        ]
+
+    if all(f and os.path.exists(f) for f in cache_files):
+        return [np.load(f) for f in cache_files]
+
+    # the file is kept open so that the reads of successive volumes carry on
+    # through the gzip stream rather than decompressing it from the start
+    subject_img = nb.load(subject_file, keep_file_open=True)
+    n_timepoints = subject_img.shape[3] if len(subject_img.shape) > 3 else 1
+
+    roi_masks = [
+        basc.load_roi_mask(roi_mask_file) for roi_mask_file in roi_mask_files
+    ]
+    bounding_box = tuple(
+        slice(voxels.min(), voxels.max() + 1) if len(voxels) else slice(0, 0)
+        for voxels in np.nonzero(np.logical_or.reduce(roi_masks))
+    )
+    roi_masks = [roi_mask[bounding_box] for roi_mask in roi_masks]
+
+    if chunk_size is None:
+        box_size = max(1, np.prod([s.stop - s.start for s in bounding_box]))
+        chunk_size = max(1, (64 << 20) // (8 * box_size))
+
+    subject_rois = [
+        np.empty((roi_mask.sum(), n_timepoints), dtype='float32')
+        for roi_mask in roi_masks
+    ]
+
+    for start in range(0, n_timepoints, chunk_size):
+        stop = min(start + chunk_size, n_timepoints)
+        if len(subject_img.shape) > 3:
+            chunk = subject_img.dataobj[bounding_box + (slice(start, stop),)]
+        else:
+            chunk = subject_img.dataobj[bounding_box][..., np.newaxis]
+        chunk = np.asanyarray(chunk)
+
+        for roi_mask, subject_roi in zip(roi_masks, subject_rois):
+            subject_roi[:, start:stop] = chunk[roi_mask]
+
+    del subject_img
+
+    for subject_roi, cache_file in zip(subject_rois, cache_files):
+        if cache_file:
+            utils._atomic_save(cache_file, np.save, subject_roi)
+
+    return subject_rois
+
+
+def create_cohort_store(subjects_files, roi_mask_file, store_dir,
+                        cxc_roi_mask_file=None):
+    """
+    Masks the time series of a cohort once and keeps them in a directory,
+    to be used in place of the nifti files by `nifti_individual_stability`
+    and `group_dim_reduce`.
+
+    The store holds a `cohort.json` index with the content hashes of the
+    masks and subject files, and for each subject its float32 (`V`, `T`)
+    ROI time series as `<entry>.roi.npy`, and cross-cluster ROI time series
+    as `<entry>.cxc.npy`, both memory-mappable. Subjects already in the
+    store with the same content hash are not masked again.
+
+    Parameters
+    ----------
+    subjects_files : list of strings
+        Nifti files of all subjects
+    roi_mask_file : string
+        Region of interest that is being parcellated
+    store_dir : string
+        Directory of the store
+    cxc_roi_mask_file : string, optional
+        Cross-cluster region of interest
+
+    Returns
+    -------
+    subject_entries : list of strings
+        Paths of the store entries of the subjects, in the order of
+        `subjects_files`
+
+    """
+    import os
+    import json
+    import numpy as np
+    import PyBASC.basc as basc
+
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+
+    masks = {'roi': (roi_mask_file, basc._file_hash(roi_mask_file))}
+    if cxc_roi_mask_file:
+        masks['cxc'] = (
+            cxc_roi_mask_file, basc._file_hash(cxc_roi_mask_file)
+        )
+
+    index_file = os.path.join(store_dir, 'cohort.json')
+    index = {'masks': {}, 'subjects': {}}
+    if os.path.exists(index_file):
+        with open(index_file) as f:
+            index = json.load(f)
+
+    # entries are only reusable if they were masked with the same masks
+    if any(
+        index['masks'].get(name, {}).get('hash') != mask_hash
+        for name, (_, mask_hash) in masks.items()
+    ):
+        index = {'masks': {}, 'subjects': {}}
+
+    index['masks'].update({
+        name: {'file': os.path.abspath(mask_file), 'hash': mask_hash}
+        for name, (mask_file, mask_hash) in masks.items()
+    })
+    names = sorted(masks)
+
+    subject_entries = []
+    for subject_file in subjects_files:
+        subject_hash = basc._file_hash(subject_file)
+        entry = subject_hash[:16]
+        entry_path = os.path.join(store_dir, entry)
+
+        if entry not in index['subjects'] or not all(
+            os.path.exists('%s.%s.npy' % (entry_path, name))
+            for name in names
+        ):
+            subject_rois = basc.load_subject_rois(
+                subject_file, [masks[name][0] for name in names]
+            )
+            for name, subject_roi in zip(names, subject_rois):
+                np.save('%s.%s.npy' % (entry_path, name), subject_roi)
+
+            index['subjects'][entry] = {
+                'file': os.path.abspath(subject_file),
+                'hash': subject_hash,
+                'n_timepoints': int(subject_rois[0].shape[1]),
+            }
+
+        subject_entries.append(os.path.abspath(entry_path))
+
+    with open(index_file, 'w') as f:
+        json.dump(index, f, indent=2, sort_keys=True)
+
+    return subject_entries
+
+
+def is_cohort_entry(subject_file):
+    """
+    Whether a subject path is an entry of a cohort store rather than a
+    nifti file.
+    """
+    import os
+
+    return (
+        isinstance(subject_file, str) and
+        not subject_file.endswith(('.nii', '.nii.gz')) and
+        os.path.exists(
+            os.path.join(os.path.dirname(subject_file), 'cohort.json')
+        )
+    )
+
+
+def load_cohort_rois(subject_entry, roi_mask_files):
+    """
+    Loads the masked time series of a subject from a cohort store, as
+    read-only memory maps.
+
+    Parameters
+    ----------
+    subject_entry : string
+        Path of the store entry of the subject
+    roi_mask_files : list of strings
+        Nifti masks of the regions to load, which must be the ROI or the
+        cross-cluster ROI the store was created with
+
+    Returns
+    -------
+    subject_rois : list of array_like
+        For each mask, the float32 time series of shape (`V`, `T`) of its
+        `V` voxels
+
+    """
+    import os
+    import json
+    import numpy as np
+    import PyBASC.basc as basc
+
+    with open(os.path.join(os.path.dirname(subject_entry),
+                           'cohort.json')) as f:
+        index = json.load(f)
+
+    mask_names = {
+        mask['hash']: name for name, mask in index['masks'].items()
+    }
+
+    subject_rois = []
+    for roi_mask_file in roi_mask_files:
+        mask_hash = basc._file_hash(roi_mask_file)
+        if mask_hash not in mask_names:
+            raise ValueError(
+                'Mask %s is not one of the masks of the cohort store of %s'
+                % (roi_mask_file, subject_entry)
+            )
+        subject_rois.append(np.load(
+            '%s.%s.npy' % (subject_entry, mask_names[mask_hash]),
+            mmap_mode='r'
+        ))
+
+    return subject_rois
+
+
+def _roi_volume(data_array, roi_mask):
+    """
+    Places the rows of `data_array` at the voxels of the boolean `roi_mask`.
+    """
+    import numpy as np
+
+    if data_array.ndim == 1:
+        out_vol = np.zeros_like(roi_mask, dtype=data_array.dtype)
+        out_vol[roi_mask] = data_array
+
+    elif data_array.ndim == 2:
+        list_roi_shape = list(roi_mask.shape[0:3])
+
+        out_vol = np.zeros(
+            list_roi_shape + [data_array.shape[1]],
+            dtype=data_array.dtype
+        )
+        out_vol[roi_mask] = data_array
+
+    else:
+        raise ValueError(
+            'data_array is %i dimensional, '
             'must be either 1 or 2 dimensional' % len(data_array.shape)
         )
 
+    return out_vol
+
+
+def ndarray_to_vol(data_array, roi_mask_file, sample_file, filename):
+    """
+    Converts a numpy array to a nifti file given an roi mask
+
+    Parameters
+    ----------
+    data_array : array_like
+        A data array with the same column length and index alignment as the
+        given roi_mask_file.  If data_array is two dimensional, first dimension
+        is considered temporal dimension
+    roi_mask_file : string
+        Region of interest that is being parcellated. Large volumes should use
+        compression_dim to reduce computational load.
+    sample_file : string or list of strings
+        Path of sample nifti file(s) to use for header of the output.
+        If list, the first file is chosen.
+    filename : string
+        Name of output file
+
+
+    Returns
+    -------
+    img_file : string
+        Path of the nifti file output
+
+    """
+
+    import os
+    import numpy as np
+    import nibabel as nb
+
+    import PyBASC.basc as basc
+
+    roi_mask = basc.load_roi_mask(roi_mask_file)
+
+    out_vol = basc._roi_volume(data_array, roi_mask)
+
     # TODO @AKI why not use header from ROI file?
     #           it should has the same affine
-    if type(sample_file) is list:
-        sample_file = sample_file[0]
-
-    nii = nb.load(sample_file)
+    header, affine = basc.load_header(sample_file)
 
     img = nb.Nifti1Image(
         out_vol,
-        header=nii.get_header(),
-        affine=nii.get_affine()
+        header=header,
+        affine=affine
     )
 
     img_file = os.path.join(os.getcwd(), filename)
@@ -711,65 +1544,113 @@ def ndarray_to_vol(data_array, roi_mask_file, sample_file, filename):
     return img_file, img
 
 
-def individual_group_clustered_maps(
-        subject_stability_list, clusters_G, roi_mask_file,
-        group_dim_reduce, compression_labels_file):
-    # TODO @AKI update doc
+def ndarray_to_vols(data_arrays, roi_mask_file, sample_file, filenames):
     """
-    Calculate the individual stability maps of each subject based on the group
-    stability clustering solution.
+    Converts the rows of a numpy array to nifti files given an roi mask,
+    reading the mask and the header once.
 
     Parameters
     ----------
-    subject_stability_list : list of strings
-        A length `N` list of file paths to numpy matrices of shape (`V`, `V`),
-        `N` subjects, `V` voxels
-    clusters_G : array_like
-        Length `V` array of cluster assignments for each voxel
+    data_arrays : array_like
+        Array of shape (`K`, `V`), one volume per row, with the same column
+        length and index alignment as the given roi_mask_file.
     roi_mask_file : string
-        Region of interest that is being parcellated. Large volumes should use
-        compression_dim to reduce computational load. 
-    group_dim_reduce : boolean
-        Whether or not dimension reduction will be performed at the group 
-        level.
-    compression_labels_file : array_like
-        an array that contain the dimension reduced label file from
-        an individual dim reduce. 
-    
-    
+        Region of interest that is being parcellated.
+    sample_file : string or list of strings
+        Path of sample nifti file(s) to use for header of the output.
+        If list, the first file is chosen.
+    filenames : string or list of strings
+        Name of a single 4D output file with the `K` volumes along the fourth
+        dimension, or length `K` list of names of 3D output files.
 
     Returns
     -------
-    individual_cluster_voxel_scores : list of strings
-        A length `N` list of nifti files of the individual group clustered
-        stability maps for each cluster.  Temporal dimension of each file
-        corresponds to each subject.
+    img_files : string or list of strings
+        Path of the 4D nifti file output, or paths of the 3D ones
 
     """
 
     import os
     import numpy as np
-    import PyBASC.utils as utils
+    import nibabel as nb
+
     import PyBASC.basc as basc
-    import scipy.sparse
 
-    supervox_ism = scipy.sparse.load_npz(subject_stability_list)
+    data_arrays = np.asarray(data_arrays)
+    roi_mask = basc.load_roi_mask(roi_mask_file)
+    header, affine = basc.load_header(sample_file)
 
-    if compression_labels_file:
-        compression_labels = np.load(compression_labels_file)
-    else:
-       compression_labels = None
+    if not isinstance(filenames, list):
+        img_file = os.path.join(os.getcwd(), filenames)
+        nb.Nifti1Image(
+            basc._roi_volume(data_arrays.T, roi_mask),
+            header=header,
+            affine=affine
+        ).to_filename(img_file)
+        return img_file
+
+    if len(filenames) != data_arrays.shape[0]:
+        raise ValueError(
+            '%i filenames given for %i volumes'
+            % (len(filenames), data_arrays.shape[0])
+        )
+
+    img_files = []
+    for data_array, filename in zip(data_arrays, filenames):
+        img_file = os.path.join(os.getcwd(), filename)
+        nb.Nifti1Image(
+            basc._roi_volume(data_array, roi_mask),
+            header=header,
+            affine=affine
+        ).to_filename(img_file)
+        img_files.append(img_file)
+
+    return img_files
+
+
+def _individual_group_clustered_map(
+        subject_stability_file, clusters_G, roi_mask_file, group_dim_reduce,
+        compression_labels_file, one_hot=None, suffix=''):
+    """
+    Calculate the individual stability maps of a single subject based on the
+    group stability clustering solution, see
+    `individual_group_clustered_maps`.
 
+    Parameters
+    ----------
+    one_hot : tuple, optional
+        The one-hot encoding of `clusters_G`, see `utils.cluster_one_hot`
+    suffix : string, optional
+        Appended to the names of the output files
+
+    Returns
+    -------
+    The individual group cluster stability file, the nifti file of the
+    individualized group clusters and their label file.
+
+    """
+
+    import os
+    import numpy as np
+    import PyBASC.utils as utils
+    import PyBASC.basc as basc
+
+    clusters_G = np.asarray(clusters_G).ravel()
+    if one_hot is None:
+        one_hot = utils.cluster_one_hot(clusters_G)
+    cluster_ids = one_hot[0]
+
+    # the packed matrix is averaged in blocks of rows, never densified
+    indiv_stability_set = \
+        utils.PackedStabilityMatrix.load(subject_stability_file)
     if group_dim_reduce:
-        indiv_stability_set = utils.expand_ism(
-            supervox_ism, compression_labels
-        ).toarray()
-    else:
-        indiv_stability_set = supervox_ism.toarray()
+        indiv_stability_set = indiv_stability_set.expand(
+            np.load(compression_labels_file)
+        )
 
-    cluster_ids = np.unique(clusters_G)
-    cluster_voxel_scores, k_mask = \
-        utils.cluster_matrix_average(indiv_stability_set, clusters_G)
+    cluster_voxel_scores, _ = utils.cluster_matrix_average(
+        indiv_stability_set, clusters_G, one_hot=one_hot
+    )
 
     ind_group_cluster_stability = np.array([
         cluster_voxel_scores[(i-1), clusters_G == i].mean()
@@ -778,10 +1659,8 @@ def individual_group_clustered_maps(
 
     cluster_voxel_scores = cluster_voxel_scores.astype("uint8")
 
-    k_mask = k_mask.astype(bool)
-
     ind_group_cluster_stability_file = os.path.join(
-        os.getcwd(), 'ind_group_cluster_stability.npy'
+        os.getcwd(), 'ind_group_cluster_stability%s.npy' % suffix
     )
     np.save(ind_group_cluster_stability_file, ind_group_cluster_stability)
 
@@ -790,7 +1669,7 @@ def individual_group_clustered_maps(
     ) + 1
 
     ind_group_cluster_labels_file = os.path.join(
-        os.getcwd(), 'ind_group_cluster_labels.npy'
+        os.getcwd(), 'ind_group_cluster_labels%s.npy' % suffix
     )
     np.save(ind_group_cluster_labels_file, individualized_group_cluster_npy)
 
@@ -798,16 +1677,136 @@ def individual_group_clustered_maps(
         individualized_group_cluster_npy,
         roi_mask_file,
         roi_mask_file,
-        os.path.join(os.getcwd(), 'individualized_group_cluster.nii.gz')
+        'individualized_group_cluster%s.nii.gz' % suffix
     )
 
-    np.save(ind_group_cluster_labels_file, individualized_group_cluster_npy)
-
     return (ind_group_cluster_stability_file,
             individualized_group_clusters_file,
             ind_group_cluster_labels_file)
 
 
+def individual_group_clustered_maps(
+        subject_stability_list, clusters_G, roi_mask_file,
+        group_dim_reduce, compression_labels_file):
+    # TODO @AKI update doc
+    """
+    Calculate the individual stability maps of each subject based on the group
+    stability clustering solution.
+
+    Parameters
+    ----------
+    subject_stability_list : list of strings
+        A length `N` list of file paths to numpy matrices of shape (`V`, `V`),
+        `N` subjects, `V` voxels
+    clusters_G : array_like
+        Length `V` array of cluster assignments for each voxel
+    roi_mask_file : string
+        Region of interest that is being parcellated. Large volumes should use
+        compression_dim to reduce computational load. 
+    group_dim_reduce : boolean
+        Whether or not dimension reduction will be performed at the group 
+        level.
+    compression_labels_file : array_like
+        an array that contain the dimension reduced label file from
+        an individual dim reduce. 
+    
+    
+
+    Returns
+    -------
+    individual_cluster_voxel_scores : list of strings
+        A length `N` list of nifti files of the individual group clustered
+        stability maps for each cluster.  Temporal dimension of each file
+        corresponds to each subject.
+
+    """
+
+    import PyBASC.basc as basc
+
+    return basc._individual_group_clustered_map(
+        subject_stability_list, clusters_G, roi_mask_file,
+        group_dim_reduce, compression_labels_file
+    )
+
+
+def batch_individual_group_clustered_maps(
+        subject_stability_list, clusters_G, roi_mask_file,
+        group_dim_reduce, compression_labels_list):
+    """
+    Calculate the individual stability maps of all subjects based on the
+    group stability clustering solution, in a single process.
+
+    Same as `individual_group_clustered_maps` for each subject, but the
+    one-hot encoding of `clusters_G` is built once for all subjects.
+
+    Parameters
+    ----------
+    subject_stability_list : list of strings
+        A length `N` list of file paths to the subject stability matrices,
+        `N` subjects
+    clusters_G : array_like
+        Length `V` array of cluster assignments for each voxel
+    roi_mask_file : string
+        Region of interest that is being parcellated.
+    group_dim_reduce : boolean
+        Whether or not dimension reduction will be performed at the group
+        level.
+    compression_labels_list : list of strings
+        A length `N` list of the dimension reduced label files of each
+        subject, or None.
+
+    Returns
+    -------
+    ind_group_cluster_stability_file : list of strings
+        A length `N` list of the individual group cluster stability files
+    individualized_group_clusters_file : list of strings
+        A length `N` list of nifti files of the individualized group clusters
+    ind_group_cluster_labels_file : list of strings
+        A length `N` list of the individualized group cluster label files
+
+    """
+
+    import PyBASC.utils as utils
+    import PyBASC.basc as basc
+
+    if not isinstance(subject_stability_list, list):
+        subject_stability_list = [subject_stability_list]
+
+    if not isinstance(compression_labels_list, list):
+        compression_labels_list = \
+            [compression_labels_list] * len(subject_stability_list)
+
+    one_hot = utils.cluster_one_hot(clusters_G)
+
+    ind_group_cluster_stability_files = []
+    individualized_group_clusters_files = []
+    ind_group_cluster_labels_files = []
+
+    for i, (subject_stability_file, compression_labels_file) in enumerate(
+        zip(subject_stability_list, compression_labels_list)
+    ):
+        (ind_group_cluster_stability_file,
+         individualized_group_clusters_file,
+         ind_group_cluster_labels_file) = \
+            basc._individual_group_clustered_map(
+                subject_stability_file, clusters_G, roi_mask_file,
+                group_dim_reduce, compression_labels_file, one_hot=one_hot,
+                suffix='_%d' % i
+            )
+
+        ind_group_cluster_stability_files.append(
+            ind_group_cluster_stability_file
+        )
+        individualized_group_clusters_files.append(
+            individualized_group_clusters_file
+        )
+        ind_group_cluster_labels_files.append(ind_group_cluster_labels_file)
+
+    return (ind_group_cluster_stability_files,
+            individualized_group_clusters_files,
+            ind_group_cluster_labels_files)
+
+
 def post_analysis(ind_group_cluster_stability_file_list):
     """
     Creates a composite matrix of all the ind_group_cluster_stability files.
@@ -909,20 +1908,20 @@ def create_group_cluster_maps(gsm_file, clusters_G_file, roi_mask_file):
     import PyBASC.utils as utils
     import scipy.sparse
 
-    group_stability_set = scipy.sparse.load_npz(gsm_file).toarray()
+    # memory-mapped when packed, averaged in blocks of rows
+    group_stability_set = utils.PackedStabilityMatrix.load(gsm_file)
     clusters_G = np.load(clusters_G_file)
     cluster_ids = np.unique(clusters_G)
 
     group_cluster_voxel_scores, _ = \
         utils.cluster_matrix_average(group_stability_set, clusters_G)
 
-    for k in cluster_ids:
-        basc.ndarray_to_vol(
-            group_cluster_voxel_scores[k - 1],
-            roi_mask_file,
-            roi_mask_file,
-            'group_level_cluster%i_stability.nii.gz' % k
-        )
+    basc.ndarray_to_vols(
+        group_cluster_voxel_scores[cluster_ids - 1],
+        roi_mask_file,
+        roi_mask_file,
+        ['group_level_cluster%i_stability.nii.gz' % k for k in cluster_ids]
+    )
 
 
 # TODO @AKI unused?
@@ -1051,11 +2050,8 @@ def gsm_nifti(roi_mask_file, n_clusters, out_dir, cluster_method='ward'):
     np.save(grp_cluster_stability_diff_file, grp_cluster_stability_diff)
 
     # Group cluster stability volumes
-    [
-        basc.ndarray_to_vol(
-            gsm_cluster_voxel_scores[k - 1],
-            roi_mask_file, roi_mask_file,
-            'gsm_single_cluster%i_stability.nii.gz' % k
-        )
-        for k in cluster_ids
-    ]
+    basc.ndarray_to_vols(
+        gsm_cluster_voxel_scores[cluster_ids - 1],
+        roi_mask_file, roi_mask_file,
+        ['gsm_single_cluster%i_stability.nii.gz' % k for k in cluster_ids]
+    )
@@ -12,7 +12,8 @@ def run_basc_workflow(
     dataset_bootstraps, timeseries_bootstraps, n_clusters, output_size,
     bootstrap_list, proc_mem, similarity_metric, group_dim_reduce=False,
     cross_cluster=False, cross_cluster_mask_file=None, blocklength=1,
-    affinity_threshold=0.0, cluster_method='ward', out_dir=None, run=True
+    affinity_threshold=0.0, cluster_method='ward', out_dir=None, run=True,
+    cache_dir=None
 ):
     
     """Run the 'template_workflow' function to execute the modular workflow
@@ -71,7 +72,8 @@ def run_basc_workflow(
         cxc_roi_mask_file=cross_cluster_mask_file,
         blocklength=blocklength,
         affinity_threshold=affinity_threshold,
-        cluster_method=cluster_method
+        cluster_method=cluster_method,
+        cache_dir=cache_dir
     )
     
     resource_pool['group_stability_matrix'] = (basc, 'outputspec.group_stability_matrix')
@@ -120,7 +122,7 @@ def run_basc_workflow_parallelized(
 
     cross_cluster=False, cross_cluster_mask_file=None, 
     out_dir=None, runs=1, proc_mem=None, random_seed=None,
-    analysis_id='basc', cache_method='content'
+    analysis_id='basc', cache_method='content', cache_dir=None
 ):
     import os
     import nipype.interfaces.io as nio
@@ -158,7 +160,9 @@ def run_basc_workflow_parallelized(
             group_dim_reduce=group_dim_reduce,
             cross_cluster=cross_cluster,
             cxc_roi_mask_file=cross_cluster_mask_file,
-            random_state_tuple=rng_run.get_state()
+            random_state_tuple=rng_run.get_state(),
+            cache_dir=cache_dir,
+            n_clusters_list=n_clusters_list
         )
 
         basc_workflow.get_node('inputspec_compression_dim').iterables = [
@@ -5,9 +5,11 @@ import nipype.interfaces.utility as util
 from PyBASC.basc import (
     group_dim_reduce,
     nifti_individual_stability,
-    map_group_stability_random_bootstrap,
+    group_stability_means,
+    cluster_group_stability,
+    select_individual_stability,
     join_group_stability,
-    individual_group_clustered_maps,
+    batch_individual_group_clustered_maps,
     post_analysis,
     ndarray_to_vol
 )
@@ -55,6 +57,9 @@ def create_basc(proc_mem, name='basc'):
         inputspec.affinity_threshold : list (floats)
             Minimum threshold for similarity matrix based on correlation to
             create an edge
+        inputspec.cache_dir : string
+            Directory where the masked subject time series are cached
+            between runs, None to disable the cache
 
     Workflow Outputs::
 
@@ -124,6 +129,8 @@ def create_basc(proc_mem, name='basc'):
         'cross_cluster',
         'cxc_roi_mask_file',
 
+        'cache_dir',
+
     ]), name='inputspec')
 
 
@@ -148,7 +155,8 @@ def create_basc(proc_mem, name='basc'):
                          'compression_dim',
                          'group_dim_reduce',
                          'cross_cluster',
-                         'cxc_roi_mask_file'],
+                         'cxc_roi_mask_file',
+                         'cache_dir'],
             output_names=['compressor',
                           'cxc_compressor',
                           'compression_labels_file'],
@@ -174,7 +182,8 @@ def create_basc(proc_mem, name='basc'):
                          'cbb_block_size',
                          'blocklength',
                          'affinity_threshold',
-                         'cluster_method'],
+                         'cluster_method',
+                         'cache_dir'],
             output_names=['ism_file', 'compression_labels_file'],
             function=nifti_individual_stability,
             as_module=True
@@ -186,21 +195,38 @@ def create_basc(proc_mem, name='basc'):
     )
     nis.inputs.cbb_block_size = None
 
-    mgsm = CustomCacheMapNode(
+    # the averages of all group bootstraps are computed in one node, so the
+    # individual stability matrices are read once instead of once per
+    # bootstrap, and each average is clustered by its own process
+    mgsm_means = CustomCacheNode(
         Function(
             input_names=['subject_stability_list',
+                         'bootstrap_list'],
+            output_names=['group_mean_files',
+                          'random_state_tuples'],
+            function=group_stability_means,
+            as_module=True
+        ),
+        name='group_stability_means',
+        mem_gb=mem_per_proc
+    )
+
+    mgsm = CustomCacheMapNode(
+        Function(
+            input_names=['group_mean_file',
                          'n_clusters',
-                         'is_bootstrapping',
                          'roi_mask_file',
                          'group_dim_reduce',
-                         'cluster_method'],
+                         'cluster_method',
+                         'random_state_tuple'],
             output_names=['G_file'],
-            function=map_group_stability_random_bootstrap,
+            function=cluster_group_stability,
             as_module=True
         ),
         name='map_group_stability',
         mem_gb=mem_per_proc,
-        iterfield='is_bootstrapping'
+        iterfield=['group_mean_file',
+                   'random_state_tuple']
     )
 
     jgsm = CustomCacheNode(
@@ -226,22 +252,21 @@ def create_basc(proc_mem, name='basc'):
         mem_gb=mem_per_proc
     )
     
-    igcm = CustomCacheMapNode(
+    igcm = CustomCacheNode(
         Function(
             input_names=['subject_stability_list',
                          'clusters_G',
                          'roi_mask_file',
                          'group_dim_reduce',
-                         'compression_labels_file'],
+                         'compression_labels_list'],
             output_names=['ind_group_cluster_stability_file',
                           'individualized_group_clusters_file',
                           'ind_group_cluster_labels_file'],
-            function=individual_group_clustered_maps,
+            function=batch_individual_group_clustered_maps,
             as_module=True
         ),
         name='individual_group_clustered_maps',
-        mem_gb=mem_per_proc,
-        iterfield=['subject_stability_list', 'compression_labels_file']
+        mem_gb=mem_per_proc
     )
 
     post = CustomCacheNode(
@@ -280,6 +305,7 @@ def create_basc(proc_mem, name='basc'):
                 ('cxc_roi_mask_file', 'cxc_roi_mask_file'),
                 ('group_dim_reduce', 'group_dim_reduce'),
                 ('cross_cluster', 'cross_cluster'),
+                ('cache_dir', 'cache_dir'),
             ]
         ),
         (
@@ -295,11 +321,16 @@ def create_basc(proc_mem, name='basc'):
                 ('blocklength', 'blocklength'),
                 ('affinity_threshold', 'affinity_threshold'),
                 ('cluster_method', 'cluster_method'),
+                ('cache_dir', 'cache_dir'),
+            ]
+        ),
+        (
+            inputspec, mgsm_means, [
+                ('bootstrap_list', 'bootstrap_list'),
             ]
         ),
         (
             inputspec, mgsm, [
-                ('bootstrap_list', 'is_bootstrapping'),
                 ('n_clusters', 'n_clusters'),
                 ('roi_mask_file', 'roi_mask_file'),
                 ('group_dim_reduce', 'group_dim_reduce'),
@@ -337,11 +368,18 @@ def create_basc(proc_mem, name='basc'):
         ),
 
         (
-            nis, mgsm, [
+            nis, mgsm_means, [
                 ('ism_file', 'subject_stability_list'),
             ]
         ),
 
+        (
+            mgsm_means, mgsm, [
+                ('group_mean_files', 'group_mean_file'),
+                ('random_state_tuples', 'random_state_tuple'),
+            ]
+        ),
+
         (
             nis, jgsm, [
                 ('ism_file', 'subject_stability_list'),
@@ -352,7 +390,7 @@ def create_basc(proc_mem, name='basc'):
         (
             nis, igcm, [
                 ('ism_file', 'subject_stability_list'),
-                ('compression_labels_file', 'compression_labels_file'),
+                ('compression_labels_file', 'compression_labels_list'),
             ]
         ),
 
@@ -450,9 +488,16 @@ def create_basc_parallelized(proc_mem, name='basc', random_state=None):
             Number of bootstraps of each subject's timeseries
         inputspec.n_clusters : integer
             Number of clusters at both the individiual and group level
+        inputspec.n_clusters_list : list (integers)
+            All the numbers of clusters iterated over, the individual
+            stability matrices of each subject are computed for all of them
+            in a single pass
         inputspec.affinity_threshold : list (floats)
             Minimum threshold for similarity matrix based on correlation to
             create an edge
+        inputspec.cache_dir : string
+            Directory where the masked subject time series are cached
+            between runs, None to disable the cache
 
     Workflow Outputs::
 
@@ -514,6 +559,8 @@ def create_basc_parallelized(proc_mem, name='basc', random_state=None):
             'cxc_roi_mask_file',
             'group_dim_reduce',
             'random_state_tuple',
+            'cache_dir',
+            'n_clusters_list',
         ]),
         name='inputspec',
         ignore_cache=ignore_cache
@@ -601,7 +648,8 @@ def create_basc_parallelized(proc_mem, name='basc', random_state=None):
                          'compression_dim',
                          'group_dim_reduce',
                          'cross_cluster',
-                         'cxc_roi_mask_file'],
+                         'cxc_roi_mask_file',
+                         'cache_dir'],
             output_names=['compressor',
                           'cxc_compressor',
                           'compression_labels_file'],
@@ -629,7 +677,8 @@ def create_basc_parallelized(proc_mem, name='basc', random_state=None):
                          'blocklength',
                          'affinity_threshold',
                          'cluster_method',
-                         'random_state_tuple'],
+                         'random_state_tuple',
+                         'cache_dir'],
             output_names=['ism_file', 'compression_labels_file'],
             function=nifti_individual_stability,
             as_module=True
@@ -641,21 +690,56 @@ def create_basc_parallelized(proc_mem, name='basc', random_state=None):
     )
     nis.inputs.cbb_block_size = None
 
-    mgsm = CustomCacheMapNode(
+    # the individual stability matrices do not depend on the iterated number
+    # of clusters, they are computed once for all of them and the ones of
+    # each number of clusters are picked from the subject outputs
+    select_ism = CustomCacheNode(
         Function(
             input_names=['subject_stability_list',
+                         'n_clusters_list',
+                         'n_clusters'],
+            output_names=['subject_stability_list'],
+            function=select_individual_stability,
+            as_module=True
+        ),
+        name='select_individual_stability',
+        mem_gb=mem_per_proc,
+        ignore_cache=ignore_cache
+    )
+
+    # the averages of all group bootstraps are computed in one node, so the
+    # individual stability matrices are read once instead of once per
+    # bootstrap, and each average is clustered by its own process
+    mgsm_means = CustomCacheNode(
+        Function(
+            input_names=['subject_stability_list',
+                         'bootstrap_list',
+                         'random_state_tuple'],
+            output_names=['group_mean_files',
+                          'random_state_tuples'],
+            function=group_stability_means,
+            as_module=True
+        ),
+        name='group_stability_means',
+        mem_gb=mem_per_proc,
+        ignore_cache=ignore_cache
+    )
+
+    mgsm = CustomCacheMapNode(
+        Function(
+            input_names=['group_mean_file',
                          'n_clusters',
-                         'is_bootstrapping',
                          'roi_mask_file',
                          'group_dim_reduce',
                          'cluster_method',
                          'random_state_tuple'],
             output_names=['G_file'],
-            function=map_group_stability_random_bootstrap,
+            function=cluster_group_stability,
             as_module=True
         ),
         name='map_group_stability',
-        iterfield='is_bootstrapping',
+        iterfield=['group_mean_file',
+                   'random_state_tuple'],
         mem_gb=mem_per_proc,
         ignore_cache=ignore_cache
     )
@@ -685,25 +769,20 @@ def create_basc_parallelized(proc_mem, name='basc', random_state=None):
         ignore_cache=ignore_cache
     )
     
-    igcm = CustomCacheMapNode(
+    igcm = CustomCacheNode(
         Function(
             input_names=['subject_stability_list',
                          'clusters_G',
                          'roi_mask_file',
                          'group_dim_reduce',
-                         'compression_labels_file',
-                         'random_state_tuple'],
+                         'compression_labels_list'],
             output_names=['ind_group_cluster_stability_file',
                           'individualized_group_clusters_file',
                           'ind_group_cluster_labels_file'],
-            function=individual_group_clustered_maps,
+            function=batch_individual_group_clustered_maps,
             as_module=True
         ),
         name='individual_group_clustered_maps',
-        iterfield=[
-            'subject_stability_list',
-            'compression_labels_file'
-        ],
         mem_gb=mem_per_proc,
         ignore_cache=ignore_cache
     )
@@ -745,6 +824,7 @@ def create_basc_parallelized(proc_mem, name='basc', random_state=None):
                 ('cxc_roi_mask_file', 'cxc_roi_mask_file'),
                 ('cross_cluster', 'cross_cluster'),
                 ('group_dim_reduce', 'group_dim_reduce'),
+                ('cache_dir', 'cache_dir'),
             ]
         ),
         (
@@ -762,6 +842,8 @@ def create_basc_parallelized(proc_mem, name='basc', random_state=None):
                 ('cross_cluster', 'cross_cluster'),
                 ('cxc_roi_mask_file', 'cxc_roi_mask_file'),
                 ('random_state_tuple', 'random_state_tuple'),
+                ('cache_dir', 'cache_dir'),
+                ('n_clusters_list', 'n_clusters'),
             ]
         ),
         (
@@ -789,11 +871,6 @@ def create_basc_parallelized(proc_mem, name='basc', random_state=None):
                 ('similarity_metric', 'similarity_metric'),
             ]
         ),
-        (
-            inputspec_n_clusters, nis, [
-                ('n_clusters', 'n_clusters'),
-            ]
-        ),
         (
             inputspec_affinity_threshold, nis, [
                 ('affinity_threshold', 'affinity_threshold'),
@@ -809,15 +886,42 @@ def create_basc_parallelized(proc_mem, name='basc', random_state=None):
 
 
         (
-            inputspec, mgsm, [
-                ('roi_mask_file', 'roi_mask_file'),
-                ('group_dim_reduce', 'group_dim_reduce'),
+            inputspec, select_ism, [
+                ('n_clusters_list', 'n_clusters_list'),
+            ]
+        ),
+        (
+            inputspec_n_clusters, select_ism, [
+                ('n_clusters', 'n_clusters'),
+            ]
+        ),
+        (
+            nis, select_ism, [
+                ('ism_file', 'subject_stability_list'),
+            ]
+        ),
+
+
+
+        (
+            inputspec, mgsm_means, [
                 ('random_state_tuple', 'random_state_tuple'),
             ]
         ),
         (
-            inputspec_boostraps, mgsm, [
-                (('dataset_bootstraps', _generate_list), 'is_bootstrapping'),
+            inputspec_boostraps, mgsm_means, [
+                (('dataset_bootstraps', _generate_list), 'bootstrap_list'),
+            ]
+        ),
+        (
+            select_ism, mgsm_means, [
+                ('subject_stability_list', 'subject_stability_list'),
+            ]
+        ),
+        (
+            inputspec, mgsm, [
+                ('roi_mask_file', 'roi_mask_file'),
+                ('group_dim_reduce', 'group_dim_reduce'),
             ]
         ),
         (
@@ -831,8 +935,9 @@ def create_basc_parallelized(proc_mem, name='basc', random_state=None):
             ]
         ),
         (
-            nis, mgsm, [
-                ('ism_file', 'subject_stability_list'),
+            mgsm_means, mgsm, [
+                ('group_mean_files', 'group_mean_file'),
+                ('random_state_tuples', 'random_state_tuple'),
             ]
         ),
 
@@ -860,9 +965,13 @@ def create_basc_parallelized(proc_mem, name='basc', random_state=None):
                 ('cluster_method', 'cluster_method'),
             ]
         ),
+        (
+            select_ism, jgsm, [
+                ('subject_stability_list', 'subject_stability_list'),
+            ]
+        ),
         (
             nis, jgsm, [
-                ('ism_file', 'subject_stability_list'),
                 ('compression_labels_file', 'compression_labels_list'),
             ]
         ),
@@ -880,10 +989,14 @@ def create_basc_parallelized(proc_mem, name='basc', random_state=None):
                 ('group_dim_reduce', 'group_dim_reduce'),
             ]
         ),
+        (
+            select_ism, igcm, [
+                ('subject_stability_list', 'subject_stability_list'),
+            ]
+        ),
         (
             nis, igcm, [
-                ('ism_file', 'subject_stability_list'),
-                ('compression_labels_file', 'compression_labels_file'),
+                ('compression_labels_file', 'compression_labels_list'),
             ]
         ),
         (
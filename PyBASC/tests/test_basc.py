@@ -18,6 +18,61 @@ import nibabel as nb
 # from sklearn.preprocessing import StandardScaler
 
 
+def _random_stability_matrix(random_state, n_features, dtype='uint8'):
+    """
+    Random symmetric stability matrix, with values between 0 and 100
+    """
+    S = random_state.randint(0, 101, size=(n_features, n_features))
+    return ((S + S.T) // 2).astype(dtype)
+
+
+def _save_roi_mask(tmpdir, roi_mask=None, filename='roi_mask.nii.gz'):
+    """
+    Save a ROI mask as a nifti file, by default 16 voxels of a (4, 4, 3)
+    volume. Returns the file and the mask.
+    """
+    if roi_mask is None:
+        roi_mask = np.zeros((4, 4, 3), dtype='int16')
+        roi_mask[1:3, :, 1:] = 1
+
+    roi_mask_file = str(tmpdir.join(filename))
+    nb.Nifti1Image(roi_mask, np.eye(4)).to_filename(roi_mask_file)
+
+    return roi_mask_file, roi_mask
+
+
+def _record_renames(monkeypatch):
+    """
+    Record the (source, destination) pairs of the calls to os.rename, which
+    still rename the files
+    """
+    renames = []
+    rename = os.rename
+    monkeypatch.setattr(
+        os, 'rename', lambda src, dst: renames.append((src, dst)) or
+        rename(src, dst)
+    )
+
+    return renames
+
+
+def _knn_reference(Y, n_neighbors, affinity_threshold=0.0):
+    """
+    Dense reference for the kNN graph: each row keeps its most similar
+    columns, then the graph is symmetrized
+    """
+    from PyBASC.utils import correlation_similarity
+
+    n_features = Y.shape[1]
+    dense = correlation_similarity(Y, affinity_threshold, dtype='float32')
+    np.fill_diagonal(dense, -np.inf)
+    desired = np.zeros((n_features, n_features), dtype='float32')
+    for i, row in enumerate(dense):
+        neighbors = np.argsort(row)[-n_neighbors:]
+        desired[i, neighbors] = row[neighbors]
+    return 0.5 * (desired + desired.T)
+
+
 def test_timeseries_bootstrap():
     """
     Tests the timeseries_bootstrap method of BASC workflow
@@ -46,7 +101,32 @@ def test_timeseries_bootstrap():
 
     np.testing.assert_equal(actual, desired)
 
- 
+
+def test_timeseries_bootstrap_indices():
+    """
+    Tests that the batched timeseries bootstrap draws the same samples as
+    successive timeseries_bootstrap calls
+    """
+
+    from PyBASC.utils import timeseries_bootstrap, timeseries_bootstrap_indices
+
+    x = np.arange(50).reshape((5, 10)).T
+
+    random_state = np.random.RandomState(seed=27)
+    desired = np.array([
+        timeseries_bootstrap(x, 3, random_state=random_state)[1]
+        for _ in range(20)
+    ])
+
+    random_state = np.random.RandomState(seed=27)
+    actual = timeseries_bootstrap_indices(
+        10, 3, n_bootstraps=20, random_state=random_state
+    )
+
+    assert actual.dtype == np.int32
+    np.testing.assert_equal(actual, desired)
+
+
 def test_standard_bootstrap():
     """
     Tests the standard_bootstrap method of BASC workflow
@@ -76,6 +156,1083 @@ def test_standard_bootstrap():
     np.testing.assert_equal(actual, desired)
 
 
+def test_correlation_similarity():
+    """
+    Tests the correlation fast path against the pdist based similarity
+    """
+
+    import scipy.spatial.distance
+    from sklearn.preprocessing import normalize
+    from PyBASC.utils import correlation_similarity, similarity_matrix
+
+    random_state = np.random.RandomState(seed=27)
+    x = random_state.randn(40, 30)
+    x[:, 5] = 1.0
+
+    for affinity_threshold in (0.0, 0.4):
+        dist = scipy.spatial.distance.pdist(x.T, metric='correlation')
+        max_dist = np.nanmax(dist)
+        dist = scipy.spatial.distance.squareform(dist)
+        dist[np.isnan(dist)] = max_dist
+        desired = 1 - normalize(dist, norm='max')
+        desired[desired < affinity_threshold] = 0
+
+        out = np.empty((30, 30), dtype='float32')
+        actual = correlation_similarity(x, affinity_threshold, out=out)
+
+        assert actual is out
+        np.testing.assert_allclose(actual, desired, atol=1e-5)
+
+        # the float64 fast path agrees within floating-point tolerance, the
+        # default path is pdist itself
+        np.testing.assert_allclose(
+            correlation_similarity(x, affinity_threshold, dtype='float64'),
+            desired, atol=1e-12
+        )
+        np.testing.assert_allclose(
+            similarity_matrix(x, 'correlation', affinity_threshold), desired,
+            rtol=0, atol=1e-15
+        )
+
+
+def test_similarity_workspace():
+    """
+    Tests that the similarity matrices of successive bootstraps are computed
+    in the same workspace buffers
+    """
+
+    from PyBASC.utils import SimilarityWorkspace, similarity_matrix
+
+    workspace = SimilarityWorkspace()
+    a = workspace.buffer('similarity', (10, 10), 'float32')
+    assert a is workspace.buffer('similarity', (10, 10), 'float32')
+    assert a is not workspace.buffer('similarity', (12, 12), 'float32')
+    assert workspace.buffer('similarity', (12, 12), 'float64').dtype == \
+        np.float64
+
+    random_state = np.random.RandomState(seed=27)
+    for similarity_metric, dtype in (('correlation', 'float32'),
+                                     ('correlation', None),
+                                     ('euclidean', None)):
+        workspace = SimilarityWorkspace()
+        previous = None
+        for _ in range(3):
+            x = random_state.randn(40, 30)
+            actual = similarity_matrix(
+                x, similarity_metric, 0.0, workspace=workspace, dtype=dtype
+            )
+            if previous is not None:
+                assert actual is previous
+            previous = actual
+
+            np.testing.assert_allclose(
+                actual, similarity_matrix(x, similarity_metric, 0.0),
+                atol=1e-5
+            )
+
+        workspace.clear()
+        assert similarity_matrix(
+            x, similarity_metric, 0.0, workspace=workspace, dtype=dtype
+        ) is not previous
+
+
+def test_coassignment_accumulator():
+    """
+    Tests the co-assignment counts against summed adjacency matrices
+    """
+
+    from PyBASC.utils import adjacency_matrix, CoassignmentAccumulator
+
+    random_state = np.random.RandomState(seed=27)
+    n_bootstraps = 7
+
+    acc = CoassignmentAccumulator(25, n_bootstraps)
+    S = np.zeros((25, 25))
+    for _ in range(n_bootstraps):
+        labels = random_state.randint(0, 4, size=25)
+        acc.add(labels)
+        S += adjacency_matrix(labels[:, np.newaxis])
+
+    desired = (S * 100 // n_bootstraps).astype('uint8')
+
+    assert acc.counts.dtype == np.uint8
+    np.testing.assert_equal(acc.stability(block_size=6), desired)
+
+
+def test_stability_matrix_from_labels():
+    """
+    Tests the deferred stability matrix against the accumulated one
+    """
+
+    from PyBASC.utils import individual_stability_matrix
+
+    random_state = np.random.RandomState(seed=27)
+    Y = random_state.randn(50, 20)
+
+    S, labels = individual_stability_matrix(
+        Y, None, 6, 3, 'correlation', cluster_method='ward',
+        random_state=np.random.RandomState(seed=1), return_labels=True
+    )
+    S_deferred = individual_stability_matrix(
+        Y, None, 6, 3, 'correlation', cluster_method='ward',
+        random_state=np.random.RandomState(seed=1), deferred=True
+    )
+
+    assert labels.shape == (6, 20)
+    np.testing.assert_equal(S_deferred, S)
+
+
+def test_parallel_individual_stability_matrix():
+    """
+    Tests that the parallel bootstraps do not depend on the number of jobs,
+    as long as there is more than one
+    """
+
+    from PyBASC.utils import individual_stability_matrix
+
+    random_state = np.random.RandomState(seed=27)
+    Y = random_state.randn(50, 20)
+
+    desired = individual_stability_matrix(
+        Y, None, 6, 3, 'correlation', cluster_method='kmeans',
+        random_state=np.random.RandomState(seed=1), n_jobs=2
+    )
+    for n_jobs in (3, -1):
+        actual = individual_stability_matrix(
+            Y, None, 6, 3, 'correlation', cluster_method='kmeans',
+            random_state=np.random.RandomState(seed=1), n_jobs=n_jobs
+        )
+        np.testing.assert_equal(actual, desired)
+
+
+def test_individual_stability_matrix_multiple_k():
+    """
+    Tests that one pass over the bootstraps gives the stability matrices of
+    each number of clusters
+    """
+
+    from PyBASC.utils import individual_stability_matrix
+
+    random_state = np.random.RandomState(seed=27)
+    Y = random_state.randn(50, 20)
+
+    for n_jobs in (1, 2):
+        S, labels = individual_stability_matrix(
+            Y, None, 6, [2, 3, 5], 'correlation', cluster_method='ward',
+            random_state=np.random.RandomState(seed=1), return_labels=True,
+            n_jobs=n_jobs
+        )
+        assert labels.shape == (6, 3, 20)
+
+        for k, n_clusters in enumerate([2, 3, 5]):
+            desired = individual_stability_matrix(
+                Y, None, 6, n_clusters, 'correlation',
+                cluster_method='ward',
+                random_state=np.random.RandomState(seed=1), n_jobs=n_jobs
+            )
+            np.testing.assert_equal(S[k], desired)
+
+
+def test_select_individual_stability():
+    """
+    Tests the selection of the stability matrices of one number of clusters
+    """
+
+    import pytest
+    from PyBASC.basc import select_individual_stability
+
+    subject_stability_list = [
+        ['ism_%d_k%d.npz' % (i, k) for k in (2, 3, 5)] for i in range(3)
+    ]
+
+    assert select_individual_stability(
+        subject_stability_list, [2, 3, 5], 3
+    ) == ['ism_0_k3.npz', 'ism_1_k3.npz', 'ism_2_k3.npz']
+
+    with pytest.raises(ValueError):
+        select_individual_stability(subject_stability_list, [2, 3, 5], 4)
+
+
+def test_warm_start_kmeans():
+    """
+    Tests that k-means methods keep their centroids between bootstraps
+    """
+
+    from PyBASC.utils import (
+        WarmStart,
+        cluster_similarity,
+        individual_stability_matrix,
+        similarity_matrix,
+    )
+
+    random_state = np.random.RandomState(seed=27)
+    Y = random_state.randn(50, 20)
+    sim_matrix = similarity_matrix(Y, 'correlation', 0.0)
+
+    for cluster_method in ('kmeans', 'minibatch_kmeans'):
+        warm_start = WarmStart()
+        labels = cluster_similarity(
+            sim_matrix, None, [2, 3], cluster_method=cluster_method,
+            random_state=np.random.RandomState(seed=1), warm_start=warm_start
+        )
+        assert warm_start.centroids(2).shape == (2, 20)
+        assert warm_start.centroids(3).shape == (3, 20)
+
+        # started from its own centroids, k-means stays where it was
+        warm_labels = cluster_similarity(
+            sim_matrix, None, [2, 3], cluster_method=cluster_method,
+            random_state=np.random.RandomState(seed=2), warm_start=warm_start
+        )
+        if cluster_method == 'kmeans':
+            np.testing.assert_equal(warm_labels, labels)
+
+        S = individual_stability_matrix(
+            Y, None, 6, 3, 'correlation', cluster_method=cluster_method,
+            random_state=np.random.RandomState(seed=1), warm_start=True
+        )
+        assert S.shape == (20, 20)
+        assert (S.diagonal() == 100).all()
+
+
+def test_similarity_embedding():
+    """
+    Tests clustering on low-rank embeddings of the similarity matrix
+    """
+
+    from PyBASC.utils import (
+        cluster_similarity,
+        similarity_embedding,
+        similarity_matrix,
+    )
+
+    random_state = np.random.RandomState(seed=27)
+    Y = random_state.randn(50, 30)
+    sim_matrix = similarity_matrix(Y, 'correlation', 0.0)
+
+    for method in ('svd', 'spectral'):
+        embedding = similarity_embedding(
+            sim_matrix, 5, method=method,
+            random_state=np.random.RandomState(seed=1)
+        )
+        assert embedding.shape == (30, 5)
+
+        for cluster_method in ('ward', 'kmeans', 'gaussianmixture'):
+            y_pred = cluster_similarity(
+                sim_matrix, None, [2, 4], cluster_method=cluster_method,
+                random_state=np.random.RandomState(seed=1),
+                embedding=method, n_components=5
+            )
+            assert y_pred.shape == (2, 30)
+            assert len(np.unique(y_pred[1])) == 4
+
+    # ward clusters the columns of the similarity matrix and the other
+    # methods its rows, which are their own full embeddings
+    for cluster_method, embedding in (('ward', sim_matrix.T),
+                                      ('kmeans', sim_matrix)):
+        np.testing.assert_equal(
+            cluster_similarity(
+                sim_matrix, None, 3, cluster_method=cluster_method,
+                random_state=np.random.RandomState(seed=1),
+                embedding=embedding
+            ),
+            cluster_similarity(
+                sim_matrix, None, 3, cluster_method=cluster_method,
+                random_state=np.random.RandomState(seed=1)
+            )
+        )
+
+
+def test_knn_correlation_similarity():
+    """
+    Tests the structure of the sparse k-nearest-neighbour correlation graph
+    against a dense top-k reference
+    """
+
+    import scipy.sparse
+    from PyBASC.utils import knn_correlation_similarity
+
+    random_state = np.random.RandomState(seed=27)
+    Y = random_state.randn(50, 30)
+
+    sim_graph = knn_correlation_similarity(Y, n_neighbors=5, block_size=7)
+    assert scipy.sparse.isspmatrix_csr(sim_graph)
+    assert sim_graph.shape == (30, 30)
+    assert (sim_graph != sim_graph.T).nnz == 0
+    assert sim_graph.diagonal().sum() == 0
+    assert (sim_graph.getnnz(axis=1) >= 5).all()
+
+    np.testing.assert_allclose(
+        sim_graph.toarray(), _knn_reference(Y, 5), atol=1e-5
+    )
+
+
+def test_knn_correlation_similarity_threshold():
+    """
+    Tests that neighbours below the affinity threshold are left out of the
+    kNN graph
+    """
+
+    from PyBASC.utils import knn_correlation_similarity
+
+    random_state = np.random.RandomState(seed=27)
+    Y = random_state.randn(50, 30)
+
+    sim_graph = knn_correlation_similarity(Y, n_neighbors=5, block_size=7)
+    thresholded = knn_correlation_similarity(
+        Y, n_neighbors=5, affinity_threshold=0.4, block_size=7
+    )
+    assert 0 < thresholded.nnz < sim_graph.nnz
+
+    np.testing.assert_allclose(
+        thresholded.toarray(), _knn_reference(Y, 5, 0.4), atol=1e-5
+    )
+
+
+def test_knn_correlation_similarity_workspace():
+    """
+    Tests that the blocks of the kNN graph share one workspace buffer
+    """
+
+    from PyBASC.utils import SimilarityWorkspace, knn_correlation_similarity
+
+    random_state = np.random.RandomState(seed=27)
+    Y = random_state.randn(50, 30)
+
+    sim_graph = knn_correlation_similarity(Y, n_neighbors=5, block_size=7)
+
+    # the last, shorter block reuses the buffer of the others
+    workspace = SimilarityWorkspace()
+    knn_block = None
+    for _ in range(2):
+        actual = knn_correlation_similarity(
+            Y, n_neighbors=5, block_size=7, workspace=workspace
+        )
+        assert (actual != sim_graph).nnz == 0
+        if knn_block is not None:
+            assert workspace.buffer('knn_block', (7, 30), 'float32') is \
+                knn_block
+        knn_block = workspace.buffer('knn_block', (7, 30), 'float32')
+
+
+def test_knn_n_neighbors(monkeypatch):
+    """
+    Tests that the number of neighbours reaches the kNN graph from the
+    entry points
+    """
+
+    import PyBASC.utils as utils
+    from PyBASC.utils import (
+        bootstrap_stability_counts,
+        cluster_similarity,
+        cluster_timeseries,
+        individual_stability_matrix,
+        knn_correlation_similarity,
+    )
+
+    random_state = np.random.RandomState(seed=27)
+    Y = random_state.randn(50, 30)
+
+    sim_graph = knn_correlation_similarity(Y, n_neighbors=2)
+    y_pred = cluster_timeseries(
+        Y, None, 3, 'k_neighbors', 0.0, cluster_method='spectral',
+        random_state=np.random.RandomState(seed=1), n_neighbors=2
+    )
+    np.testing.assert_equal(
+        y_pred,
+        cluster_similarity(
+            sim_graph, None, 3, cluster_method='spectral',
+            random_state=np.random.RandomState(seed=1)
+        )
+    )
+
+    n_neighbors = []
+    knn = utils.knn_correlation_similarity
+    monkeypatch.setattr(
+        utils, 'knn_correlation_similarity',
+        lambda X, **kwargs: n_neighbors.append(kwargs['n_neighbors']) or
+        knn(X, **kwargs)
+    )
+    individual_stability_matrix(
+        Y, None, 2, 3, 'k_neighbors', cluster_method='spectral',
+        random_state=np.random.RandomState(seed=1), n_neighbors=4
+    )
+    bootstrap_stability_counts(
+        Y, [1, 2], 3, 'k_neighbors', cbb_block_size=7,
+        cluster_method='spectral', n_neighbors=6
+    )
+    assert n_neighbors == [4, 4, 6, 6]
+
+
+def test_knn_eigen_solver():
+    """
+    Tests the eigen solvers of spectral clustering on the kNN graph
+    """
+
+    import pytest
+    from PyBASC.utils import cluster_timeseries
+
+    random_state = np.random.RandomState(seed=27)
+    Y = random_state.randn(50, 30)
+
+    for eigen_solver in ('arpack', 'lobpcg'):
+        y_pred = cluster_timeseries(
+            Y, None, 3, 'k_neighbors', 0.0, cluster_method='spectral',
+            random_state=np.random.RandomState(seed=1),
+            eigen_solver=eigen_solver
+        )
+        assert y_pred.shape == (30,)
+
+    with pytest.raises(ValueError):
+        cluster_timeseries(
+            Y, None, 3, 'k_neighbors', 0.0, cluster_method='spectral',
+            eigen_solver='power'
+        )
+
+    try:
+        import pyamg
+    except ImportError:
+        with pytest.raises(ImportError):
+            cluster_timeseries(
+                Y, None, 3, 'k_neighbors', 0.0, cluster_method='spectral',
+                eigen_solver='amg'
+            )
+
+
+def test_knn_ward_clustering():
+    """
+    Tests ward clustering with the kNN graph as connectivity
+    """
+
+    from PyBASC.utils import cluster_timeseries
+
+    random_state = np.random.RandomState(seed=27)
+    Y = random_state.randn(50, 30)
+
+    y_pred = cluster_timeseries(
+        Y, None, 3, 'k_neighbors', 0.0, cluster_method='ward'
+    )
+    assert y_pred.shape == (30,)
+    assert len(np.unique(y_pred)) == 3
+
+
+def test_sum_stability_matrices(tmpdir):
+    """
+    Tests the streamed weighted sum against the stacked bootstrap mean
+    """
+
+    import scipy.sparse
+    from PyBASC.utils import standard_bootstrap, standard_bootstrap_counts
+    from PyBASC.utils import sum_stability_matrices
+
+    random_state = np.random.RandomState(seed=27)
+    stack = random_state.randint(0, 101, size=(6, 15, 15)).astype('int8')
+
+    files = []
+    for i, S in enumerate(stack):
+        files.append(str(tmpdir.join('ism_%d.npz' % i)))
+        scipy.sparse.save_npz(files[-1], scipy.sparse.csr_matrix(S))
+
+    desired = standard_bootstrap(
+        stack, random_state=np.random.RandomState(seed=1)
+    ).mean(axis=0).astype('uint8')
+
+    weights = standard_bootstrap_counts(
+        6, random_state=np.random.RandomState(seed=1)
+    )
+    actual = sum_stability_matrices(files, weights) // 6
+
+    np.testing.assert_equal(actual, desired)
+
+
+def test_map_group_stability_bootstraps(tmpdir):
+    """
+    Tests the batched group bootstraps against one bootstrap at a time
+    """
+
+    import pytest
+    from PyBASC.basc import (
+        group_stability_means,
+        join_group_stability,
+        map_group_stability_bootstraps,
+        map_group_stability_random_bootstrap,
+    )
+    from PyBASC.utils import load_stability_matrix, save_stability_matrix
+
+    random_state = np.random.RandomState(seed=27)
+    files = []
+    for i in range(5):
+        S = _random_stability_matrix(random_state, 20, 'int8')
+        # packed matrices are memory-mapped, the others staged
+        stability_format = ('npz', 'npy')[i % 2]
+        files.append(str(tmpdir.join('ism_%d.%s' % (i, stability_format))))
+        save_stability_matrix(files[-1], S)
+
+    random_state_tuple = np.random.RandomState(seed=1).get_state()
+    bootstrap_list = [0, 1, 2]
+
+    for n_jobs in (1, 2):
+        with tmpdir.mkdir('mgsm_bootstraps_%d' % n_jobs).as_cwd():
+            actual = map_group_stability_bootstraps(
+                files, 3, bootstrap_list, None, True,
+                random_state_tuple=random_state_tuple, n_jobs=n_jobs
+            )
+            assert sorted(os.listdir('.')) == sorted(
+                os.path.basename(G_file) for G_file in actual
+            )
+
+        for i, b in enumerate(bootstrap_list):
+            with tmpdir.join('mgsm_%d' % i).ensure(dir=True).as_cwd():
+                desired = map_group_stability_random_bootstrap(
+                    files, 3, b, None, True,
+                    random_state_tuple=random_state_tuple
+                )
+            np.testing.assert_equal(
+                load_stability_matrix(actual[i]),
+                load_stability_matrix(desired)
+            )
+
+    # only the packed files, nothing is staged
+    with tmpdir.mkdir('means').as_cwd():
+        group_mean_files, _ = group_stability_means(
+            files[1::2], [False], random_state_tuple=random_state_tuple
+        )
+        assert os.listdir('.') == ['group_stability_mean_0.npy']
+    np.testing.assert_equal(
+        load_stability_matrix(group_mean_files[0], packed=True),
+        (load_stability_matrix(files[1], packed=True).astype(int) +
+         load_stability_matrix(files[3], packed=True)) // 2
+    )
+
+    # the group stages cluster one number of clusters at a time
+    with pytest.raises(ValueError):
+        map_group_stability_bootstraps(
+            files, [2, 3], bootstrap_list, None, True,
+            random_state_tuple=random_state_tuple
+        )
+    with pytest.raises(ValueError):
+        map_group_stability_random_bootstrap(
+            files, [2, 3], 0, None, True,
+            random_state_tuple=random_state_tuple
+        )
+    with pytest.raises(ValueError):
+        join_group_stability(
+            files, files, 5, [2, 3], None, True, [None] * len(files)
+        )
+
+
+def test_save_stability_matrix(tmpdir):
+    """
+    Tests the packed and sparse stability matrix files
+    """
+
+    from PyBASC.utils import load_stability_matrix, save_stability_matrix
+
+    random_state = np.random.RandomState(seed=27)
+    S = _random_stability_matrix(random_state, 30)
+
+    for ext in ('npy', 'npz'):
+        stability_file = str(tmpdir.join('ism.%s' % ext))
+        save_stability_matrix(stability_file, S)
+        np.testing.assert_equal(load_stability_matrix(stability_file), S)
+
+    packed = load_stability_matrix(str(tmpdir.join('ism.npy')), packed=True)
+    assert isinstance(packed, np.memmap)
+    assert packed.shape == (30 * 31 // 2,)
+
+
+def test_packed_stability_matrix():
+    """
+    Tests the packed stability matrix operations against dense ones
+    """
+
+    from PyBASC.utils import PackedStabilityMatrix, adjacency_matrix
+
+    random_state = np.random.RandomState(seed=27)
+    S = _random_stability_matrix(random_state, 12)
+
+    packed = PackedStabilityMatrix.from_dense(S)
+    np.testing.assert_equal(packed.toarray(), S)
+    np.testing.assert_equal(packed.rows(3, 8), S[3:8])
+    np.testing.assert_equal(packed.upper_rows(3, 8), np.triu(S[3:8, 3:]))
+
+    labels = random_state.randint(0, 12, size=30)
+    np.testing.assert_equal(
+        packed.expand(labels).toarray(), S[labels][:, labels]
+    )
+
+    labels = random_state.randint(0, 3, size=12)
+    adjacency = PackedStabilityMatrix.from_labels(labels)
+    np.testing.assert_equal(
+        adjacency.toarray(), adjacency_matrix(labels).toarray()
+    )
+
+    total = PackedStabilityMatrix.zeros(12)
+    total.add(packed).add(packed, weight=2)
+    np.testing.assert_equal(
+        total.scaled(1, 2).toarray(), S.astype(int) * 3 // 2
+    )
+
+
+def test_expand_ism():
+    """
+    Tests the label gather expansion against the indicator matrix product
+    """
+
+    import scipy.sparse
+    from PyBASC.utils import expand_ism, expand_ism_blocks
+
+    random_state = np.random.RandomState(seed=27)
+    ism = _random_stability_matrix(random_state, 8, 'int8')
+    labels = random_state.randint(0, 8, size=40)
+
+    transform_mat = np.zeros((8, 40))
+    transform_mat[labels, np.arange(40)] = 1
+    desired = np.dot(
+        np.dot(ism.astype(float), transform_mat).T, transform_mat
+    )
+
+    actual = expand_ism(scipy.sparse.csr_matrix(ism), labels)
+    np.testing.assert_equal(actual.toarray(), desired)
+
+    for start, stop, block in expand_ism_blocks(ism, labels, block_size=15):
+        np.testing.assert_equal(block, desired[start:stop])
+
+
+def test_compare_stability_matrices_labels():
+    """
+    Tests the supervoxel comparison against the expanded matrices
+    """
+
+    from PyBASC.utils import compare_stability_matrices, expand_ism
+
+    random_state = np.random.RandomState(seed=27)
+    ism_a = _random_stability_matrix(random_state, 10)
+    ism_b = _random_stability_matrix(random_state, 10)
+    ism_a[3] = ism_a[:, 3] = 0
+
+    labels = random_state.randint(0, 9, size=200)
+
+    desired = compare_stability_matrices(
+        expand_ism(ism_a, labels, dense=True),
+        expand_ism(ism_b, labels, dense=True)
+    )
+    actual = compare_stability_matrices(ism_a, ism_b, labels=labels)
+
+    np.testing.assert_allclose(actual, desired, rtol=1e-10)
+
+
+def test_compare_stability_matrices(tmpdir):
+    """
+    Tests the blocked comparison against the dense row-normalized one
+    """
+
+    from scipy.spatial.distance import correlation
+    from sklearn.preprocessing import normalize
+    from PyBASC.utils import (
+        PackedStabilityMatrix,
+        compare_stability_matrices,
+        save_stability_matrix,
+    )
+
+    random_state = np.random.RandomState(seed=27)
+    ism_a = _random_stability_matrix(random_state, 50)
+    ism_b = _random_stability_matrix(random_state, 50)
+    ism_a[7] = ism_a[:, 7] = 0
+
+    desired = 1 - correlation(
+        normalize(ism_a, norm='l2').ravel(),
+        normalize(ism_b, norm='l2').ravel()
+    )
+
+    memmap_file = str(tmpdir.join('ism_b.npy'))
+    np.save(memmap_file, ism_b)
+    packed_file = str(tmpdir.join('ism_a.npy'))
+    save_stability_matrix(packed_file, ism_a)
+
+    for block_size in (None, 1, 16):
+        actual = compare_stability_matrices(
+            ism_a, ism_b, block_size=block_size
+        )
+        np.testing.assert_allclose(actual, desired, rtol=1e-10)
+
+    # packed matrices are read as blocks of their upper triangle
+    for block_size in (None, 1, 16):
+        actual = compare_stability_matrices(
+            PackedStabilityMatrix.load(packed_file),
+            np.load(memmap_file, mmap_mode='r'),
+            block_size=block_size
+        )
+        np.testing.assert_allclose(actual, desired, rtol=1e-10)
+
+        actual = compare_stability_matrices(
+            PackedStabilityMatrix.from_dense(ism_b),
+            PackedStabilityMatrix.load(packed_file),
+            block_size=block_size
+        )
+        np.testing.assert_allclose(actual, desired, rtol=1e-10)
+
+
+def test_cluster_matrix_average():
+    """
+    Tests the one-hot cluster averages against per-cluster boolean masks
+    """
+
+    from PyBASC.utils import PackedStabilityMatrix, cluster_matrix_average
+
+    random_state = np.random.RandomState(seed=31)
+    ism = _random_stability_matrix(random_state, 40)
+    assignments = random_state.randint(0, 5, size=40)
+    assignments[-1] = 7
+
+    cluster_ids = np.unique(assignments)
+    desired = np.zeros((len(cluster_ids), 40))
+    for i, cluster_id in enumerate(cluster_ids):
+        in_cluster = assignments == cluster_id
+        desired[i] = ism[:, in_cluster].mean(axis=1)
+
+        mask = np.outer(in_cluster, in_cluster)
+        np.fill_diagonal(mask, False)
+        if mask.any():
+            desired[i, in_cluster] = ism[mask].mean()
+        else:
+            desired[i, in_cluster] = 0
+
+    for M, block_size in ((ism, None), (ism, 7),
+                          (PackedStabilityMatrix.from_dense(ism), 3)):
+        actual, K_mask = cluster_matrix_average(
+            M, assignments, block_size=block_size
+        )
+        np.testing.assert_equal(actual, desired)
+
+    K_mask = K_mask.toarray(dtype=bool)
+    assert not K_mask.diagonal().any()
+    assert (K_mask == (
+        (assignments[:, None] == assignments[None, :]) & ~np.eye(40, dtype=bool)
+    )).all()
+
+
+def test_cluster_matrix_average_within_cluster():
+    """
+    Tests that every voxel of a cluster gets the within-cluster mean of its
+    own cluster, not only voxels 0 and 1, and that single voxel clusters
+    leave the other clusters untouched
+    """
+
+    from PyBASC.utils import cluster_matrix_average
+
+    M = np.array([
+        [0, 4, 2, 1, 1],
+        [4, 0, 6, 1, 1],
+        [2, 6, 0, 1, 1],
+        [1, 1, 1, 0, 9],
+        [1, 1, 1, 9, 0],
+    ])
+
+    # within-cluster means without the diagonal: 4 for the first cluster,
+    # 9 for the second, 0 for the single voxel of the third
+    actual, _ = cluster_matrix_average(M, np.array([0, 0, 0, 1, 1]))
+    np.testing.assert_equal(actual, [
+        [4, 4, 4, 1, 1],
+        [1, 1, 1, 9, 9],
+    ])
+
+    actual, _ = cluster_matrix_average(M, np.array([0, 0, 0, 1, 2]))
+    np.testing.assert_equal(actual, [
+        [4, 4, 4, 1, 1],
+        [1, 1, 1, 0, 9],
+        [1, 1, 1, 9, 0],
+    ])
+
+
+def test_batch_individual_group_clustered_maps(tmpdir):
+    """
+    Tests the batched maps against the per-subject ones
+    """
+
+    from PyBASC.basc import (
+        batch_individual_group_clustered_maps,
+        individual_group_clustered_maps,
+    )
+    from PyBASC.utils import save_stability_matrix
+
+    random_state = np.random.RandomState(seed=33)
+
+    roi_mask_file, roi_mask = _save_roi_mask(tmpdir)
+    V = int(roi_mask.sum())
+
+    clusters_G = random_state.randint(1, 4, size=V)
+    subject_stability_list = []
+    for i in range(3):
+        ism = _random_stability_matrix(random_state, V)
+        ism_file = str(tmpdir.join('ism_%d.npy' % i))
+        save_stability_matrix(ism_file, ism)
+        subject_stability_list.append(ism_file)
+
+    with tmpdir.mkdir('batch').as_cwd():
+        batch_outputs = batch_individual_group_clustered_maps(
+            subject_stability_list, clusters_G, roi_mask_file, False,
+            [None] * 3
+        )
+
+    for i, ism_file in enumerate(subject_stability_list):
+        with tmpdir.mkdir('subject_%d' % i).as_cwd():
+            outputs = individual_group_clustered_maps(
+                ism_file, clusters_G, roi_mask_file, False, None
+            )
+
+        for output, batch_output in zip(outputs, batch_outputs):
+            if output.endswith('.npy'):
+                np.testing.assert_allclose(
+                    np.load(batch_output[i]), np.load(output), rtol=1e-12
+                )
+            else:
+                assert (nb.load(batch_output[i]).get_data() ==
+                        nb.load(output).get_data()).all()
+
+
+def test_ndarray_to_vols(tmpdir):
+    """
+    Tests the multi-volume writer and the mask cache
+    """
+
+    from PyBASC.basc import load_roi_mask, ndarray_to_vol, ndarray_to_vols
+
+    roi_mask_file, roi_mask = _save_roi_mask(tmpdir)
+
+    data = np.arange(3 * roi_mask.sum()).reshape(3, -1).astype('int16')
+
+    with tmpdir.as_cwd():
+        img_files = ndarray_to_vols(
+            data, roi_mask_file, roi_mask_file,
+            ['vol_%d.nii.gz' % i for i in range(3)]
+        )
+        img_file = ndarray_to_vols(
+            data, roi_mask_file, roi_mask_file, 'vols.nii.gz'
+        )
+
+        vols = nb.load(img_file).get_data()
+        assert vols.shape == (4, 4, 3, 3)
+        for i in range(3):
+            ref_file, _ = ndarray_to_vol(
+                data[i], roi_mask_file, roi_mask_file, 'ref.nii.gz'
+            )
+            ref = nb.load(ref_file).get_data()
+            assert (nb.load(img_files[i]).get_data() == ref).all()
+            assert (vols[..., i] == ref).all()
+
+    assert load_roi_mask(roi_mask_file) is load_roi_mask(roi_mask_file)
+
+    roi_mask[0, 0, 0] = 1
+    _save_roi_mask(tmpdir, roi_mask)
+    assert load_roi_mask(roi_mask_file).sum() == roi_mask.sum()
+
+
+def test_load_subject_rois(tmpdir, monkeypatch):
+    """
+    Tests the streamed masking of a subject and its cache
+    """
+
+    from PyBASC.basc import load_subject_rois
+
+    renames = _record_renames(monkeypatch)
+
+    random_state = np.random.RandomState(seed=35)
+
+    subject_data = random_state.randn(4, 4, 3, 10).astype('float32')
+    subject_file = str(tmpdir.join('subject.nii.gz'))
+    nb.Nifti1Image(subject_data, np.eye(4)).to_filename(subject_file)
+
+    roi_masks = [np.zeros((4, 4, 3), dtype='int16') for _ in range(2)]
+    roi_masks[0][1:3, :, 1:] = 1
+    roi_masks[1][0, :2, :] = 1
+    roi_mask_files = [
+        _save_roi_mask(tmpdir, roi_mask, 'roi_mask_%d.nii.gz' % i)[0]
+        for i, roi_mask in enumerate(roi_masks)
+    ]
+
+    cache_dir = str(tmpdir.join('cache'))
+    for chunk_size, cache in ((None, None), (3, None),
+                              (3, cache_dir), (3, cache_dir)):
+        subject_rois = load_subject_rois(
+            subject_file, roi_mask_files, cache_dir=cache,
+            chunk_size=chunk_size
+        )
+        for roi_mask, subject_roi in zip(roi_masks, subject_rois):
+            assert subject_roi.dtype == np.float32
+            assert (subject_roi == subject_data[roi_mask.astype(bool)]).all()
+
+    # cache files are written under a temporary name and renamed in place,
+    # the second cached load reads them
+    cache_files = sorted(os.listdir(cache_dir))
+    assert len(cache_files) == 2
+    assert sorted(os.path.basename(dst) for _, dst in renames) == cache_files
+    assert all(src != dst for src, dst in renames)
+
+
+def test_cohort_store(tmpdir):
+    """
+    Tests that cohort store entries stand in for the subject files
+    """
+
+    from PyBASC.basc import (
+        create_cohort_store,
+        load_header,
+        load_subject_rois,
+        nifti_individual_stability,
+    )
+    from PyBASC.utils import load_stability_matrix
+
+    random_state = np.random.RandomState(seed=37)
+
+    roi_mask_file, _ = _save_roi_mask(tmpdir)
+
+    subjects_files = []
+    for i in range(2):
+        subjects_files.append(str(tmpdir.join('subject_%d.nii.gz' % i)))
+        nb.Nifti1Image(
+            random_state.randn(4, 4, 3, 20).astype('float32'), np.eye(4)
+        ).to_filename(subjects_files[-1])
+
+    store_dir = str(tmpdir.join('store'))
+    subject_entries = create_cohort_store(
+        subjects_files, roi_mask_file, store_dir
+    )
+    assert create_cohort_store(
+        subjects_files, roi_mask_file, store_dir
+    ) == subject_entries
+
+    for subject_file, subject_entry in zip(subjects_files, subject_entries):
+        subject_roi, = load_subject_rois(subject_file, [roi_mask_file])
+        entry_roi, = load_subject_rois(subject_entry, [roi_mask_file])
+        assert (subject_roi == entry_roi).all()
+
+        assert (load_header(subject_entry)[1] ==
+                load_header(subject_file)[1]).all()
+
+        isms = []
+        for i, subject in enumerate((subject_file, subject_entry)):
+            with tmpdir.mkdir('nis_%s_%d' % (
+                os.path.basename(subject_entry), i
+            )).as_cwd():
+                ism_file, _ = nifti_individual_stability(
+                    subject, roi_mask_file, 2, 2, 0, 'correlation',
+                    random_state_tuple=np.random.RandomState(1).get_state()
+                )
+                isms.append(np.asarray(load_stability_matrix(ism_file)))
+                assert not os.path.exists('bootstrap_labels.npy')
+        assert (isms[0] == isms[1]).all()
+
+        # the bootstrap labels are only written on request
+        with tmpdir.mkdir(
+            'nis_%s_labels' % os.path.basename(subject_entry)
+        ).as_cwd():
+            ism_file, _ = nifti_individual_stability(
+                subject_entry, roi_mask_file, 2, 2, 0, 'correlation',
+                random_state_tuple=np.random.RandomState(1).get_state(),
+                deferred=True, save_labels=True
+            )
+            assert np.load('bootstrap_labels.npy').shape == (2, 16)
+            assert (np.asarray(load_stability_matrix(ism_file)) ==
+                    isms[0]).all()
+
+
+def test_spatial_connectivity(tmpdir, monkeypatch):
+    """
+    Tests the in-memory and on-disk caches of the ward connectivity graph
+    """
+
+    import PyBASC.utils as utils
+    from sklearn.feature_extraction import image
+
+    roi_mask = np.zeros((6, 6, 4), dtype=bool)
+    roi_mask[1:5, 1:5, 1:3] = True
+    cache_dir = tmpdir.join('cache')
+
+    monkeypatch.setattr(utils, '_connectivity_cache', {})
+    renames = _record_renames(monkeypatch)
+
+    # without a cache directory, nothing is written
+    with tmpdir.as_cwd():
+        connectivity = utils.spatial_connectivity(roi_mask)
+    desired = image.grid_to_graph(6, 6, 4, mask=roi_mask)
+    assert (connectivity != desired).nnz == 0
+    assert utils.spatial_connectivity(roi_mask) is connectivity
+    assert tmpdir.listdir() == []
+    assert renames == []
+
+    monkeypatch.setattr(utils, '_connectivity_cache', {})
+    connectivity = utils.spatial_connectivity(roi_mask, str(cache_dir))
+    assert (connectivity != desired).nnz == 0
+    assert utils.spatial_connectivity(roi_mask, str(cache_dir)) is \
+        connectivity
+
+    # written under a temporary name, then renamed in place
+    cache_files = cache_dir.listdir()
+    assert len(cache_files) == 1
+    assert len(renames) == 1
+    assert renames[0][1] == str(cache_files[0])
+    assert renames[0][0] != renames[0][1]
+
+    # a new process loads the graph from disk
+    monkeypatch.setattr(utils, '_connectivity_cache', {})
+    monkeypatch.setattr(image, 'grid_to_graph', None)
+    cached = utils.spatial_connectivity(roi_mask, str(cache_dir))
+    assert (cached != desired).nnz == 0
+    monkeypatch.undo()
+
+    # a different mask gets its own graph
+    monkeypatch.setattr(utils, '_connectivity_cache', {})
+    roi_mask[1, 1, 1] = False
+    connectivity = utils.spatial_connectivity(roi_mask, str(cache_dir))
+    assert connectivity.shape == (roi_mask.sum(), roi_mask.sum())
+    assert len(cache_dir.listdir()) == 2
+
+
+def test_ward_tree():
+    """
+    Tests the cuts of one ward tree against ward fitted at each number of
+    clusters
+    """
+
+    from sklearn.cluster import FeatureAgglomeration
+    from PyBASC.utils import (
+        WardTree,
+        cluster_timeseries,
+        similarity_matrix,
+        spatial_connectivity,
+    )
+
+    random_state = np.random.RandomState(seed=39)
+
+    roi_mask = np.zeros((8, 8, 6), dtype=bool)
+    roi_mask[1:7, 1:7, 1:5] = True
+    V = roi_mask.sum()
+    X = random_state.randn(30, V)
+
+    sim_matrix = similarity_matrix(X, 'correlation', 0.0)
+    connectivity = spatial_connectivity(roi_mask)
+
+    structured = WardTree(sim_matrix, connectivity=connectivity)
+    unstructured = WardTree(sim_matrix)
+    for n_clusters in (1, 2, 7, 99, 100, 120, V):
+        ward = FeatureAgglomeration(
+            n_clusters=n_clusters, connectivity=connectivity, linkage='ward'
+        ).fit(sim_matrix)
+        assert (structured.cut(n_clusters) == ward.labels_).all()
+
+        ward = FeatureAgglomeration(
+            n_clusters=n_clusters, linkage='ward'
+        ).fit(sim_matrix)
+        assert (unstructured.cut(n_clusters) == ward.labels_).all()
+
+    y_pred = cluster_timeseries(X, roi_mask, [2, 4], 'correlation', 0.0)
+    assert y_pred.shape == (2, V)
+    for labels, n_clusters in zip(y_pred, [2, 4]):
+        assert (labels == cluster_timeseries(
+            X, roi_mask, n_clusters, 'correlation', 0.0
+        )).all()
+
+
 # def test_adjacency_matrix():
 #     """
 #     Tests the adjacency_matrix of BASC workflow
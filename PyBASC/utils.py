@@ -136,55 +136,1051 @@ def timeseries_bootstrap(tseries, block_size, random_state=None):
 
     """
     import numpy as np
+    import PyBASC.utils as utils
+
+    block_mask = utils.timeseries_bootstrap_indices(
+        tseries.shape[0], block_size, random_state=random_state
+    )[0].astype('int')
+
+    return tseries[block_mask, :], block_mask
+
+
+def timeseries_bootstrap_indices(
+    n_timepoints, block_size, n_bootstraps=1, random_state=None
+):
+    """
+    Generates the timepoint indices of `n_bootstraps` Circular-block-bootstrap
+    samples at once. Drawing `n_bootstraps` samples in a single call consumes
+    the random state exactly as `n_bootstraps` successive calls to
+    `timeseries_bootstrap` do, so seeded runs give the same resamples.
+
+    Parameters
+    ----------
+    n_timepoints : integer
+        Number of timepoints `M` of the time-series
+    block_size : integer
+        Size of the bootstrapped blocks
+    n_bootstraps : integer, optional
+        Number of bootstrap samples
+    random_state : RandomState
+        the random state to seed the bootstrap
+
+    Returns
+    -------
+    block_masks : array_like
+        An int32 matrix of shape (`n_bootstraps`, `M`), each row holding the
+        timepoint indices of one bootstrap sample
+
+    Examples
+    --------
+
+    >>> timeseries_bootstrap_indices(10, 3, n_bootstraps=2).shape
+    (2, 10)
+
+    """
+    import numpy as np
+
+    if not random_state:
+        random_state = np.random.RandomState()
+
+    # calculate number of blocks
+    k = int(np.ceil(float(n_timepoints) / block_size))
+
+    # generate random indices of blocks, one row per bootstrap
+    r_ind = np.floor(random_state.rand(n_bootstraps, k) * n_timepoints)
+    r_ind = r_ind.astype('int32')
+
+    # timepoint t is the (t % block_size)-th element of block t // block_size
+    timepoints = np.arange(n_timepoints, dtype='int32')
+    block_masks = r_ind[:, timepoints // block_size] + timepoints % block_size
+    np.mod(block_masks, n_timepoints, out=block_masks)
+
+    return block_masks
+
+
+def timeseries_bootstrap_generator(
+    tseries, block_size, n_bootstraps, random_state=None, presample=True
+):
+    """
+    Lazily yields `n_bootstraps` Circular-block-bootstrap samples of the
+    input time-series.
+
+    Parameters
+    ----------
+    tseries : array_like
+        A matrix of shapes (`M`, `N`) with `M` timepoints and `N` variables
+    block_size : integer
+        Size of the bootstrapped blocks
+    n_bootstraps : integer
+        Number of bootstrap samples
+    random_state : RandomState
+        the random state to seed the bootstrap
+    presample : boolean, optional
+        Whether the indices of all samples are drawn up front with a single
+        `timeseries_bootstrap_indices` call. Set it to False when the random
+        state is also consumed between samples (e.g. by the clustering), so
+        the draws stay interleaved as with `timeseries_bootstrap`.
+
+    Yields
+    ------
+    bseries : array_like
+        Bootstrap sample of the input timeseries, gathered on demand
+    block_mask : array_like
+        Timepoint indices of the bootstrap sample
+
+    """
+    import PyBASC.utils as utils
+
+    n_timepoints = tseries.shape[0]
+
+    if presample:
+        block_masks = utils.timeseries_bootstrap_indices(
+            n_timepoints, block_size, n_bootstraps, random_state=random_state
+        )
+        for block_mask in block_masks:
+            yield tseries[block_mask, :], block_mask
+
+    else:
+        for _ in range(n_bootstraps):
+            block_mask = utils.timeseries_bootstrap_indices(
+                n_timepoints, block_size, random_state=random_state
+            )[0]
+            yield tseries[block_mask, :], block_mask
+
+
+def standard_bootstrap(dataset, random_state=None):
+    """
+    Generates a bootstrap sample from the input dataset
+
+    Parameters
+    ----------
+    dataset : array_like
+        A matrix of where dimension-0 represents samples
+    random_state : integer
+        the random state to seed the bootstrap
+
+    Returns
+    -------
+    bdataset : array_like
+        A bootstrap sample of the input dataset
+
+    Examples
+    --------
+    """
+
+    if not random_state:
+        random_state = np.random.RandomState()
+
+    n = dataset.shape[0]
+    b = random_state.randint(0, high=n - 1, size=n)
+    return dataset[b]
+
+
+def standard_bootstrap_counts(n_samples, random_state=None):
+    """
+    Draw a bootstrap sample as in `standard_bootstrap`, but return how many
+    times each sample was drawn instead of the resampled dataset.
+
+    Parameters
+    ----------
+    n_samples : integer
+        Number of samples in the dataset
+    random_state : RandomState
+        the random state to draw the bootstrap from
+
+    Returns
+    -------
+    counts : array_like
+        Array of shape (`n_samples`,) with the multiplicity of each sample
+
+    Examples
+    --------
+    >>> rs = np.random.RandomState(10)
+    >>> counts = standard_bootstrap_counts(5, rs)
+    >>> counts.sum()
+    5
+    """
+
+    if not random_state:
+        random_state = np.random.RandomState()
+
+    b = random_state.randint(0, high=n_samples - 1, size=n_samples)
+    return np.bincount(b, minlength=n_samples)
+
+
+def pack_stability_matrix(S):
+    """
+    Pack the upper triangle of a symmetric stability matrix, diagonal
+    included, row by row into a uint8 vector.
+
+    Parameters
+    ----------
+    S : array_like
+        A symmetric matrix of shape (`V`, `V`)
+
+    Returns
+    -------
+    packed : array_like
+        A uint8 vector of length `V` * (`V` + 1) / 2
+
+    Examples
+    --------
+    >>> pack_stability_matrix(np.array([[100, 20], [20, 100]]))
+    array([100,  20, 100], dtype=uint8)
+    """
+    V = S.shape[0]
+    packed = np.empty(V * (V + 1) // 2, dtype='uint8')
+
+    start = 0
+    for i in range(V):
+        packed[start:start + V - i] = S[i, i:]
+        start += V - i
+
+    return packed
+
+
+def unpack_stability_matrix(packed, out=None):
+    """
+    Rebuild the symmetric stability matrix from its packed upper triangle,
+    see `pack_stability_matrix`.
+
+    Parameters
+    ----------
+    packed : array_like
+        A vector of length `V` * (`V` + 1) / 2, possibly memory-mapped
+    out : array_like, optional
+        A matrix of shape (`V`, `V`) to fill
+
+    Returns
+    -------
+    S : array_like
+        A matrix of shape (`V`, `V`)
+    """
+    V = int((np.sqrt(8 * len(packed) + 1) - 1) // 2)
+    if V * (V + 1) // 2 != len(packed):
+        raise ValueError(
+            'A packed stability matrix cannot have {} elements'.format(
+                len(packed)
+            )
+        )
+
+    if out is None:
+        out = np.empty((V, V), dtype=packed.dtype)
+
+    start = 0
+    for i in range(V):
+        row = packed[start:start + V - i]
+        out[i, i:] = row
+        out[i:, i] = row
+        start += V - i
+
+    return out
+
+
+def save_stability_matrix(stability_file, S):
+    """
+    Save a stability matrix, in the format given by the extension of the
+    file.
+
+    A `.npy` file stores the packed upper triangle of the matrix as raw
+    uint8 (see `pack_stability_matrix`), which can be memory-mapped. Any
+    other file is written as a sparse `.npz` matrix.
+
+    Parameters
+    ----------
+    stability_file : string
+        Path of the file to write
+    S : array_like or sparse matrix
+        A symmetric stability matrix of shape (`V`, `V`)
+    """
+    import scipy.sparse
+    import PyBASC.utils as utils
+
+    if stability_file.endswith('.npy'):
+        if scipy.sparse.issparse(S):
+            S = S.toarray()
+        np.save(stability_file, utils.pack_stability_matrix(S))
+    else:
+        if not scipy.sparse.issparse(S):
+            S = scipy.sparse.csr_matrix(S, dtype=np.int8)
+        scipy.sparse.save_npz(stability_file, S)
+
+
+def load_stability_matrix(stability_file, packed=False):
+    """
+    Load a stability matrix saved by one of the BASC stages as a dense array.
+
+    Parameters
+    ----------
+    stability_file : string
+        Path to the saved stability matrix, a sparse `.npz` or a packed
+        `.npy` (see `save_stability_matrix`)
+    packed : boolean, optional
+        Return the packed upper triangle instead of the full matrix. For
+        `.npy` files it is memory-mapped, without reading the whole file.
+
+    Returns
+    -------
+    S : array_like
+        Dense stability matrix, or its packed upper triangle
+    """
+    import scipy.sparse
+    import PyBASC.utils as utils
+
+    if stability_file.endswith('.npy'):
+        S = np.load(stability_file, mmap_mode='r')
+        if packed:
+            return S
+        return utils.unpack_stability_matrix(S)
+
+    S = scipy.sparse.load_npz(stability_file).toarray()
+    if packed:
+        return utils.pack_stability_matrix(S)
+    return S
+
+
+def sum_stability_matrices(
+    stability_files, weights=None, dtype='uint32', packed=False
+):
+    """
+    Sum stability matrices stored on disk, loading one at a time.
+
+    Parameters
+    ----------
+    stability_files : list of strings
+        Paths to the stability matrices, all of the same shape
+    weights : array_like, optional
+        Non-negative integer multiplicity of each matrix, such as the counts
+        of `standard_bootstrap_counts`. Matrices with a weight of zero are
+        not loaded.
+    dtype : string, optional
+        Integer type of the sum
+    packed : boolean, optional
+        Return the sum as a `PackedStabilityMatrix`
+
+    Returns
+    -------
+    total : array_like or PackedStabilityMatrix
+        Weighted sum of the matrices
+    """
+    import PyBASC.utils as utils
+
+    if weights is None:
+        weights = np.ones(len(stability_files), dtype='int')
+
+    # packed files are summed as memory-mapped triangles and unpacked once
+    sum_packed = packed or all(f.endswith('.npy') for f in stability_files)
+
+    total = None
+    weighted = None
+    for stability_file, weight in zip(stability_files, weights):
+        if weight == 0:
+            continue
+
+        S = utils.load_stability_matrix(stability_file, packed=sum_packed)
+        if total is None:
+            total = np.zeros(S.shape, dtype=dtype)
+
+        if weight == 1:
+            np.add(total, S, out=total, casting='unsafe')
+        else:
+            if weighted is None:
+                weighted = np.empty(S.shape, dtype=dtype)
+            # widen before multiplying, the stored type may be int8
+            np.copyto(weighted, S, casting='unsafe')
+            weighted *= weight
+            total += weighted
+
+    if sum_packed and total is not None:
+        total = utils.PackedStabilityMatrix(total)
+        if not packed:
+            total = total.toarray()
+
+    return total
+
+
+class PackedStabilityMatrix(object):
+    """
+    Symmetric stability matrix stored as its packed upper triangle, diagonal
+    included (see `pack_stability_matrix`).
+
+    It holds half of the entries of the dense matrix. Rows are rebuilt from
+    the packed vector on demand, so the dense matrix is only materialized
+    when `toarray` is called.
+
+    Full rows gather their part below the diagonal from every previous row
+    segment, which is several times slower than slicing the dense matrix.
+    Passes over the whole matrix read the contiguous segments of
+    `upper_rows` instead and add the transposed contribution of each block
+    themselves, as `cluster_matrix_average` and `compare_stability_matrices`
+    do.
+
+    Parameters
+    ----------
+    data : array_like
+        Packed upper triangle, of length `V` * (`V` + 1) / 2. It can be a
+        memory-mapped array.
+
+    Examples
+    --------
+    >>> S = PackedStabilityMatrix.from_labels(np.array([0, 0, 1]))
+    >>> S.data
+    array([1, 1, 0, 1, 0, 1], dtype=uint8)
+    >>> S.rows(1, 3)
+    array([[1, 1, 0],
+           [0, 0, 1]], dtype=uint8)
+
+    """
+
+    def __init__(self, data):
+        n_features = int((np.sqrt(8 * len(data) + 1) - 1) // 2)
+        if n_features * (n_features + 1) // 2 != len(data):
+            raise ValueError(
+                'A packed stability matrix cannot have {} elements'.format(
+                    len(data)
+                )
+            )
+
+        self.data = data
+        self.n_features = n_features
+        self._offsets = None
+
+    @property
+    def shape(self):
+        return (self.n_features, self.n_features)
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    @classmethod
+    def zeros(cls, n_features, dtype='uint32'):
+        """
+        Create an all-zero matrix, to accumulate into.
+        """
+        return cls(np.zeros(n_features * (n_features + 1) // 2, dtype=dtype))
+
+    @classmethod
+    def from_dense(cls, S):
+        """
+        Pack a dense or sparse symmetric matrix.
+        """
+        import scipy.sparse
+        import PyBASC.utils as utils
+
+        if scipy.sparse.issparse(S):
+            S = S.toarray()
+        return cls(utils.pack_stability_matrix(S))
+
+    @classmethod
+    def from_labels(cls, labels):
+        """
+        Build the packed adjacency matrix of a clustering, the packed
+        equivalent of `adjacency_matrix`.
+        """
+        labels = np.asarray(labels).ravel()
+        V = len(labels)
+
+        data = np.empty(V * (V + 1) // 2, dtype='uint8')
+        start = 0
+        for i in range(V):
+            np.equal(labels[i:], labels[i], out=data[start:start + V - i],
+                     casting='unsafe')
+            start += V - i
+
+        return cls(data)
+
+    @classmethod
+    def load(cls, stability_file):
+        """
+        Load a stability matrix saved in any format, memory-mapping the
+        packed `.npy` files.
+        """
+        import PyBASC.utils as utils
+
+        return cls(utils.load_stability_matrix(stability_file, packed=True))
+
+    def save(self, stability_file):
+        """
+        Save the matrix in the format given by the extension of the file,
+        see `save_stability_matrix`.
+        """
+        import PyBASC.utils as utils
+
+        if stability_file.endswith('.npy'):
+            np.save(stability_file, self.data.astype('uint8', copy=False))
+        else:
+            utils.save_stability_matrix(stability_file, self.toarray())
+
+    def offsets(self):
+        """
+        Position of the diagonal element of each row in the packed vector.
+        """
+        if self._offsets is None:
+            i = np.arange(self.n_features, dtype='int64')
+            self._offsets = i * self.n_features - i * (i - 1) // 2
+        return self._offsets
+
+    def rows(self, start, stop):
+        """
+        Get the dense rows `start` to `stop` of the matrix, gathered from the
+        packed vector.
+        """
+        offsets = self.offsets()
+        r = np.arange(start, stop)[:, np.newaxis]
+        c = np.arange(self.n_features)[np.newaxis, :]
+        index = offsets[np.minimum(r, c)] + np.abs(c - r)
+        return np.asarray(self.data)[index]
+
+    def upper_rows(self, start, stop):
+        """
+        Get the rows `start` to `stop` of the upper triangle from the
+        diagonal on, `S[start:stop, start:]` with the entries below the
+        diagonal set to 0, copied from contiguous packed segments.
+        """
+        offsets = self.offsets()
+        V = self.n_features
+        out = np.zeros((stop - start, V - start), dtype=self.data.dtype)
+        for i in range(start, stop):
+            out[i - start, i - start:] = \
+                self.data[offsets[i]:offsets[i] + V - i]
+        return out
+
+    def toarray(self):
+        """
+        Get the dense matrix.
+        """
+        import PyBASC.utils as utils
+
+        return utils.unpack_stability_matrix(np.asarray(self.data))
+
+    def add(self, other, weight=1):
+        """
+        Add another matrix, or a packed vector, in place, `weight` times.
+        """
+        if isinstance(other, PackedStabilityMatrix):
+            other = other.data
+
+        if weight == 1:
+            np.add(self.data, other, out=self.data, casting='unsafe')
+        else:
+            weighted = np.asarray(other).astype(self.data.dtype)
+            weighted *= weight
+            self.data += weighted
+
+        return self
+
+    def scaled(self, scale, denominator, block_size=1 << 22):
+        """
+        Get the uint8 matrix of `scale` * matrix / `denominator`, rounded
+        down, such as the mean of a sum or its percentage.
+        """
+        out = np.empty(len(self.data), dtype='uint8')
+        for start in range(0, len(self.data), block_size):
+            block = self.data[start:start + block_size].astype('uint64')
+            block *= scale
+            block //= denominator
+            out[start:start + block_size] = block
+
+        return PackedStabilityMatrix(out)
+
+    def expand(self, labels):
+        """
+        Get the voxel-wise matrix of a supervoxel matrix, given the
+        supervoxel label of each voxel, the packed equivalent of
+        `expand_ism`.
+        """
+        labels = np.asarray(labels).ravel()
+        V = len(labels)
+        S = self.toarray()
+
+        data = np.empty(V * (V + 1) // 2, dtype=self.data.dtype)
+        start = 0
+        for i in range(V):
+            data[start:start + V - i] = S[labels[i], labels[i:]]
+            start += V - i
+
+        return PackedStabilityMatrix(data)
+
+    def compare(self, other, labels=None):
+        """
+        Calculate the similarity with another stability matrix, see
+        `compare_stability_matrices`.
+        """
+        import PyBASC.utils as utils
+
+        return utils.compare_stability_matrices(self, other, labels=labels)
+
+
+def correlation_similarity(
+    X, affinity_threshold, out=None, dtype='float32', workspace=None
+):
+    """
+    Calculate the thresholded similarity matrix between the columns of a
+    given timeseries based on their correlation distance.
+
+    It computes the same matrix as the generic path of `similarity_matrix`
+    with the 'correlation' metric, but the columns are z-scored once and the
+    correlations are obtained with a single (float32 by default) matrix
+    product. The NaN fill, max-normalization and thresholding are done in
+    place.
+
+    Parameters
+    ----------
+    X : array_like
+        A matrix of shape (`N`, `M`) with `N` samples and `M` dimensions
+    affinity_threshold : float
+        Similarities below this threshold are set to zero.
+    out : array_like, optional
+        A C-contiguous matrix of shape (`M`, `M`) and type `dtype` that
+        receives the similarity matrix.
+    dtype : string, optional
+        Floating point precision of the computation.
+    workspace : SimilarityWorkspace, optional
+        Workspace holding the z-scored timeseries and similarity buffers,
+        used when `out` is not given.
+
+    Returns
+    -------
+    sim_matrix : array_like
+        A similarity matrix of shape (`M`, `M`)
+
+    """
+    import numpy as np
+
+    X = np.asarray(X)
+    n_features = X.shape[1]
+
+    if workspace is None:
+        Z = np.empty(X.shape, dtype=dtype)
+        if out is None:
+            out = np.empty((n_features, n_features), dtype=dtype)
+    else:
+        Z = workspace.buffer('zscore', X.shape, dtype)
+        if out is None:
+            out = workspace.buffer(
+                'similarity', (n_features, n_features), dtype
+            )
+
+    constant = _unit_columns(X, Z)
+
+    np.dot(Z.T, Z, out=out)
+
+    # correlation distance
+    np.subtract(1, out, out=out)
+    np.fill_diagonal(out, 0)
+
+    # Constant columns have an undefined correlation, which is replaced by
+    # the maximum distance
+    if constant.any():
+        out[constant, :] = 0
+        out[:, constant] = 0
+        max_dist = out.max()
+        out[constant, :] = max_dist
+        out[:, constant] = max_dist
+        np.fill_diagonal(out, 0)
+
+    return _similarity_from_distance(out, affinity_threshold)
+
+
+def _unit_columns(X, Z):
+    """
+    Center the columns of `X` in double precision, then scale them to unit
+    norm into `Z`, so that Z.T Z is the correlation matrix. Returns the mask
+    of the constant columns, which are left at zero.
+    """
+    import numpy as np
+
+    np.subtract(X, X.mean(axis=0, dtype='float64').astype(Z.dtype), out=Z)
+    norms = np.sqrt(np.einsum('ij,ij->j', Z, Z))
+    constant = norms == 0
+    norms[constant] = 1
+    Z /= norms
+
+    return constant
+
+
+def knn_correlation_similarity(
+    X, n_neighbors=10, affinity_threshold=0.0, dtype='float32',
+    block_size=None, workspace=None
+):
+    """
+    Calculate a sparse k-nearest-neighbour similarity graph between the
+    columns of a given timeseries based on their correlation distance.
+
+    The correlations are computed a block of rows at a time and only the
+    `n_neighbors` largest similarities of each row are kept, so the dense
+    `M` x `M` matrix is never formed. Kept values are the ones of
+    `correlation_similarity`, except that constant columns have a zero
+    correlation with every other column. The graph is made symmetric by
+    averaging it with its transpose.
+
+    Parameters
+    ----------
+    X : array_like
+        A matrix of shape (`N`, `M`) with `N` samples and `M` dimensions
+    n_neighbors : integer, optional
+        Number of neighbours of each column, itself excluded
+    affinity_threshold : float, optional
+        Similarities below this threshold are set to zero.
+    dtype : string, optional
+        Floating point precision of the computation.
+    block_size : integer, optional
+        Number of rows of the correlation matrix computed at a time
+    workspace : SimilarityWorkspace, optional
+        Workspace holding the z-scored timeseries and the block buffer
+
+    Returns
+    -------
+    sim_graph : scipy.sparse.csr_matrix
+        A symmetric similarity graph of shape (`M`, `M`)
+
+    """
+    import numpy as np
+    import scipy.sparse
 
-    if not random_state:
-        random_state = np.random.RandomState()
+    X = np.asarray(X)
+    n_features = X.shape[1]
+    n_neighbors = min(n_neighbors, n_features - 1)
+    if block_size is None:
+        block_size = max(1, (1 << 22) // max(n_features, 1))
+    block_size = max(1, min(block_size, n_features))
 
-    # calculate number of blocks
-    k = int(np.ceil(float(tseries.shape[0]) / block_size))
+    if workspace is None:
+        Z = np.empty(X.shape, dtype=dtype)
+    else:
+        Z = workspace.buffer('zscore', X.shape, dtype)
+    constant = _unit_columns(X, Z)
 
-    # generate random indices of blocks
-    r_ind = np.floor(random_state.rand(1, k) * tseries.shape[0])
-    blocks = np.dot(np.arange(0, block_size)[:, np.newaxis], np.ones([1, k]))
+    if n_neighbors < 1:
+        return scipy.sparse.csr_matrix((n_features, n_features), dtype=dtype)
 
-    block_offsets = np.dot(np.ones([block_size, 1]), r_ind)
-    block_mask = (blocks + block_offsets).flatten('F')[:tseries.shape[0]]
-    block_mask = np.mod(block_mask, tseries.shape[0])
+    rows, cols, values = [], [], []
+    for start in range(0, n_features, block_size):
+        stop = min(start + block_size, n_features)
+        diagonal = (np.arange(stop - start), np.arange(start, stop))
 
-    return tseries[block_mask.astype('int'), :], block_mask.astype('int')
+        # the last block is a slice of the same buffer, so the workspace
+        # keeps a single allocation across blocks and bootstraps
+        if workspace is None:
+            block = np.empty((block_size, n_features), dtype=dtype)
+        else:
+            block = workspace.buffer(
+                'knn_block', (block_size, n_features), dtype
+            )
+        block = block[:stop - start]
+        np.dot(Z[:, start:stop].T, Z, out=block)
+
+        # correlation distance, normalized and thresholded as in the dense
+        # similarity
+        np.subtract(1, block, out=block)
+        block[diagonal] = 0
+        _similarity_from_distance(block, affinity_threshold)
+
+        # a column is not its own neighbour
+        block[diagonal] = -np.inf
+        neighbors = np.argpartition(
+            block, block.shape[1] - n_neighbors, axis=1
+        )[:, -n_neighbors:]
+        similarities = np.take_along_axis(block, neighbors, axis=1)
+
+        kept = similarities > 0
+        rows.append(np.nonzero(kept)[0] + start)
+        cols.append(neighbors[kept])
+        values.append(similarities[kept])
+
+    sim_graph = scipy.sparse.csr_matrix(
+        (np.concatenate(values),
+         (np.concatenate(rows), np.concatenate(cols))),
+        shape=(n_features, n_features)
+    )
 
+    return ((sim_graph + sim_graph.T) * 0.5).tocsr()
 
-def standard_bootstrap(dataset, random_state=None):
+
+def _similarity_from_distance(dist, affinity_threshold):
     """
-    Generates a bootstrap sample from the input dataset
+    Turn a distance matrix into a thresholded similarity matrix in place,
+    as `1 - normalize(dist, norm='max')`.
+    """
+    import numpy as np
+
+    row_max = np.maximum(dist.max(axis=1), -dist.min(axis=1))
+    row_max[row_max == 0] = 1
+    dist /= row_max[:, np.newaxis]
+    np.subtract(1, dist, out=dist)
+
+    np.copyto(dist, 0, where=dist < affinity_threshold)
+
+    return dist
+
+
+def _squareform_into(condensed, out):
+    """
+    Write a condensed distance vector into a preallocated square matrix,
+    as `scipy.spatial.distance.squareform` does.
+    """
+    n = out.shape[0]
+
+    start = 0
+    for i in range(n):
+        stop = start + n - i - 1
+        out[i, i] = 0
+        out[i, i + 1:] = condensed[start:stop]
+        out[i + 1:, i] = condensed[start:stop]
+        start = stop
+
+    return out
+
+
+class SimilarityWorkspace(object):
+    """
+    Buffers shared by the similarity matrix computations of all bootstraps
+    of a subject, so each bootstrap fills the same memory in place instead
+    of allocating new `V` x `V` matrices.
+
+    Buffers are allocated on first request and reused as long as the
+    requested shape and type do not change.
+
+    Examples
+    --------
+    >>> workspace = SimilarityWorkspace()
+    >>> a = workspace.buffer('similarity', (10, 10), 'float32')
+    >>> a is workspace.buffer('similarity', (10, 10), 'float32')
+    True
+
+    """
+
+    def __init__(self):
+        self._buffers = {}
+
+    def buffer(self, name, shape, dtype='float64'):
+        """
+        Get the named buffer, allocating it if needed.
+        """
+        shape = tuple(shape)
+        dtype = np.dtype(dtype)
+
+        buf = self._buffers.get(name)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            # release the previous buffer before allocating the new one
+            self._buffers.pop(name, None)
+            buf = np.empty(shape, dtype=dtype)
+            self._buffers[name] = buf
+
+        return buf
+
+    def clear(self):
+        """
+        Release all buffers.
+        """
+        self._buffers.clear()
+
+
+class WarmStart(object):
+    """
+    Centroids of the last k-means clustering at each number of clusters,
+    used to initialize the clustering of the next bootstrap of the same
+    subject with a single run instead of several random restarts.
+
+    Examples
+    --------
+    >>> warm_start = WarmStart()
+    >>> warm_start.centroids(3) is None
+    True
+    >>> warm_start.update(3, np.zeros((3, 10)))
+    >>> warm_start.centroids(3).shape
+    (3, 10)
+
+    """
+
+    def __init__(self):
+        self._centroids = {}
+
+    def centroids(self, n_clusters):
+        """
+        Get the last centroids for `n_clusters`, None if there are none.
+        """
+        return self._centroids.get(n_clusters)
+
+    def update(self, n_clusters, centroids):
+        """
+        Keep the centroids of the last clustering with `n_clusters`.
+        """
+        self._centroids[n_clusters] = np.array(centroids)
+
+
+def similarity_matrix(
+    X, similarity_metric, affinity_threshold, out=None, workspace=None,
+    n_neighbors=10, dtype=None
+):
+    """
+    Calculate the thresholded similarity matrix between the columns of a
+    given timeseries.
 
     Parameters
     ----------
-    dataset : array_like
-        A matrix of where dimension-0 represents samples
-    random_state : integer
-        the random state to seed the bootstrap
+    X : array_like
+        A matrix of shape (`N`, `M`) with `N` samples and `M` dimensions
+    similarity_metric : string
+        Any distance metric supported by `scipy.spatial.distance.pdist`.
+        'correlation' uses the `correlation_similarity` fast path when a
+        `dtype` is given. 'k_neighbors' gives the sparse correlation graph
+        of `knn_correlation_similarity`.
+    affinity_threshold : float
+        Similarities below this threshold are set to zero.
+    out : array_like, optional
+        A C-contiguous matrix of shape (`M`, `M`) and type `dtype` that
+        receives the similarity matrix when the 'correlation' metric is used.
+    workspace : SimilarityWorkspace, optional
+        Workspace whose buffers receive the intermediate and final matrices.
+    n_neighbors : integer, optional
+        Number of neighbours of each column with the 'k_neighbors' metric
+    dtype : string, optional
+        Floating point precision of the matrix product of the 'correlation'
+        fast path and of the 'k_neighbors' graph. The fast path agrees with
+        `pdist` within floating-point tolerance, which can break the ties
+        of heavily tied data differently, so without `dtype` the
+        'correlation' metric goes through `pdist` and the 'k_neighbors'
+        graph is float32.
 
     Returns
     -------
-    bdataset : array_like
-        A bootstrap sample of the input dataset
+    sim_matrix : array_like or scipy.sparse.csr_matrix
+        A similarity matrix of shape (`M`, `M`), sparse with the
+        'k_neighbors' metric
 
-    Examples
-    --------
     """
+    import numpy as np
+    import scipy as sp
+    import PyBASC.utils as utils
 
-    if not random_state:
-        random_state = np.random.RandomState()
+    if similarity_metric == 'correlation' and dtype is not None:
+        return utils.correlation_similarity(
+            X, affinity_threshold, out=out, dtype=dtype, workspace=workspace
+        )
 
-    n = dataset.shape[0]
-    b = random_state.randint(0, high=n - 1, size=n)
-    return dataset[b]
+    if similarity_metric == 'k_neighbors':
+        return utils.knn_correlation_similarity(
+            X, n_neighbors=n_neighbors,
+            affinity_threshold=affinity_threshold,
+            dtype=dtype or 'float32', workspace=workspace
+        )
+
+    X = np.asarray(X)
+    X_dist = sp.spatial.distance.pdist(X.T, metric=similarity_metric)
+    max_dist = np.nanmax(X_dist)
+    X_dist[np.isnan(X_dist)] = max_dist
+
+    if workspace is None:
+        X_dist = sp.spatial.distance.squareform(X_dist)
+    else:
+        n_features = X.shape[1]
+        X_dist = utils._squareform_into(
+            X_dist,
+            workspace.buffer('similarity', (n_features, n_features))
+        )
+
+    return utils._similarity_from_distance(X_dist, affinity_threshold)
+
+
+def _atomic_save(file, save, data):
+    """
+    Save `data` to `file` with `save(file, data)`, writing a file private to
+    the process and renaming it, so concurrent processes never read a
+    partially written file.
+    """
+    root, ext = os.path.splitext(file)
+    tmp_file = '%s.%d%s' % (root, os.getpid(), ext)
+    try:
+        save(tmp_file, data)
+        os.rename(tmp_file, file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+_connectivity_cache = {}
+
+
+def spatial_connectivity(mask_data, cache_dir=None):
+    """
+    Get the voxel adjacency graph of a mask, as built by
+    `sklearn.feature_extraction.image.grid_to_graph`, for spatially
+    constrained ward clustering.
+
+    Graphs are cached in memory by a hash of the mask contents, so all the
+    ward fits of a process share a single graph. When `cache_dir` is
+    provided, the graph is also persisted there as a sparse `.npz` and
+    loaded from there by later runs.
+
+    Parameters
+    ----------
+    mask_data : array_like
+        A binary 3D mask of the region of interest (ROI)
+    cache_dir : string, optional
+        Directory where the graphs are persisted, keyed by the hash of the
+        mask contents.
+
+    Returns
+    -------
+    connectivity : scipy.sparse matrix
+        Adjacency matrix of shape (`V`, `V`), `V` voxels of the mask
+
+    """
+    import hashlib
+    import numpy as np
+    import scipy.sparse
+    from sklearn.feature_extraction import image
+
+    mask_data = np.ascontiguousarray(mask_data, dtype=bool)
+
+    mask_hash = hashlib.sha1(str(mask_data.shape).encode())
+    mask_hash.update(mask_data.tobytes())
+    mask_hash = mask_hash.hexdigest()
+
+    connectivity = _connectivity_cache.get(mask_hash)
+    if connectivity is not None:
+        return connectivity
+
+    connectivity_file = None
+    if cache_dir:
+        connectivity_file = os.path.join(
+            cache_dir, 'connectivity_%s.npz' % mask_hash
+        )
+
+    if connectivity_file and os.path.exists(connectivity_file):
+        connectivity = scipy.sparse.load_npz(connectivity_file)
+
+    else:
+        shape = mask_data.shape
+        connectivity = image.grid_to_graph(
+            n_x=shape[0], n_y=shape[1],
+            n_z=shape[2], mask=mask_data
+        )
+
+        if connectivity_file:
+            try:
+                if not os.path.isdir(cache_dir):
+                    os.makedirs(cache_dir)
+                _atomic_save(
+                    connectivity_file, scipy.sparse.save_npz, connectivity
+                )
+            except (IOError, OSError):
+                logger.warning(
+                    'Could not cache the connectivity graph in %s', cache_dir
+                )
+
+    _connectivity_cache[mask_hash] = connectivity
+
+    return connectivity
 
 
 def cluster_timeseries(
     X, roi_mask_data, n_clusters, similarity_metric,
-    affinity_threshold, cluster_method='ward', random_state=None
+    affinity_threshold, cluster_method='ward', random_state=None,
+    workspace=None, warm_start=None, embedding=None, n_components=50,
+    eigen_solver='arpack', n_neighbors=10, dtype=None
 ):
     """
     Cluster a given timeseries
@@ -196,8 +1192,9 @@ def cluster_timeseries(
     roi_mask_data : array_like
         An array that contains a binary mask of the region of interest (ROI)
         being parcellated.
-    n_clusters : integer
-        Number of clusters
+    n_clusters : integer or list of integers
+        Number of clusters. With a list, the data is clustered at each of
+        them, see `cluster_similarity`.
     similarity_metric : {'k_neighbors', 'correlation', 'data'}
         Type of similarity measure for spectral clustering. The pairwise
         similarity measure specifies the edges of the similarity graph.
@@ -206,16 +1203,36 @@ def cluster_timeseries(
     affinity_threshold : float
         Threshold of similarity metric when 'correlation' similarity
         metric is used.
-    cluster_method : {'ward', 'spectral', 'kmeans', 'gaussianmixture'}
+    cluster_method : {'ward', 'spectral', 'kmeans', 'minibatch_kmeans',
+                      'gaussianmixture'}
         A string that says which cluster method to use.
     random_state : integer
         the random state to seed the bootstrap
+    workspace : SimilarityWorkspace, optional
+        Preallocated buffers for the similarity matrix, shared across calls.
+    warm_start : WarmStart, optional
+        Centroids to initialize k-means with, updated after clustering.
+    embedding : {None, 'svd', 'spectral'}, optional
+        Cluster the voxels on a low-rank embedding of the similarity matrix
+        of `n_components` dimensions, see `cluster_similarity`
+    n_components : integer, optional
+        Number of dimensions of the embedding
+    eigen_solver : {'arpack', 'lobpcg', 'amg'}, optional
+        Eigensolver of spectral clustering and of the spectral embedding,
+        'amg' needs pyamg to be installed
+    n_neighbors : integer, optional
+        Number of neighbours of each voxel with the 'k_neighbors' metric
+    dtype : string, optional
+        Floating point precision of the similarity matrix, see
+        `similarity_matrix`. The individual bootstraps use the float32 fast
+        path, the group stages the exact `pdist` path.
 
 
     Returns
     -------
     y_pred : array_like
-        Predicted cluster labels
+        Predicted cluster labels, one row per number of clusters when
+        `n_clusters` is a list
 
     Examples
     --------
@@ -227,41 +1244,134 @@ def cluster_timeseries(
 
     """
     import numpy as np
-    import scipy as sp
-    import sklearn as sk
-    from sklearn.feature_extraction import image
-    from sklearn.cluster import FeatureAgglomeration, SpectralClustering, KMeans
-    from sklearn.mixture import GaussianMixture
+    import PyBASC.utils as utils
 
-    X = np.array(X)
-    X_dist = sp.spatial.distance.pdist(X.T, metric=similarity_metric)
-    max_dist = np.nanmax(X_dist)
+    sim_matrix = utils.similarity_matrix(
+        X, similarity_metric, affinity_threshold, workspace=workspace,
+        n_neighbors=n_neighbors, dtype=dtype
+    )
 
-    X_dist = sp.spatial.distance.squareform(X_dist)
-    X_dist[np.isnan(X_dist)] = max_dist
+    print("Calculating Hierarchical Clustering")
 
-    sim_matrix = 1 - sk.preprocessing.normalize(X_dist, norm='max')
-    sim_matrix[sim_matrix < affinity_threshold] = 0
+    return utils.cluster_similarity(
+        sim_matrix, roi_mask_data, n_clusters,
+        cluster_method=cluster_method, random_state=random_state,
+        warm_start=warm_start, embedding=embedding,
+        n_components=n_components, eigen_solver=eigen_solver
+    )
 
-    print("Calculating Hierarchical Clustering")
+
+def cluster_similarity(
+    sim_matrix, roi_mask_data, n_clusters, cluster_method='ward',
+    random_state=None, warm_start=None, embedding=None, n_components=50,
+    eigen_solver='arpack'
+):
+    """
+    Cluster the features of a similarity matrix.
+
+    When `n_clusters` is a list, the matrix is clustered at each number of
+    clusters. For ward, the tree is then built once and cut at every one of
+    them.
+
+    With an `embedding`, each voxel is described by its `n_components`
+    coordinates in a low-rank embedding of the similarity matrix instead of
+    its full row of `V` similarities, so ward, k-means and gaussian mixtures
+    are fitted in `n_components` dimensions. Spectral clustering always
+    works on the similarity matrix itself.
+
+    A sparse similarity graph, as given by the 'k_neighbors' metric, is
+    clustered as is by spectral clustering, k-means and the embeddings.
+    Ward and gaussian mixtures need it dense.
+
+    Parameters
+    ----------
+    sim_matrix : array_like or scipy.sparse matrix
+        A similarity matrix of shape (`V`, `V`)
+    roi_mask_data : array_like
+        An array that contains a binary mask of the region of interest (ROI)
+        being parcellated, to constrain ward clustering spatially.
+    n_clusters : integer or list of integers
+        Number of clusters
+    cluster_method : {'ward', 'spectral', 'kmeans', 'minibatch_kmeans',
+                      'gaussianmixture'}
+        A string that says which cluster method to use.
+    random_state : integer
+        the random state to seed the bootstrap
+    warm_start : WarmStart, optional
+        For the k-means methods, the centroids of the previous clustering.
+        When it has centroids for the number of clusters, k-means starts
+        from them with a single run, and the new centroids are kept.
+    embedding : {None, 'svd', 'spectral'} or array_like, optional
+        Method of `similarity_embedding` to embed the similarity matrix
+        with, or an embedding of shape (`V`, `n_components`) already
+        computed
+    n_components : integer, optional
+        Number of dimensions of the embedding
+    eigen_solver : {'arpack', 'lobpcg', 'amg'}, optional
+        Eigensolver of spectral clustering and of the spectral embedding,
+        'amg' needs pyamg to be installed
+
+    Returns
+    -------
+    y_pred : array_like
+        Predicted cluster labels of shape (`V`,), or (`K`, `V`) when
+        `n_clusters` is a list of `K` numbers of clusters
+
+    """
+    import numpy as np
+    import scipy.sparse
+    from sklearn.cluster import (
+        FeatureAgglomeration, SpectralClustering, KMeans, MiniBatchKMeans
+    )
+    from sklearn.mixture import GaussianMixture
+    import PyBASC.utils as utils
 
     cluster_method = cluster_method.lower()
-    
-    
+    utils._check_eigen_solver(eigen_solver)
+
+    if scipy.sparse.issparse(sim_matrix) and embedding is None and \
+            cluster_method in ('ward', 'gaussianmixture'):
+        sim_matrix = sim_matrix.toarray()
+
+    # ward clusters the columns of its input, the other methods the rows
+    samples = features = sim_matrix
+    if isinstance(embedding, str) and cluster_method != 'spectral':
+        embedding = utils.similarity_embedding(
+            sim_matrix, n_components, method=embedding,
+            random_state=random_state, eigen_solver=eigen_solver
+        )
+    if embedding is not None and cluster_method != 'spectral':
+        samples = embedding
+        features = embedding.T
+
+    if isinstance(n_clusters, (list, tuple, np.ndarray)):
+        if cluster_method == 'ward':
+            connectivity = None
+            if roi_mask_data is not None:
+                connectivity = utils.spatial_connectivity(roi_mask_data)
+            tree = utils.WardTree(features, connectivity=connectivity)
+            return np.array([tree.cut(k) for k in n_clusters])
+
+        return np.array([
+            utils.cluster_similarity(
+                sim_matrix, roi_mask_data, k,
+                cluster_method=cluster_method, random_state=random_state,
+                warm_start=warm_start, embedding=embedding,
+                eigen_solver=eigen_solver
+            )
+            for k in n_clusters
+        ])
+
     if cluster_method == 'ward':
         if roi_mask_data is not None:
-            shape = roi_mask_data.shape
-            connectivity = image.grid_to_graph(
-                n_x=shape[0], n_y=shape[1],
-                n_z=shape[2], mask=roi_mask_data
-            )
+            connectivity = utils.spatial_connectivity(roi_mask_data)
 
             ward = FeatureAgglomeration(
                 n_clusters=n_clusters,
                 connectivity=connectivity,
                 linkage='ward'
             )
-            ward.fit(sim_matrix)
+            ward.fit(features)
             y_pred = ward.labels_.astype(np.int)
 
         else:
@@ -271,42 +1381,204 @@ def cluster_timeseries(
                 linkage='ward'
             )
 
-            ward.fit(sim_matrix)
+            ward.fit(features)
             y_pred = ward.labels_.astype(np.int)
 
     elif cluster_method == 'spectral':
         spectral = SpectralClustering(
             n_clusters,
-            eigen_solver='arpack',
+            eigen_solver=eigen_solver,
             affinity="precomputed", assign_labels='discretize',
             random_state=random_state
         )
         spectral.fit(sim_matrix)
         y_pred = spectral.labels_.astype(np.int)
 
-    elif cluster_method == 'kmeans':
-        kmeans = KMeans(
-            n_clusters=n_clusters,
-            init='k-means++', n_init=10,
-            random_state=random_state
-        )
-        kmeans.fit(sim_matrix)
+    elif cluster_method in ('kmeans', 'minibatch_kmeans'):
+        init, n_init = 'k-means++', 10
+        if cluster_method == 'minibatch_kmeans':
+            n_init = 3
+        if warm_start is not None and \
+                warm_start.centroids(n_clusters) is not None:
+            init, n_init = warm_start.centroids(n_clusters), 1
+
+        if cluster_method == 'kmeans':
+            kmeans = KMeans(
+                n_clusters=n_clusters,
+                init=init, n_init=n_init,
+                random_state=random_state
+            )
+        else:
+            kmeans = MiniBatchKMeans(
+                n_clusters=n_clusters,
+                init=init, n_init=n_init,
+                random_state=random_state
+            )
+        kmeans.fit(samples)
         y_pred = kmeans.labels_.astype(np.int)
 
+        if warm_start is not None:
+            warm_start.update(n_clusters, kmeans.cluster_centers_)
+
     elif cluster_method == 'gaussianmixture':
         gaussianmixture = GaussianMixture(
             n_components=n_clusters,
             init_params='kmeans',
             random_state=random_state
         )
-        y_pred = gaussianmixture.fit_predict(sim_matrix)
+        y_pred = gaussianmixture.fit_predict(samples)
 
     return y_pred
 
 
+def similarity_embedding(sim_matrix, n_components=50, method='svd',
+                         random_state=None, eigen_solver='arpack'):
+    """
+    Low-rank embedding of the voxels of a similarity matrix.
+
+    Parameters
+    ----------
+    sim_matrix : array_like
+        A similarity matrix of shape (`V`, `V`)
+    n_components : integer, optional
+        Number of dimensions of the embedding, at most `V` - 1
+    method : {'svd', 'spectral'}, optional
+        'svd' projects the rows of the matrix on its leading singular
+        vectors, computed with a truncated randomized SVD. 'spectral' takes
+        the matrix as the affinity of a graph and embeds it with the leading
+        eigenvectors of its normalized Laplacian.
+    random_state : integer or RandomState, optional
+        Random state of the randomized solvers
+    eigen_solver : {'arpack', 'lobpcg', 'amg'}, optional
+        Eigensolver of the spectral embedding
+
+    Returns
+    -------
+    embedding : array_like
+        Coordinates of shape (`V`, `n_components`) of each voxel
+
+    """
+    from sklearn.manifold import spectral_embedding
+    from sklearn.utils.extmath import randomized_svd
+
+    n_components = min(n_components, sim_matrix.shape[0] - 1)
+
+    if method == 'svd':
+        U, singular_values, _ = randomized_svd(
+            sim_matrix, n_components, random_state=random_state
+        )
+        return U * singular_values
+
+    elif method == 'spectral':
+        return spectral_embedding(
+            sim_matrix, n_components=n_components, eigen_solver=eigen_solver,
+            random_state=random_state, drop_first=False
+        )
+
+    raise ValueError('Unknown embedding method: %s' % method)
+
+
+def _check_eigen_solver(eigen_solver):
+    """
+    Check that the eigensolver is known and that pyamg is installed when
+    'amg' is asked for.
+    """
+    if eigen_solver not in ('arpack', 'lobpcg', 'amg'):
+        raise ValueError('Unknown eigen_solver: %s' % eigen_solver)
+
+    if eigen_solver == 'amg':
+        try:
+            import pyamg
+        except ImportError:
+            raise ImportError(
+                "eigen_solver='amg' requires pyamg, install it or use "
+                "'arpack' or 'lobpcg'"
+            )
+
+
+class WardTree(object):
+    """
+    Full ward tree of the features of a similarity matrix, built once and
+    cut at any number of clusters.
+
+    The cuts give the same labels as `FeatureAgglomeration` fitted with the
+    same number of clusters, including its numbering of the clusters.
+
+    Parameters
+    ----------
+    sim_matrix : array_like
+        A similarity matrix of shape (`V`, `V`)
+    connectivity : scipy.sparse matrix, optional
+        Adjacency matrix of the features, for spatially constrained ward
+
+    """
+
+    def __init__(self, sim_matrix, connectivity=None):
+        from sklearn.cluster import ward_tree
+
+        self.children, _, self.n_leaves, _ = ward_tree(
+            np.asarray(sim_matrix).T, connectivity=connectivity
+        )
+        self.structured = connectivity is not None
+
+    def cut(self, n_clusters):
+        """
+        Labels of the features when the tree is cut at `n_clusters`.
+
+        The merges below the cut are joined as connected components, and
+        each feature is labelled by the top node of its component.
+        """
+        import scipy.sparse
+        from heapq import heappush, heappushpop
+        from scipy.sparse.csgraph import connected_components
+
+        n_leaves = self.n_leaves
+        if not 0 < n_clusters <= n_leaves:
+            raise ValueError(
+                'Cannot cut a tree of %i leaves in %i clusters'
+                % (n_leaves, n_clusters)
+            )
+
+        n_nodes = 2 * n_leaves - 1
+        merged = self.children[:n_leaves - n_clusters]
+        parents = np.arange(n_leaves, n_leaves + len(merged))
+        graph = scipy.sparse.coo_matrix(
+            (
+                np.ones(2 * len(merged), dtype=bool),
+                (np.concatenate([parents, parents]), merged.T.ravel())
+            ),
+            shape=(n_nodes, n_nodes)
+        )
+        n_components, components = connected_components(
+            graph, directed=False
+        )
+        component_tops = np.zeros(n_components, dtype=np.intp)
+        np.maximum.at(component_tops, components, np.arange(n_nodes))
+        tops = component_tops[components[:n_leaves]]
+
+        # FeatureAgglomeration stops building structured trees early for
+        # large numbers of clusters, and then numbers clusters by top node
+        if self.structured and not n_clusters < max(100, 0.02 * n_leaves):
+            return np.searchsorted(np.unique(tops), tops).astype(np.int)
+
+        # otherwise it numbers them in the order they come off the heap of
+        # sklearn.cluster._agglomerative._hc_cut
+        nodes = [-(max(self.children[-1]) + 1)]
+        for _ in range(n_clusters - 1):
+            these_children = self.children[-nodes[0] - n_leaves]
+            heappush(nodes, -these_children[0])
+            heappushpop(nodes, -these_children[1])
+
+        labels = np.zeros(n_nodes, dtype=np.int)
+        labels[-np.array(nodes)] = np.arange(n_clusters)
+        return labels[tops]
+
+
 def cross_cluster_timeseries(
     data1, data2, roi_mask_data, n_clusters, similarity_metric,
-    affinity_threshold, cluster_method='ward', random_state=None
+    affinity_threshold, cluster_method='ward', random_state=None,
+    workspace=None, warm_start=None, embedding=None, n_components=50,
+    eigen_solver='arpack'
 ):
     """
     Cluster a timeseries dataset based on its relationship
@@ -324,8 +1596,9 @@ def cross_cluster_timeseries(
     roi_mask_data : array_like
         An array that contains a binary mask of the region of interest (ROI)
         being parcellated.
-    n_clusters : integer
-        Number of clusters
+    n_clusters : integer or list of integers
+        Number of clusters. With a list, the data is clustered at each of
+        them, see `cluster_similarity`.
     similarity_metric : {'euclidean', 'correlation', 'minkowski', 'cityblock',
                          'seuclidean'}
         Type of similarity measure for distance matrix.  The pairwise similarity
@@ -335,15 +1608,30 @@ def cross_cluster_timeseries(
     affinity_threshold : float
         Threshold of similarity metric when 'correlation' similarity metric
         is used.
-    cluster_method : {'ward', 'spectral', 'kmeans', 'gaussianmixture'}
+    cluster_method : {'ward', 'spectral', 'kmeans', 'minibatch_kmeans',
+                      'gaussianmixture'}
         A string that says which cluster method to use.
     random_state : integer
         the random state to seed the bootstrap
+    workspace : SimilarityWorkspace, optional
+        Preallocated buffers for the distance and similarity matrices, shared
+        across calls.
+    warm_start : WarmStart, optional
+        Centroids to initialize k-means with, updated after clustering.
+    embedding : {None, 'svd', 'spectral'}, optional
+        Cluster the voxels on a low-rank embedding of the similarity matrix
+        of `n_components` dimensions, see `cluster_similarity`
+    n_components : integer, optional
+        Number of dimensions of the embedding
+    eigen_solver : {'arpack', 'lobpcg', 'amg'}, optional
+        Eigensolver of spectral clustering and of the spectral embedding,
+        'amg' needs pyamg to be installed
 
     Returns
     -------
     y_pred : array_like
-        Predicted cluster labels
+        Predicted cluster labels, one row per number of clusters when
+        `n_clusters` is a list
 
 
     Examples
@@ -370,82 +1658,45 @@ def cross_cluster_timeseries(
     https://docs.scipy.org/doc/scipy/reference/generated/scipy.spatial.distance.cdist.html#scipy.spatial.distance.cdist
     http://scikit-learn.org/stable/modules/clustering.html#spectral-clustering
 
-    """
-
-    from scipy.spatial.distance import pdist, cdist, squareform
-    from sklearn.preprocessing import normalize
-    from sklearn.feature_extraction import image
-    from sklearn.cluster import FeatureAgglomeration, KMeans, SpectralClustering
-    from sklearn.mixture import GaussianMixture
-
-
-    dist_btwn_data_1_2 = np.array(
-        cdist(data1.T, data2.T, metric=similarity_metric)
-    )
-
-    max_dist = np.nanmax(dist_btwn_data_1_2)
-    dist_btwn_data_1_2[np.isnan(dist_btwn_data_1_2)] = max_dist
-
-    dist_of_1 = pdist(
-        dist_btwn_data_1_2, metric='euclidean'
-    )
-    dist_matrix = squareform(dist_of_1)
-    sim_matrix = 1 - normalize(dist_matrix, norm='max')
-    sim_matrix[sim_matrix < affinity_threshold] = 0
-
-    if cluster_method == 'ward':
-        
-        if roi_mask_data is not None:
-            shape = roi_mask_data.shape
-            connectivity = image.grid_to_graph(
-                n_x=shape[0], n_y=shape[1],
-                n_z=shape[2], mask=roi_mask_data
-            )
-
-            ward = FeatureAgglomeration(
-                n_clusters=n_clusters,
-                connectivity=connectivity,
-                linkage='ward'
-            )
-            ward.fit(sim_matrix)
-            y_pred = ward.labels_.astype(np.int)
-
-        else:
-            ward = FeatureAgglomeration(
-                n_clusters=n_clusters,
-                affinity='euclidean',
-                linkage='ward'
-            )
-            ward.fit(sim_matrix)
-            y_pred = ward.labels_.astype(np.int)
-
-    elif cluster_method == 'spectral':
-        spectral = SpectralClustering(
-            n_clusters, eigen_solver='arpack',
-            affinity="precomputed", assign_labels='discretize',
-            random_state=random_state
-        )
-        spectral.fit(sim_matrix)
-        y_pred = spectral.labels_.astype(np.int)
+    """
 
-    elif cluster_method == 'kmeans':
-        kmeans = KMeans(
-            n_clusters=n_clusters, init='k-means++',
-            n_init=10, random_state=random_state
+    from scipy.spatial.distance import pdist, cdist, squareform
+    import PyBASC.utils as utils
+
+    V1, V2 = data1.shape[1], data2.shape[1]
+
+    if workspace is None:
+        dist_btwn_data_1_2 = cdist(data1.T, data2.T, metric=similarity_metric)
+    else:
+        dist_btwn_data_1_2 = cdist(
+            data1.T, data2.T, metric=similarity_metric,
+            out=workspace.buffer('cross_distance', (V1, V2))
         )
 
-        kmeans.fit(sim_matrix)
-        y_pred = kmeans.labels_.astype(np.int)
+    max_dist = np.nanmax(dist_btwn_data_1_2)
+    dist_btwn_data_1_2[np.isnan(dist_btwn_data_1_2)] = max_dist
 
-    elif cluster_method == 'gaussianmixture':
-        gaussianmixture = GaussianMixture(
-            n_components=n_clusters,
-            init_params='kmeans',
-            random_state=random_state
+    dist_of_1 = pdist(
+        dist_btwn_data_1_2, metric='euclidean'
+    )
+
+    if workspace is None:
+        dist_matrix = squareform(dist_of_1)
+    else:
+        dist_matrix = utils._squareform_into(
+            dist_of_1, workspace.buffer('similarity', (V1, V1))
         )
-        y_pred = gaussianmixture.fit_predict(sim_matrix)
 
-    return y_pred
+    sim_matrix = utils._similarity_from_distance(
+        dist_matrix, affinity_threshold
+    )
+
+    return utils.cluster_similarity(
+        sim_matrix, roi_mask_data, n_clusters,
+        cluster_method=cluster_method, random_state=random_state,
+        warm_start=warm_start, embedding=embedding,
+        n_components=n_components, eigen_solver=eigen_solver
+    )
 
 
 def adjacency_matrix(cluster_pred):
@@ -475,39 +1726,241 @@ def adjacency_matrix(cluster_pred):
 
     """
     from scipy import sparse
-    
-    x = cluster_pred.copy()
-    if(len(x.shape) == 1):
-        x = x[:, np.newaxis]
 
-    # Force the cluster indexing to be positive integers
-    if x.min() <= 0:
-        x += -x.min() + 1
+    x = np.asarray(cluster_pred).ravel()
 
-    A = np.dot(x**-1., x.T) == 1
+    # Voxels are adjacent when they share a label; comparing the labels
+    # directly avoids a float outer product
+    A = x[:, np.newaxis] == x[np.newaxis, :]
     A = sparse.csr_matrix(A, dtype=bool)
     return A
 
 
-def cluster_matrix_average(M, cluster_assignments):
+class CoassignmentAccumulator(object):
+    """
+    Count how often each pair of features is assigned to the same cluster
+    over a series of clusterings.
+
+    The counts are accumulated straight from the label vectors, one block of
+    co-assigned features per cluster, in the smallest unsigned integer type
+    able to hold `n_bootstraps`.
+
+    Parameters
+    ----------
+    n_features : integer
+        Number of clustered features `V`
+    n_bootstraps : integer
+        Number of clusterings that will be added
+
+    Examples
+    --------
+    >>> acc = CoassignmentAccumulator(4, 2)
+    >>> acc.add(np.array([0, 0, 1, 1]))
+    >>> acc.add(np.array([0, 1, 1, 1]))
+    >>> acc.stability()
+    array([[100,  50,   0,   0],
+           [ 50, 100,  50,  50],
+           [  0,  50, 100, 100],
+           [  0,  50, 100, 100]], dtype=uint8)
+
+    """
+
+    def __init__(self, n_features, n_bootstraps):
+        self.n_features = n_features
+        self.n_bootstraps = n_bootstraps
+        self.n_added = 0
+        self.counts = np.zeros(
+            (n_features, n_features),
+            dtype=np.min_scalar_type(max(n_bootstraps, 1))
+        )
+        if self.counts.dtype.kind != 'u':
+            self.counts = self.counts.astype('uint32')
+
+    def add(self, labels):
+        """
+        Add the co-assignments of one clustering.
+
+        Parameters
+        ----------
+        labels : array_like
+            Cluster label of each feature, of shape (`V`,) or (`V`, `1`)
+        """
+        labels = np.asarray(labels).ravel()
+        if labels.shape[0] != self.n_features:
+            raise ValueError(
+                'Expected {} labels, got {}'.format(
+                    self.n_features, labels.shape[0]
+                )
+            )
+
+        order = np.argsort(labels, kind='mergesort')
+        sorted_labels = labels[order]
+        bounds = np.flatnonzero(np.diff(sorted_labels)) + 1
+        for idx in np.split(order, bounds):
+            self.counts[np.ix_(idx, idx)] += 1
+
+        self.n_added += 1
+
+    def stability(self, n_bootstraps=None, block_size=1024):
+        """
+        Get the stability matrix, the percentage of clusterings in which each
+        pair of features was co-assigned, rounded down.
+
+        Parameters
+        ----------
+        n_bootstraps : integer, optional
+            Number of clusterings to divide by, defaults to the one given at
+            construction
+        block_size : integer
+            Number of rows converted at a time
+
+        Returns
+        -------
+        S : array_like
+            A uint8 matrix of shape (`V`, `V`)
+        """
+        if n_bootstraps is None:
+            n_bootstraps = self.n_bootstraps
+
+        S = np.empty(self.counts.shape, dtype='uint8')
+        for start in range(0, self.n_features, block_size):
+            stop = min(start + block_size, self.n_features)
+            block = self.counts[start:stop].astype('uint32')
+            block *= 100
+            block //= n_bootstraps
+            S[start:stop] = block
+
+        return S
+
+
+def stability_matrix_from_labels(bootstrap_labels, block_size=256):
+    """
+    Calculate the stability matrix from the cluster labels of a series of
+    bootstraps, the percentage of bootstraps in which each pair of features
+    was assigned to the same cluster, rounded down.
+
+    The co-assignments are counted over blocks of rows, comparing the labels
+    of all bootstraps at once, so the memory used is bounded by the block
+    size instead of by the number of bootstraps.
+
+    Parameters
+    ----------
+    bootstrap_labels : array_like
+        A matrix of shape (`B`, `V`) with the labels of the `V` features in
+        each of the `B` bootstraps
+    block_size : integer
+        Number of rows counted at a time
+
+    Returns
+    -------
+    S : array_like
+        A uint8 matrix of shape (`V`, `V`)
+
+    Examples
+    --------
+    >>> labels = np.array([[0, 0, 1], [0, 1, 1]])
+    >>> stability_matrix_from_labels(labels)
+    array([[100,  50,   0],
+           [ 50, 100,  50],
+           [  0,  50, 100]], dtype=uint8)
+
+    """
+    bootstrap_labels = np.asarray(bootstrap_labels)
+    if bootstrap_labels.ndim == 1:
+        bootstrap_labels = bootstrap_labels[np.newaxis, :]
+
+    n_bootstraps, V = bootstrap_labels.shape
+
+    # keep the boolean comparison of a chunk of bootstraps around 16M entries
+    block_size = max(1, min(block_size, V))
+    chunk = max(1, (1 << 24) // (block_size * max(V, 1)))
+
+    S = np.empty((V, V), dtype='uint8')
+    counts = np.empty((block_size, V), dtype='uint32')
+    for start in range(0, V, block_size):
+        stop = min(start + block_size, V)
+        block_counts = counts[:stop - start]
+        block_counts.fill(0)
+        for b in range(0, n_bootstraps, chunk):
+            L = bootstrap_labels[b:b + chunk]
+            block_counts += (
+                L[:, start:stop, np.newaxis] == L[:, np.newaxis, :]
+            ).sum(axis=0, dtype='uint32')
+
+        block_counts *= 100
+        block_counts //= n_bootstraps
+        S[start:stop] = block_counts
+
+    return S
+
+
+def cluster_one_hot(cluster_assignments):
+    """
+    One-hot encoding of cluster assignments.
+
+    Parameters
+    ----------
+    cluster_assignments : array_like
+        Length `V` array of cluster labels
+
+    Returns
+    -------
+    cluster_ids : array_like
+        The `C` sorted unique cluster labels
+    cluster_index : array_like
+        Length `V` array of the position of each voxel's label in
+        `cluster_ids`
+    Z : array_like
+        Float array of shape (`V`, `C`), 1 where a voxel is in a cluster
+
+    """
+    cluster_assignments = np.asarray(cluster_assignments).ravel()
+    cluster_ids, cluster_index = np.unique(
+        cluster_assignments, return_inverse=True
+    )
+    Z = np.zeros((cluster_assignments.shape[0], cluster_ids.shape[0]),
+                 dtype='float64')
+    Z[np.arange(cluster_assignments.shape[0]), cluster_index] = 1
+    return cluster_ids, cluster_index, Z
+
+
+def cluster_matrix_average(M, cluster_assignments, block_size=None,
+                           one_hot=None):
     """
     Calculate the average element value within a similarity matrix for each
     cluster assignment, a measure of within cluster similarity.
     Self similarity (diagonal of similarity matrix) is removed.
 
+    With `Z` the one-hot matrix of the cluster assignments, the sums of each
+    voxel over each cluster are `M @ Z`, and the within-cluster sums are the
+    diagonal of `Z.T @ M @ Z` minus the diagonal of `M` summed per cluster.
+    `M` is read in blocks of rows, so it can be of any numeric type,
+    memory-mapped, sparse or a `PackedStabilityMatrix`. A packed `M` is read
+    in blocks of its upper triangle `U`, adding both `U @ Z` and the
+    transposed contribution `U.T @ Z`.
+
     Parameters
     ----------
     M : array_like
         A stability matrix.
     cluster_assignments : array_like
         A cluster labels file
+    block_size : integer, optional
+        Number of rows of `M` converted to float at a time
+    one_hot : tuple, optional
+        The output of `cluster_one_hot` for `cluster_assignments`, to share
+        it between matrices clustered with the same assignments
         
     Returns
     -------
     
     vox_cluster_label: array_like
         An output that has the mean stability for each voxel by each cluster
-        label.
+        label. Each voxel of a cluster gets the mean within-cluster stability
+        for its own cluster, 0 for single voxel clusters.
+    K_mask : WithinClusterMask
+        The pairs of distinct voxels in the same cluster, built from the
+        labels on request.
 
 
     Examples
@@ -515,55 +1968,150 @@ def cluster_matrix_average(M, cluster_assignments):
     >>> import numpy as np
     >>> S = np.arange(25).reshape(5, 5)
     >>> assign = np.array([0, 0, 0, 1, 1])
-    >>> basc.cluster_matrix_average(S, assign)
-    array([  6.,   6.,   6.,  21.,  21.])
+    >>> cluster_matrix_average(S, assign)[0]
+    array([[ 6. ,  6. ,  6. , 16. , 21. ],
+           [ 3.5,  8.5, 13.5, 21. , 21. ]])
 
     """
+    import PyBASC.utils as utils
+
+    cluster_assignments = np.asarray(cluster_assignments).ravel()
+    V = cluster_assignments.shape[0]
+    if block_size is None:
+        block_size = max(1, (1 << 19) // max(V, 1))
+
+    if one_hot is None:
+        one_hot = utils.cluster_one_hot(cluster_assignments)
+    cluster_ids, cluster_index, Z = one_hot
+    cluster_sizes = Z.sum(axis=0)
+
+    # Sums of each voxel over the voxels of each cluster, M @ Z
+    MZ = np.empty((V, cluster_ids.shape[0]), dtype='float64')
+    diagonal = np.empty(V, dtype='float64')
+    if isinstance(M, utils.PackedStabilityMatrix):
+        MZ[:] = 0
+        for start in range(0, V, block_size):
+            stop = min(start + block_size, V)
+            upper = M.upper_rows(start, stop).astype('float64')
+            if np.isnan(upper).any():
+                raise ValueError('M matrix has NaN values')
+
+            diagonal[start:stop] = upper[
+                np.arange(stop - start), np.arange(stop - start)
+            ]
+            MZ[start:stop] += np.dot(upper, Z[start:])
+            MZ[start:] += np.dot(upper.T, Z[start:stop])
+
+        # the diagonal is in both the upper triangle and its transpose
+        MZ -= diagonal[:, np.newaxis] * Z
+
+    else:
+        for start in range(0, V, block_size):
+            stop = min(start + block_size, V)
+            rows = np.asarray(
+                utils._stability_rows(M, start, stop), dtype='float64'
+            )
+            if np.isnan(rows).any():
+                raise ValueError('M matrix has NaN values')
+
+            np.dot(rows, Z, out=MZ[start:stop])
+            diagonal[start:stop] = rows[
+                np.arange(stop - start), np.arange(start, stop)
+            ]
+
+    vox_cluster_label = (MZ / cluster_sizes).T
+
+    # Within-cluster sums without the self similarities, diag(Z.T @ M @ Z)
+    # minus the diagonal of M summed over each cluster
+    within_sums = np.einsum('vk,vk->k', Z, MZ) - np.dot(diagonal, Z)
+    within_pairs = cluster_sizes * (cluster_sizes - 1)
+    within_means = np.zeros(cluster_ids.shape[0])
+    np.divide(
+        within_sums, within_pairs, out=within_means, where=within_pairs > 0
+    )
+
+    # every voxel of a cluster gets the within-cluster mean, 0 for single
+    # voxel clusters
+    vox_cluster_label[cluster_index, np.arange(V)] = \
+        within_means[cluster_index]
 
-    # TODO FIGURE OUT TEST FOR THIS FUNCTION
+    return vox_cluster_label, utils.WithinClusterMask(cluster_assignments)
 
-    if np.any(np.isnan(M)):
-        raise ValueError('M matrix has NaN values')
 
-    cluster_ids = np.unique(cluster_assignments)
-    vox_cluster_label = np.zeros((
-        cluster_ids.shape[0],
-        cluster_assignments.shape[0]
-    ), dtype='float64')
+class WithinClusterMask(object):
+    """
+    Mask of the pairs of distinct voxels assigned to the same cluster, kept
+    as the cluster labels and only built as a dense matrix on request.
 
-    K_mask = np.zeros(M.shape)
+    Parameters
+    ----------
+    cluster_assignments : array_like
+        The cluster label of each voxel
 
-    for s_idx, cluster_id in enumerate(cluster_ids):
-        vox_cluster_label[s_idx, :] = \
-            M[:, cluster_assignments == cluster_id].mean(axis=1)
+    Examples
+    --------
+    >>> WithinClusterMask(np.array([0, 0, 1])).toarray()
+    array([[0., 1., 0.],
+           [1., 0., 0.],
+           [0., 0., 0.]])
 
-        k = (cluster_assignments == cluster_id)[:, np.newaxis].astype(int)
+    """
 
-        K = np.dot(k, k.T)
-        K[np.diag_indices_from(K)] = 0
+    def __init__(self, cluster_assignments):
+        self.cluster_assignments = np.asarray(cluster_assignments).ravel()
 
-        K_mask += K
+    @property
+    def shape(self):
+        V = self.cluster_assignments.shape[0]
+        return (V, V)
 
-        # Voxel with its own cluster
-        if K.sum() == 0:
-            vox_cluster_label[k[:, 0]] = 0.0
-        else:
-            vox_cluster_label[s_idx, k[:, 0].T] = \
-                M[K.astype(bool)].mean()
+    def rows(self, start, stop, dtype='float64'):
+        """
+        Get the dense rows `start` to `stop` of the mask.
+        """
+        labels = self.cluster_assignments
+        mask = (labels[start:stop, np.newaxis] == labels[np.newaxis, :])
+        mask[np.arange(stop - start), np.arange(start, stop)] = False
+        return mask.astype(dtype)
+
+    def toarray(self, dtype='float64'):
+        """
+        Get the dense mask.
+        """
+        return self.rows(0, self.shape[0], dtype=dtype)
 
-    return vox_cluster_label, K_mask
+    def astype(self, dtype):
+        return self.toarray(dtype=dtype)
 
 
-def compare_stability_matrices(ism_a, ism_b):
+def compare_stability_matrices(ism_a, ism_b, labels=None, block_size=None):
     """
     Calculate the distance between two different stability maps
+
+    The similarity is the correlation between the two matrices after each
+    of their rows is scaled to unit L2 norm. It is computed in a single pass
+    over blocks of rows, merging the means and centered sums of each block,
+    so only a block of each matrix is ever converted to float. When either
+    matrix is a `PackedStabilityMatrix`, both are taken as symmetric and read
+    as blocks of their upper triangle, in a first pass for the row norms and
+    a second one for the sums.
     
     Parameters
     ----------
     ism_a : array_like
-        A numpy stability matrix of shape (`V`, `V`), `V` voxels.
+        A numpy stability matrix of shape (`V`, `V`), `V` voxels. It can be
+        of any numeric type, memory-mapped, sparse or a
+        `PackedStabilityMatrix`.
     ism_b : array_like
         A numpy stability matrix of shape (`V`, `V`), `V` voxels.
+    labels : array_like, optional
+        Supervoxel label of each of the `V` voxels. When given, `ism_a` and
+        `ism_b` are supervoxel matrices of shape (`K`, `K`) and the
+        similarity of their voxel-wise expansions (see `expand_ism`) is
+        computed without expanding them.
+    block_size : integer, optional
+        Number of rows processed at a time, by default about 4 MB of float64
+        per matrix
 
     Returns
     -------
@@ -571,21 +2119,218 @@ def compare_stability_matrices(ism_a, ism_b):
         The distance between the two input matrices.
 
     """
-    from sklearn.preprocessing import normalize
-    from scipy.spatial.distance import correlation
+    if labels is not None:
+        return _compare_supervoxel_matrices(ism_a, ism_b, labels)
+
+    V = ism_a.shape[0]
+    if block_size is None:
+        block_size = max(1, (1 << 19) // max(V, 1))
 
-    ism_a = normalize(ism_a, norm='l2')
-    ism_b = normalize(ism_b, norm='l2')
-    distance = correlation(ism_a.ravel(), ism_b.ravel())
-    similarity = 1 - distance
+    if isinstance(ism_a, PackedStabilityMatrix) or \
+            isinstance(ism_b, PackedStabilityMatrix):
+        blocks = _upper_block_moments(ism_a, ism_b, block_size)
+    else:
+        blocks = _row_block_moments(ism_a, ism_b, block_size)
+
+    n = 0
+    mean_a = mean_b = 0.0
+    c_aa = c_bb = c_ab = 0.0
+    for n_block, block_mean_a, block_mean_b, b_aa, b_bb, b_ab in blocks:
+
+        # merge the centered sums of the block with the running ones
+        delta_a = block_mean_a - mean_a
+        delta_b = block_mean_b - mean_b
+        n_total = n + n_block
+        factor = float(n) * n_block / n_total
+
+        c_aa += b_aa + delta_a * delta_a * factor
+        c_bb += b_bb + delta_b * delta_b * factor
+        c_ab += b_ab + delta_a * delta_b * factor
+        mean_a += delta_a * n_block / n_total
+        mean_b += delta_b * n_block / n_total
+        n = n_total
+
+    similarity = c_ab / np.sqrt(c_aa * c_bb)
 
     return similarity
 
 
+def _stability_rows(ism, start, stop):
+    """
+    Dense rows `start` to `stop` of a stability matrix given as an array,
+    a sparse matrix or a `PackedStabilityMatrix`.
+    """
+    import scipy.sparse
+    import PyBASC.utils as utils
+
+    if isinstance(ism, utils.PackedStabilityMatrix):
+        return ism.rows(start, stop)
+    elif scipy.sparse.issparse(ism):
+        return ism[start:stop].toarray()
+    return ism[start:stop]
+
+
+def _row_block_moments(ism_a, ism_b, block_size):
+    """
+    Size, means and centered sums of squares and products of the
+    row-normalized entries of two stability matrices, one block of rows at a
+    time.
+    """
+    V = ism_a.shape[0]
+    for start in range(0, V, block_size):
+        stop = min(start + block_size, V)
+        a = _normalized_rows(ism_a, start, stop).ravel()
+        b = _normalized_rows(ism_b, start, stop).ravel()
+
+        mean_a = a.mean()
+        mean_b = b.mean()
+        a -= mean_a
+        b -= mean_b
+
+        yield (a.size, mean_a, mean_b,
+               np.dot(a, a), np.dot(b, b), np.dot(a, b))
+
+
+def _upper_rows(ism, start, stop):
+    """
+    Rows `start` to `stop` of a symmetric stability matrix from the column
+    `start` on, with the entries below the diagonal set to 0, as float64.
+    See `PackedStabilityMatrix.upper_rows`.
+    """
+    import PyBASC.utils as utils
+
+    if isinstance(ism, utils.PackedStabilityMatrix):
+        return ism.upper_rows(start, stop).astype('float64')
+    return np.triu(np.asarray(
+        utils._stability_rows(ism, start, stop)[:, start:], dtype='float64'
+    ))
+
+
+def _upper_block_moments(ism_a, ism_b, block_size):
+    """
+    Same as `_row_block_moments` for symmetric matrices, read as blocks of
+    their upper triangles. Each entry above the diagonal stands for itself,
+    scaled by the norm of its row, and for its transpose, scaled by the norm
+    of its column. The row norms are computed in a first pass.
+    """
+    V = ism_a.shape[0]
+
+    # squared row norms, from the rows and the columns of the upper triangle
+    norms = []
+    for ism in (ism_a, ism_b):
+        squares = np.zeros(V)
+        for start in range(0, V, block_size):
+            stop = min(start + block_size, V)
+            upper = _upper_rows(ism, start, stop)
+            upper *= upper
+            squares[start:stop] += upper.sum(axis=1)
+            squares[start:] += upper.sum(axis=0)
+            squares[start:stop] -= np.diagonal(upper)
+        norm = np.sqrt(squares)
+        norm[norm == 0] = 1
+        norms.append(norm)
+
+    for start in range(0, V, block_size):
+        stop = min(start + block_size, V)
+        n_rows = stop - start
+        diagonal = np.arange(n_rows)
+
+        # the entries of the block, each one scaled by its row norm, then by
+        # its column norm without the diagonal which is only counted once.
+        # The zeros below the diagonal are not entries, they are set back to
+        # zero once the entries are centered.
+        below_row = np.tril_indices(n_rows, -1)
+        below_column = np.tril_indices(n_rows)
+        n_block = n_rows * (2 * (V - start) - n_rows)
+
+        moments = [n_block]
+        entries = []
+        for ism, norm in zip((ism_a, ism_b), norms):
+            by_row = _upper_rows(ism, start, stop)
+            by_column = by_row / norm[start:]
+            by_row /= norm[start:stop, np.newaxis]
+            by_column[diagonal, diagonal] = 0
+
+            mean = (by_row.sum() + by_column.sum()) / n_block
+            by_row -= mean
+            by_column -= mean
+            by_row[below_row] = 0
+            by_column[below_column] = 0
+
+            moments.append(mean)
+            entries.append((by_row.ravel(), by_column.ravel()))
+
+        (a_row, a_column), (b_row, b_column) = entries
+        moments += [
+            np.dot(a_row, a_row) + np.dot(a_column, a_column),
+            np.dot(b_row, b_row) + np.dot(b_column, b_column),
+            np.dot(a_row, b_row) + np.dot(a_column, b_column),
+        ]
+
+        yield tuple(moments)
+
+
+def _normalized_rows(ism, start, stop):
+    """
+    Rows `start` to `stop` of a stability matrix as float64, each scaled to
+    unit L2 norm. All-zero rows are left as they are.
+    """
+    rows = np.asarray(_stability_rows(ism, start, stop), dtype='float64')
+    norms = np.sqrt(np.einsum('ij,ij->i', rows, rows))
+    norms[norms == 0] = 1
+    rows /= norms[:, np.newaxis]
+
+    return rows
+
+
+def _compare_supervoxel_matrices(ism_a, ism_b, labels):
+    """
+    Similarity of the voxel-wise expansions of two supervoxel matrices.
+
+    Every supervoxel pair (p, q) stands for n_p * n_q identical voxel pairs,
+    and the voxel rows of supervoxel p share the norm of the weighted row
+    sqrt(sum_q n_q a_pq ** 2). The correlation of the row-normalized
+    matrices is therefore a weighted correlation over the `K` x `K` entries.
+    """
+    import scipy.sparse
+    import PyBASC.utils as utils
+
+    def dense(ism):
+        if scipy.sparse.issparse(ism) or \
+                isinstance(ism, utils.PackedStabilityMatrix):
+            return ism.toarray()
+        return ism
+
+    ism_a = dense(ism_a)
+    ism_b = dense(ism_b)
+
+    labels = np.asarray(labels).ravel()
+    K = ism_a.shape[0]
+    sizes = np.bincount(labels, minlength=K).astype('float64')
+    weights = np.outer(sizes, sizes)
+    n_elements = weights.sum()
+
+    def normalized(ism):
+        ism = np.asarray(ism, dtype='float64')
+        norms = np.sqrt(np.dot(ism ** 2, sizes))
+        norms[norms == 0] = 1
+        ism = ism / norms[:, np.newaxis]
+        return ism - (weights * ism).sum() / n_elements
+
+    ism_a = normalized(ism_a)
+    ism_b = normalized(ism_b)
+
+    return (weights * ism_a * ism_b).sum() / np.sqrt(
+        (weights * ism_a ** 2).sum() * (weights * ism_b ** 2).sum()
+    )
+
+
 def individual_stability_matrix(
     Y1, roi_mask_data, n_bootstraps, n_clusters, similarity_metric,
     Y2=None, cross_cluster=False, cbb_block_size=None, blocklength=1,
-    affinity_threshold=0.0, cluster_method='ward', random_state=None
+    affinity_threshold=0.0, cluster_method='ward', random_state=None,
+    deferred=False, return_labels=False, n_jobs=1, warm_start=False,
+    embedding=None, n_components=50, eigen_solver='arpack', n_neighbors=10
 ):
     """
     Calculate the individual stability matrix of a single subject by
@@ -600,8 +2345,10 @@ def individual_stability_matrix(
         being parcellated.
     n_bootstraps : integer
         Number of bootstrap samples
-    n_clusters : integer
-        Number of clusters
+    n_clusters : integer or list of integers
+        Number of clusters. With a list of `K` numbers of clusters, each
+        bootstrap is resampled and its similarity computed once, and the
+        co-assignments are counted for every number of clusters.
     similarity_metric : {'k_neighbors', 'correlation', 'data'}
         Type of similarity measure for spectral clustering. The pairwise
         similarity measure specifies the edges of the similarity graph.
@@ -622,16 +2369,48 @@ def individual_stability_matrix(
     affinity_threshold : float, optional
         Minimum threshold for similarity matrix based on correlation
         to create an edge
-    cluster_method : {'ward', 'spectral', 'kmeans', 'gaussianmixture'}
+    cluster_method : {'ward', 'spectral', 'kmeans', 'minibatch_kmeans',
+                      'gaussianmixture'}
         A string that says which cluster method to use.
     random_state : integer
         the random state to seed the bootstrap
+    deferred : boolean, optional
+        Keep only the labels of each bootstrap and count the co-assignments
+        once all bootstraps are clustered, instead of after each bootstrap
+    return_labels : boolean, optional
+        Also return the cluster labels of every bootstrap
+    n_jobs : integer, optional
+        Number of processes the bootstraps are spread over. With more than
+        one job, every bootstrap draws from its own random state seeded from
+        `random_state`, so the result is the same for any number of jobs
+        above one, unless `warm_start` is set. With a single job, the
+        bootstraps draw from `random_state` in turn, so the result differs
+        from the parallel one for the same `random_state`.
+    warm_start : boolean, optional
+        For the k-means methods, start each bootstrap from the centroids of
+        the previous one with a single run, instead of random restarts. With
+        several jobs, the bootstraps of each job form their own chain.
+    embedding : {None, 'svd', 'spectral'}, optional
+        Cluster each bootstrap on a low-rank embedding of its similarity
+        matrix, see `cluster_similarity`
+    n_components : integer, optional
+        Number of dimensions of the embedding
+    eigen_solver : {'arpack', 'lobpcg', 'amg'}, optional
+        Eigensolver of spectral clustering and of the spectral embedding,
+        'amg' needs pyamg to be installed
+    n_neighbors : integer, optional
+        Number of neighbours of each voxel with the 'k_neighbors' metric
 
     Returns
     -------
     S : array_like
         A matrix of shape (`V1`, `V1`), each element v1_{ij} representing
-        the stability of the adjacency of voxel i with voxel j
+        the stability of the adjacency of voxel i with voxel j, or a list of
+        `K` such matrices when `n_clusters` is a list
+    bootstrap_labels : array_like
+        A matrix of shape (`n_bootstraps`, `V1`) with the labels of each
+        bootstrap, or (`n_bootstraps`, `K`, `V1`) when `n_clusters` is a
+        list, only returned if `return_labels` is set
     """
 
     import numpy as np
@@ -653,94 +2432,366 @@ def individual_stability_matrix(
     # TODO @AKI review SPATIAL CONSTRAINT EXPERIMENT
     roi_mask_data = None
 
-    S = np.zeros((V1, V1))
+    if n_jobs != 1 and n_bootstraps > 1:
+        return utils.parallel_individual_stability_matrix(
+            Y1, n_bootstraps, n_clusters, similarity_metric, Y2=Y2,
+            cross_cluster=cross_cluster, cbb_block_size=cbb_block_size,
+            affinity_threshold=affinity_threshold,
+            cluster_method=cluster_method, random_state=random_state,
+            deferred=deferred, return_labels=return_labels, n_jobs=n_jobs,
+            warm_start=warm_start, embedding=embedding,
+            n_components=n_components, eigen_solver=eigen_solver,
+            n_neighbors=n_neighbors
+        )
+
+    multiple_k = isinstance(n_clusters, (list, tuple, np.ndarray))
+    n_k = len(n_clusters) if multiple_k else 1
+
+    bootstrap_labels = np.empty((n_bootstraps, n_k, V1), dtype='int32')
+    if not deferred:
+        coassignments = [
+            utils.CoassignmentAccumulator(V1, n_bootstraps)
+            for _ in range(n_k)
+        ]
+
+    # similarity buffers are allocated once and refilled at every bootstrap,
+    # in float32 since the stability only depends on the bootstrap labels
+    workspace = utils.SimilarityWorkspace()
+    warm_start = utils.WarmStart() if warm_start else None
+
+    if n_bootstraps == 1:
+        bootstraps = [(Y1, None)]
+    else:
+        # Ward clustering does not draw from the random state, so every
+        # resample can be drawn up front; the other methods interleave their
+        # own draws with the bootstrap ones.
+        bootstraps = utils.timeseries_bootstrap_generator(
+            Y1, cbb_block_size, n_bootstraps, random_state=random_state,
+            presample=cluster_method.lower() == 'ward'
+        )
 
     if cross_cluster:
         
-        for _ in range(n_bootstraps):
+        for i, (Y_bootstrap, block_mask) in enumerate(bootstraps):
             if n_bootstraps == 1:
-                Y_bootstrap = Y1
                 Y_cxc_bootstrap = Y2
 
             else:
-                Y_bootstrap, block_mask = utils.timeseries_bootstrap(
-                    Y1, cbb_block_size, random_state=random_state
-                )
-                Y_cxc_bootstrap = Y2[block_mask.astype('int'), :]
-
-            S += utils.adjacency_matrix(
-                utils.cross_cluster_timeseries(
-                    Y_bootstrap, Y_cxc_bootstrap, roi_mask_data, n_clusters,
-                    similarity_metric=similarity_metric,
-                    affinity_threshold=affinity_threshold,
-                    cluster_method=cluster_method,
-                    random_state=random_state
-                )
-            
-            )
+                Y_cxc_bootstrap = Y2[block_mask, :]
+
+            bootstrap_labels[i] = utils.cross_cluster_timeseries(
+                Y_bootstrap, Y_cxc_bootstrap, roi_mask_data, n_clusters,
+                similarity_metric=similarity_metric,
+                affinity_threshold=affinity_threshold,
+                cluster_method=cluster_method,
+                random_state=random_state,
+                workspace=workspace,
+                warm_start=warm_start,
+                embedding=embedding,
+                n_components=n_components,
+                eigen_solver=eigen_solver
+            ).reshape(n_k, V1)
+            if not deferred:
+                for accumulator, labels in zip(coassignments,
+                                               bootstrap_labels[i]):
+                    accumulator.add(labels)
         
     else:
-        for _ in range(n_bootstraps):
-            if n_bootstraps == 1:
-                Y_bootstrap = Y1
+        for i, (Y_bootstrap, _) in enumerate(bootstraps):
+            bootstrap_labels[i] = utils.cluster_timeseries(
+                Y_bootstrap, roi_mask_data, n_clusters,
+                similarity_metric=similarity_metric,
+                affinity_threshold=affinity_threshold,
+                cluster_method=cluster_method,
+                random_state=random_state,
+                workspace=workspace,
+                warm_start=warm_start,
+                embedding=embedding,
+                n_components=n_components,
+                eigen_solver=eigen_solver,
+                n_neighbors=n_neighbors,
+                dtype='float32'
+            ).reshape(n_k, V1)
+            if not deferred:
+                for accumulator, labels in zip(coassignments,
+                                               bootstrap_labels[i]):
+                    accumulator.add(labels)
+
+    if deferred:
+        S = [
+            utils.stability_matrix_from_labels(bootstrap_labels[:, k])
+            for k in range(n_k)
+        ]
+    else:
+        S = [accumulator.stability() for accumulator in coassignments]
 
-            else:
-                Y_bootstrap, _ = utils.timeseries_bootstrap(
-                    Y1, cbb_block_size, random_state=random_state
-                )
+    if not multiple_k:
+        S = S[0]
+        bootstrap_labels = bootstrap_labels[:, 0]
+
+    if return_labels:
+        return S, bootstrap_labels
+
+    return S
+
+
+def bootstrap_stability_counts(
+    Y1, seeds, n_clusters, similarity_metric, Y2=None, cross_cluster=False,
+    cbb_block_size=None, affinity_threshold=0.0, cluster_method='ward',
+    count=True, warm_start=False, embedding=None, n_components=50,
+    eigen_solver='arpack', n_neighbors=10
+):
+    """
+    Cluster one bootstrap per seed and count the co-assignments of the
+    clusterings. This is the unit of work of
+    `parallel_individual_stability_matrix`.
+
+    Parameters
+    ----------
+    Y1 : array_like
+        A matrix of shape (`N`, `V`) with `N` timepoints and `V` voxels
+    seeds : array_like
+        One random seed per bootstrap, used both to draw the bootstrap
+        sample and by the clustering
+    count : boolean, optional
+        Whether to count the co-assignments or only return the labels
+    warm_start : boolean, optional
+        Start the k-means of each bootstrap from the previous centroids
+
+    See `individual_stability_matrix` for the other parameters.
+
+    Returns
+    -------
+    bootstrap_labels : array_like
+        A matrix of shape (`len(seeds)`, `K`, `V`) with the labels of each
+        bootstrap at each of the `K` numbers of clusters, `K` being 1 when
+        `n_clusters` is an integer
+    counts : list of array_like or None
+        The co-assignment counts of shape (`V`, `V`) for each number of
+        clusters, None if `count` is not set
+    """
+    import numpy as np
+    import PyBASC.utils as utils
 
-            S += utils.adjacency_matrix(
-                utils.cluster_timeseries(
-                    Y_bootstrap, roi_mask_data, n_clusters,
-                    similarity_metric=similarity_metric,
-                    affinity_threshold=affinity_threshold,
-                    cluster_method=cluster_method,
-                    random_state=random_state
-                )[:, np.newaxis]
+    N1, V1 = Y1.shape
+    n_k = len(n_clusters) \
+        if isinstance(n_clusters, (list, tuple, np.ndarray)) else 1
+
+    bootstrap_labels = np.empty((len(seeds), n_k, V1), dtype='int32')
+    if count:
+        coassignments = [
+            utils.CoassignmentAccumulator(V1, len(seeds))
+            for _ in range(n_k)
+        ]
+
+    workspace = utils.SimilarityWorkspace()
+    warm_start = utils.WarmStart() if warm_start else None
+    for i, seed in enumerate(seeds):
+        random_state = np.random.RandomState(seed)
+        block_mask = utils.timeseries_bootstrap_indices(
+            N1, cbb_block_size, random_state=random_state
+        )[0]
+
+        if cross_cluster:
+            labels = utils.cross_cluster_timeseries(
+                Y1[block_mask], Y2[block_mask], None, n_clusters,
+                similarity_metric=similarity_metric,
+                affinity_threshold=affinity_threshold,
+                cluster_method=cluster_method,
+                random_state=random_state,
+                workspace=workspace,
+                warm_start=warm_start,
+                embedding=embedding,
+                n_components=n_components,
+                eigen_solver=eigen_solver
+            )
+        else:
+            labels = utils.cluster_timeseries(
+                Y1[block_mask], None, n_clusters,
+                similarity_metric=similarity_metric,
+                affinity_threshold=affinity_threshold,
+                cluster_method=cluster_method,
+                random_state=random_state,
+                workspace=workspace,
+                warm_start=warm_start,
+                embedding=embedding,
+                n_components=n_components,
+                eigen_solver=eigen_solver,
+                n_neighbors=n_neighbors,
+                dtype='float32'
             )
 
-    S *= 100
-    S //= n_bootstraps
-    S = S.astype("uint8")
+        bootstrap_labels[i] = labels.reshape(n_k, V1)
+        if count:
+            for accumulator, k_labels in zip(coassignments,
+                                             bootstrap_labels[i]):
+                accumulator.add(k_labels)
+
+    counts = [c.counts for c in coassignments] if count else None
+    return bootstrap_labels, counts
+
+
+def parallel_individual_stability_matrix(
+    Y1, n_bootstraps, n_clusters, similarity_metric, Y2=None,
+    cross_cluster=False, cbb_block_size=None, blocklength=1,
+    affinity_threshold=0.0, cluster_method='ward', random_state=None,
+    deferred=False, return_labels=False, n_jobs=-1, warm_start=False,
+    embedding=None, n_components=50, eigen_solver='arpack', n_neighbors=10
+):
+    """
+    Calculate the individual stability matrix of a single subject, spreading
+    its bootstraps over a pool of processes.
+
+    Each bootstrap gets its own seed, drawn from `random_state` up front, so
+    the result is reproducible and the same for any number of jobs. The
+    timeseries are memory-mapped by joblib instead of being pickled for every
+    worker, and each worker returns the co-assignment counts of its share of
+    bootstraps, which are summed at the end.
+
+    See `individual_stability_matrix` for the parameters.
+    """
+    import numpy as np
+    import PyBASC.utils as utils
+    from joblib import Parallel, delayed, effective_n_jobs
+
+    N1, V1 = Y1.shape
+    if cbb_block_size is None:
+        cbb_block_size = int(int(np.sqrt(N1)) * blocklength)
+
+    if random_state is None:
+        random_state = np.random.RandomState()
+    seeds = random_state.randint(utils.max_int, size=n_bootstraps)
+
+    n_chunks = min(effective_n_jobs(n_jobs), n_bootstraps)
+    results = Parallel(n_jobs=n_jobs, max_nbytes='1M')(
+        delayed(utils.bootstrap_stability_counts)(
+            Y1, chunk_seeds, n_clusters, similarity_metric, Y2=Y2,
+            cross_cluster=cross_cluster, cbb_block_size=cbb_block_size,
+            affinity_threshold=affinity_threshold,
+            cluster_method=cluster_method, count=not deferred,
+            warm_start=warm_start, embedding=embedding,
+            n_components=n_components, eigen_solver=eigen_solver,
+            n_neighbors=n_neighbors
+        )
+        for chunk_seeds in np.array_split(seeds, n_chunks)
+    )
+
+    bootstrap_labels = np.concatenate([labels for labels, _ in results])
+    n_k = bootstrap_labels.shape[1]
+    if deferred:
+        S = [
+            utils.stability_matrix_from_labels(bootstrap_labels[:, k])
+            for k in range(n_k)
+        ]
+    else:
+        S = []
+        for k in range(n_k):
+            coassignments = utils.CoassignmentAccumulator(V1, n_bootstraps)
+            for _, counts in results:
+                coassignments.counts += counts[k]
+            S.append(coassignments.stability())
+
+    if not isinstance(n_clusters, (list, tuple, np.ndarray)):
+        S = S[0]
+        bootstrap_labels = bootstrap_labels[:, 0]
+
+    if return_labels:
+        return S, bootstrap_labels
 
     return S
 
 
-def expand_ism(ism, Y1_labels):
+def expand_ism(ism, Y1_labels, rows=None, dense=False):
     """
     Calculates the voxel-wise stability matrix from a
     low dimensional representation.
+
+    Each voxel takes the stability of its supervoxel, so the expansion is a
+    gather of the supervoxel matrix by the voxel labels,
+    `ism[labels][:, labels]`, done in the type of `ism`.
     
     Parameters
     ----------
-    ism : individual stabilty matrix. A symmetric array
+    ism : individual stabilty matrix. A symmetric array or sparse matrix
     
     Y1_labels : 1-D array of voxel to supervoxel labels, 
                 created in initial data compression
+
+    rows : slice or array_like, optional
+        Only expand these voxel rows, returned as a dense array of shape
+        (`len(rows)`, `V`)
+
+    dense : boolean, optional
+        Return a dense array instead of a sparse matrix
     
     Returns
     -------
     A voxel-wise representation of the stabilty matrix.
 
+    Examples
+    --------
+    >>> ism = np.array([[100, 20], [20, 90]], dtype='uint8')
+    >>> expand_ism(ism, np.array([1, 0, 1]), dense=True)
+    array([[ 90,  20,  90],
+           [ 20, 100,  20],
+           [ 90,  20,  90]], dtype=uint8)
+
     """
     import numpy as np
     from scipy import sparse
-    voxel_num = len(Y1_labels)
-    voxel_ism = np.zeros((voxel_num, voxel_num))
 
-    transform_mat = np.zeros((ism.shape[0], voxel_num))
-    for i in range(voxel_num):
-        transform_mat[Y1_labels[i], i] = 1
-    
-    # TODO-  Analyze behavior of sparse matrix ism in the np.dot function
-    temp = np.dot(ism.toarray(), transform_mat)
-    voxel_ism = np.dot(temp.T, transform_mat)
-    sparse_voxel_ism = sparse.csr_matrix(voxel_ism, dtype=np.int8) 
+    if sparse.issparse(ism):
+        ism = ism.toarray()
+
+    labels = np.asarray(Y1_labels).ravel()
+
+    if rows is not None:
+        return ism[labels[rows]][:, labels]
+
+    voxel_ism = ism[np.ix_(labels, labels)]
+    if dense:
+        return voxel_ism
+
+    return sparse.csr_matrix(voxel_ism, dtype=np.int8)
+
+
+def expand_ism_blocks(ism, Y1_labels, block_size=1024):
+    """
+    Lazily expand a supervoxel stability matrix, see `expand_ism`, one block
+    of voxel rows at a time.
+
+    Parameters
+    ----------
+    ism : array_like or sparse matrix
+        A symmetric supervoxel stability matrix of shape (`K`, `K`)
+    Y1_labels : array_like
+        Supervoxel label of each of the `V` voxels
+    block_size : integer
+        Number of voxel rows of each block
+
+    Returns
+    -------
+    blocks : generator
+        Yields the `start` and `stop` voxel rows of each block together with
+        the dense block of shape (`stop` - `start`, `V`)
+    """
+    import numpy as np
+    from scipy import sparse
+    import PyBASC.utils as utils
 
-    return sparse_voxel_ism
+    if sparse.issparse(ism):
+        ism = ism.toarray()
+
+    V = len(np.asarray(Y1_labels).ravel())
+    for start in range(0, V, block_size):
+        stop = min(start + block_size, V)
+        yield start, stop, utils.expand_ism(
+            ism, Y1_labels, rows=slice(start, stop)
+        )
 
 
-def data_compression(fmri_masked, mask_img, mask_np, compression_dim):
+def data_compression(fmri_masked, mask_img, mask_np, compression_dim,
+                     cache_dir=None):
     # TODO @AKI update doc
     """
     Perform...
@@ -754,6 +2805,9 @@ def data_compression(fmri_masked, mask_img, mask_np, compression_dim):
     mask_np : a numpy array of the mask
     compression_dim : integer
         The number of elements that the data should be reduced to
+    cache_dir : string, optional
+        Directory where the connectivity graph of the mask is persisted,
+        see `spatial_connectivity`
 
     Returns
     -------
@@ -761,13 +2815,11 @@ def data_compression(fmri_masked, mask_img, mask_np, compression_dim):
 
     """
 
-    from sklearn.feature_extraction import image
     from sklearn.cluster import FeatureAgglomeration
+    import PyBASC.utils as utils
 
     # Perform Ward clustering
-    shape = mask_np.shape
-    connectivity = image.grid_to_graph(n_x=shape[0], n_y=shape[1],
-                                       n_z=shape[2], mask=mask_np)
+    connectivity = utils.spatial_connectivity(mask_np, cache_dir=cache_dir)
 
     ward = FeatureAgglomeration(n_clusters=compression_dim,
                                 connectivity=connectivity,